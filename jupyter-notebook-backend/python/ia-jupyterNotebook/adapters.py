@@ -0,0 +1,145 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Dict
+
+from peft import PeftModel
+
+DEFAULT_ADAPTER = "default"
+
+
+class AdapterError(Exception):
+    pass
+
+
+class UnknownAdapterError(AdapterError):
+    pass
+
+
+# Named LoRA adapters on top of one PeftModel. Every adapter that was ever
+# registered keeps its path; only the `max_loaded` most recently used ones stay
+# in memory, evicted ones are loaded again on their next request. The default
+# adapter is never evicted. Callers hold `lock` around anything touching the
+# model (generate, load, delete) so swaps never happen mid-decode, and must not
+# be inside torch.inference_mode() when activate() may load weights.
+# Each loaded adapter lives in the PeftModel under its own slot name, so a
+# (re)load builds the new weights next to the old ones and only swaps the name
+# over once they loaded.
+class AdapterRegistry:
+    def __init__(self, default_path: str, extra: Dict[str, str] | None = None, max_loaded: int = 4):
+        # The pinned default plus at least one swappable slot.
+        self.max_loaded = max(2, max_loaded)
+        self.lock = threading.RLock()
+        self.model: Any = None
+        self._paths: Dict[str, str] = {**(extra or {}), DEFAULT_ADAPTER: default_path}
+        # name -> adapter name inside the PeftModel.
+        self._loaded: "OrderedDict[str, str]" = OrderedDict()
+        self.loads = 0
+        self.evictions = 0
+
+    @property
+    def swappable(self) -> bool:
+        # Merged models still expose transformers' load_adapter; only a PeftModel
+        # keeps the LoRA layers separate from the base weights.
+        return isinstance(self.model, PeftModel)
+
+    def attach(self, model: Any) -> None:
+        with self.lock:
+            self.model = model
+            self._loaded = OrderedDict([(DEFAULT_ADAPTER, DEFAULT_ADAPTER)])
+            if not self.swappable:
+                # Merged/exported weights: only the adapter baked into them exists.
+                self._paths = {DEFAULT_ADAPTER: self._paths[DEFAULT_ADAPTER]}
+
+    def known(self, name: str) -> bool:
+        return name in self._paths
+
+    def path(self, name: str) -> str:
+        return self._paths.get(name, "")
+
+    def load(self, name: str, path: str) -> None:
+        # A failed load leaves the registry (and any adapter already loaded
+        # under `name`) exactly as it was.
+        if not self.swappable:
+            raise AdapterError("El backend actual no permite cambiar adaptadores (usa LORA_MERGE=0).")
+        if name == DEFAULT_ADAPTER:
+            raise AdapterError("El adaptador 'default' no se puede reemplazar.")
+        with self.lock:
+            slot = self._load_slot(name, path)
+            previous = self._loaded.pop(name, None)
+            if previous is not None:
+                self._delete_slot(previous)
+            self._paths[name] = path
+            self._register(name, slot)
+
+    def unload(self, name: str) -> None:
+        if name == DEFAULT_ADAPTER:
+            raise AdapterError("El adaptador 'default' no se puede descargar.")
+        with self.lock:
+            if name not in self._paths:
+                raise UnknownAdapterError(f"Adaptador no encontrado: {name}")
+            if name in self._loaded:
+                self._delete_slot(self._loaded.pop(name))
+            del self._paths[name]
+
+    def activate(self, name: str) -> None:
+        with self.lock:
+            if name not in self._paths:
+                raise UnknownAdapterError(f"Adaptador no encontrado: {name}")
+            if not self.swappable:
+                return
+            if name not in self._loaded:
+                self._register(name, self._load_slot(name, self._paths[name]))
+            self._loaded.move_to_end(name)
+            slot = self._loaded[name]
+            if self.model.active_adapter != slot:
+                self.model.set_adapter(slot)
+
+    def _activate_default(self) -> None:
+        if self.model.active_adapter != DEFAULT_ADAPTER:
+            self.model.set_adapter(DEFAULT_ADAPTER)
+
+    def _load_slot(self, name: str, path: str) -> str:
+        slot = f"{name}-v{self.loads + 1}"
+        try:
+            self.model.load_adapter(path, adapter_name=slot)
+        except Exception as err:
+            # Drop whatever part of the slot got created before the failure.
+            if slot in getattr(self.model, "peft_config", {}):
+                self._delete_slot(slot)
+            raise AdapterError(f"No se pudo cargar el adaptador '{name}': {err}") from err
+        self.model.eval()
+        self.loads += 1
+        return slot
+
+    def _delete_slot(self, slot: str) -> None:
+        if self.model.active_adapter == slot:
+            self._activate_default()
+        self.model.delete_adapter(slot)
+
+    def _register(self, name: str, slot: str) -> None:
+        self._loaded[name] = slot
+        while len(self._loaded) > self.max_loaded:
+            victim = next(key for key in self._loaded if key not in (DEFAULT_ADAPTER, name))
+            self._delete_slot(self._loaded.pop(victim))
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "swappable": self.swappable,
+                "registered": dict(self._paths),
+                "loaded": list(self._loaded),
+                "maxLoaded": self.max_loaded,
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
+
+
+def parse_adapter_paths(spec: str) -> Dict[str, str]:
+    # "name=path,name2=path2" as used by the LORA_ADAPTERS env var.
+    paths: Dict[str, str] = {}
+    for item in spec.split(","):
+        name, sep, path = item.partition("=")
+        if sep and name.strip() and path.strip():
+            paths[name.strip()] = path.strip()
+    return paths
@@ -0,0 +1,550 @@
+import argparse
+import random
+import time
+from collections import Counter, deque
+from typing import Dict, List, Tuple
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def print_row(name: str, latencies: List[float], extra: Dict[str, object] | None = None) -> None:
+    parts = [
+        f"{name:<24}",
+        f"n={len(latencies)}",
+        f"p50={percentile(latencies, 50) * 1000:.1f}ms",
+        f"p95={percentile(latencies, 95) * 1000:.1f}ms",
+    ]
+    parts += [f"{key}={value}" for key, value in (extra or {}).items()]
+    print("  ".join(parts))
+
+
+def bench_decode(args: argparse.Namespace) -> None:
+    import main
+
+    decodes: List[int] = []
+    run_batch = main._generate_batch
+
+    def counting_batch(prompts, gen_kwargs, timings=None):
+        decodes.append(len(prompts))
+        return run_batch(prompts, gen_kwargs, timings)
+
+    main._generate_batch = counting_batch
+    payload = main.ExerciseRequest(
+        topic=args.topic,
+        difficulty=args.difficulty,
+        exerciseType="completar_codigo",
+        datasetSize="pequeno",
+    )
+    main.load_pipeline()
+    for constrained in (False, True):
+        main.JSON_CONSTRAINED_DECODING = constrained
+        latencies: List[float] = []
+        per_request: List[int] = []
+        sources: Counter = Counter()
+        for _ in range(args.requests):
+            decodes.clear()
+            start = time.perf_counter()
+            result = main._generate_llm(payload, main._pick_task(payload))
+            latencies.append(time.perf_counter() - start)
+            per_request.append(sum(decodes))
+            sources[result["meta"]["source"]] += 1
+        print_row(
+            "constrained" if constrained else "retry_cascade",
+            latencies,
+            {
+                "avg_decodes": f"{sum(per_request) / len(per_request):.2f}",
+                "sources": dict(sources),
+            },
+        )
+
+
+def bench_early_stop(args: argparse.Namespace) -> None:
+    import main
+
+    tokenizer, _ = main.load_pipeline()
+    generated: List[int] = []
+    run_batch = main._generate_batch
+
+    def counting_batch(prompts, gen_kwargs, timings=None):
+        outputs = run_batch(prompts, gen_kwargs, timings)
+        generated.extend(len(tokenizer(text, add_special_tokens=False)["input_ids"]) for text in outputs)
+        return outputs
+
+    main._generate_batch = counting_batch
+    main.TOKEN_BUDGET_ADAPTIVE = False
+    main.MAX_NEW_TOKENS = args.max_new_tokens
+    payload = main.ExerciseRequest(
+        topic=args.topic,
+        difficulty=args.difficulty,
+        exerciseType="completar_codigo",
+        datasetSize="pequeno",
+    )
+    for constrained in (False, True):
+        main.JSON_CONSTRAINED_DECODING = constrained
+        baseline = 0.0
+        for early_stop in (False, True):
+            main.JSON_EARLY_STOP = early_stop
+            latencies: List[float] = []
+            per_request: List[int] = []
+            sources: Counter = Counter()
+            for _ in range(args.requests):
+                generated.clear()
+                start = time.perf_counter()
+                result = main._generate_llm(payload, main._pick_task(payload))
+                latencies.append(time.perf_counter() - start)
+                per_request.append(sum(generated))
+                sources[result["meta"]["source"]] += 1
+            tokens = sum(per_request) / len(per_request)
+            baseline = baseline or tokens
+            print_row(
+                f"{'constrained' if constrained else 'free'}_{'early_stop' if early_stop else 'eos'}",
+                latencies,
+                {
+                    "avg_new_tokens": f"{tokens:.1f}",
+                    "saved_per_request": f"{baseline - tokens:.1f}",
+                    "sources": dict(sources),
+                },
+            )
+
+
+def bench_cpu(args: argparse.Namespace) -> None:
+    import torch
+    from fastapi.testclient import TestClient
+
+    import main
+
+    generated_tokens: List[int] = []
+    run_batch = main._generate_batch
+
+    def counting_batch(prompts, gen_kwargs, timings=None):
+        outputs = run_batch(prompts, gen_kwargs, timings)
+        tokenizer, _ = main.load_pipeline()
+        generated_tokens.extend(len(ids) for ids in tokenizer(outputs, add_special_tokens=False)["input_ids"])
+        return outputs
+
+    main._generate_batch = counting_batch
+    main.GENERATION_MODE = "llm"
+    main.CPU_THREADS = args.threads
+    body = {
+        "topic": args.topic,
+        "difficulty": args.difficulty,
+        "exerciseType": "completar_codigo",
+        "datasetSize": "pequeno",
+        "noCache": True,
+    }
+    client = TestClient(main.app)
+    for backend in args.backends:
+        if backend == "cuda-4bit" and not torch.cuda.is_available():
+            print(f"{backend:<24}  skipped (no CUDA)")
+            continue
+        main.INFERENCE_BACKEND = backend
+        main.load_pipeline.cache_clear()
+        start = time.perf_counter()
+        try:
+            main.load_pipeline()
+        except Exception as err:
+            print(f"{backend:<24}  skipped ({err})")
+            continue
+        load_seconds = time.perf_counter() - start
+        client.post("/generate", json=body)
+        latencies: List[float] = []
+        generated_tokens.clear()
+        for _ in range(args.requests):
+            start = time.perf_counter()
+            response = client.post("/generate", json=body)
+            latencies.append(time.perf_counter() - start)
+            response.raise_for_status()
+        print_row(
+            backend,
+            latencies,
+            {
+                "tokens_per_s": f"{sum(generated_tokens) / sum(latencies):.1f}",
+                "load_s": f"{load_seconds:.1f}",
+            },
+        )
+
+
+def bench_template(args: argparse.Namespace) -> None:
+    import asyncio
+
+    import httpx
+
+    import main
+
+    main.GENERATION_MODE = "template"
+    main._response_cache = None
+    orjson = main.orjson
+    compiled = main.render_exercise
+    topics = ["pandas", "numpy", "markdown", "python"]
+    bodies = [
+        {
+            "topic": topics[i % len(topics)],
+            "difficulty": ["basica", "intermedia", "avanzada"][i % 3],
+            "exerciseType": ["completar_codigo", "explicar"][i % 2],
+            "datasetSize": "mediano",
+        }
+        for i in range(64)
+    ]
+
+    async def load_test(client: httpx.AsyncClient) -> List[float]:
+        latencies: List[float] = []
+        sem = asyncio.Semaphore(args.concurrency)
+
+        async def one(i: int) -> None:
+            async with sem:
+                start = time.perf_counter()
+                response = await client.post("/generate", json=bodies[i % len(bodies)])
+                latencies.append(time.perf_counter() - start)
+                response.raise_for_status()
+
+        await asyncio.gather(*(one(i) for i in range(args.requests)))
+        return latencies
+
+    variants = [
+        ("legacy_stdlib_json", lambda payload, task_spec: main.build_fallback_exercise(payload, {}, task_spec), None),
+        ("compiled_stdlib_json", compiled, None),
+        ("compiled_orjson", compiled, orjson),
+    ]
+    for name, render, encoder in variants:
+        if name.endswith("orjson") and orjson is None:
+            print(f"{name:<24}  skipped (orjson not installed)")
+            continue
+        main.render_exercise = render
+        main.orjson = encoder
+        payload = main.ExerciseRequest(**bodies[0])
+        task_spec = main._pick_task(payload)
+        render_runs = []
+        for _ in range(5):
+            start = time.perf_counter()
+            for _ in range(args.render_iterations):
+                render(payload, task_spec)
+            render_runs.append(time.perf_counter() - start)
+        render_us = min(render_runs) / args.render_iterations * 1e6
+        transport = httpx.ASGITransport(app=main.app)
+
+        async def run() -> Tuple[List[float], float]:
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+                await load_test(client)
+                start = time.perf_counter()
+                latencies = await load_test(client)
+                return latencies, time.perf_counter() - start
+
+        latencies, elapsed = asyncio.run(run())
+        print_row(
+            name,
+            latencies,
+            {
+                "p99": f"{percentile(latencies, 99) * 1000:.1f}ms",
+                "req_per_s": f"{len(latencies) / elapsed:.0f}",
+                "render": f"{render_us:.1f}us",
+            },
+        )
+    main.render_exercise = compiled
+    main.orjson = orjson
+
+
+def _legacy_parse(text: str) -> Dict:
+    # parse_json_response as it was before the scanner: strip fences, first "{" to last "}".
+    import json
+    import re
+
+    cleaned = re.sub(r"```.*?```", "", text, flags=re.S).strip()
+    start, end = cleaned.find("{"), cleaned.rfind("}")
+    if start == -1 or end == -1 or end <= start:
+        raise ValueError("no_json_object")
+    payload = json.loads(cleaned[start : end + 1])
+    if "exercise" in payload and isinstance(payload["exercise"], dict):
+        payload = payload["exercise"]
+    if "title" not in payload:
+        raise ValueError("missing_title")
+    return payload
+
+
+def _recorded_outputs(path: str) -> List[str]:
+    import json
+
+    import main
+
+    if path:
+        outputs = []
+        with open(path, encoding="utf-8") as handle:
+            for line in handle:
+                if line.strip():
+                    record = json.loads(line)
+                    outputs.append(record["output"] if isinstance(record, dict) else record)
+        return outputs
+    # No recordings: the shapes the model produces, built from the template exercises.
+    outputs = []
+    for i, topic in enumerate(["pandas", "numpy", "markdown", "python"]):
+        for difficulty in ("basica", "intermedia", "avanzada"):
+            payload = main.ExerciseRequest(
+                topic=topic, difficulty=difficulty, exerciseType="explicar", datasetSize="mediano"
+            )
+            blob = json.dumps(main.render_exercise(payload, main._pick_task(payload)), ensure_ascii=False)
+            outputs += [
+                blob,
+                f"Aqui tienes el ejercicio:\n{blob}\nEspero que te sirva.",
+                f"```json\n{blob}\n```",
+                f"{blob}\n{blob}",
+                blob + '\n{"nota": "fin"}',
+                blob[: len(blob) * (60 + i * 10) // 100],
+            ]
+    return outputs
+
+
+def bench_json_parse(args: argparse.Namespace) -> None:
+    import main
+    from json_repair import salvage_json
+    from json_stream import orjson, scan_json_objects
+
+    outputs = _recorded_outputs(args.outputs)
+    size = sum(len(text.encode("utf-8")) for text in outputs)
+
+    def run(parse, clear_cache: bool) -> Tuple[float, int]:
+        best, parsed = float("inf"), 0
+        for _ in range(args.repeat):
+            if clear_cache:
+                scan_json_objects.cache_clear()
+            parsed = 0
+            start = time.perf_counter()
+            for text in outputs:
+                try:
+                    parse(text)
+                    parsed += 1
+                except ValueError:
+                    pass
+            best = min(best, time.perf_counter() - start)
+        return best, parsed
+
+    def parse_or_repair(text: str) -> Dict:
+        try:
+            return main.parse_json_response(text)
+        except ValueError:
+            repaired = salvage_json(text, main.EXERCISE_SCHEMA)
+            if not repaired or not repaired.get("title"):
+                raise
+            return repaired
+
+    variants = [
+        ("legacy_regex_json", _legacy_parse, False),
+        ("scanner", main.parse_json_response, True),
+        ("scanner_rescan", main.parse_json_response, False),
+        ("scanner_local_repair", parse_or_repair, True),
+    ]
+    print(f"{len(outputs)} outputs, {size / 1024:.1f}KiB, orjson={'yes' if orjson is not None else 'no'}")
+    for name, parse, clear_cache in variants:
+        elapsed, parsed = run(parse, clear_cache)
+        print(
+            f"{name:<24}  parsed={parsed}/{len(outputs)}  "
+            f"{elapsed / len(outputs) * 1e6:.1f}us/output  {size / elapsed / 2**20:.1f}MiB/s"
+        )
+
+
+def _legacy_pick(recent: deque, task_key: str, bank: List[Dict]) -> Dict:
+    # Selection as it was before TaskIndex: linear scan of the history per candidate.
+    candidates = [
+        t for t in bank if not any(key == task_key and tid == t["id"] for key, tid in recent)
+    ]
+    choice = random.choice(candidates if candidates else bank)
+    recent.append((task_key, choice["id"]))
+    return choice
+
+
+def bench_task_index(args: argparse.Namespace) -> None:
+    from task_index import RecentTaskHistory, TaskIndex
+
+    for bank_size in args.bank_sizes:
+        bank = {"pandas": {"basica": [{"id": f"task_{i}"} for i in range(bank_size)]}}
+        group = TaskIndex(bank).group("pandas", "basica")
+        for history_size in args.history_sizes:
+            keys = [f"pandas::basica::tipo_{k}" for k in range(args.keys)]
+            history = RecentTaskHistory(history_size)
+            start = time.perf_counter()
+            for i in range(args.picks):
+                history.pick(keys[i % len(keys)], group)
+            indexed = (time.perf_counter() - start) / args.picks
+            legacy_picks = max(1, min(args.picks // 20, 20))
+            recent: deque = deque(maxlen=history_size)
+            for i in range(history_size):
+                recent.append((keys[i % len(keys)], f"task_{i % bank_size}"))
+            start = time.perf_counter()
+            for i in range(legacy_picks):
+                _legacy_pick(recent, keys[i % len(keys)], bank["pandas"]["basica"])
+            legacy = (time.perf_counter() - start) / legacy_picks
+            print(
+                f"bank={bank_size:<6} history={history_size:<6} "
+                f"indexed={indexed * 1e6:8.2f}us/pick  legacy={legacy * 1e6:10.2f}us/pick"
+            )
+
+
+def _write_synthetic_bank(root: str, tasks: int, per_file: int) -> Tuple[str, str]:
+    import json
+    import os
+    import sqlite3
+
+    from main import TASK_BANK
+
+    templates = [task for tiers in TASK_BANK.values() for group in tiers.values() for task in group]
+    keys = [(topic, tier) for topic in TASK_BANK for tier in ("basica", "intermedia", "avanzada")]
+    rows = []
+    for i in range(tasks):
+        topic, tier = keys[i % len(keys)]
+        rows.append({"topic": topic, "tier": tier, **templates[i % len(templates)], "id": f"synthetic_{i}"})
+    bank_dir = os.path.join(root, "bank")
+    os.makedirs(bank_dir)
+    for start in range(0, tasks, per_file):
+        with open(os.path.join(bank_dir, f"tasks_{start // per_file:05d}.json"), "w", encoding="utf-8") as handle:
+            json.dump(rows[start:start + per_file], handle, ensure_ascii=False)
+    db_path = os.path.join(root, "bank.sqlite3")
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE tasks (topic TEXT NOT NULL, tier TEXT NOT NULL, data TEXT NOT NULL)")
+    conn.executemany(
+        "INSERT INTO tasks (topic, tier, data) VALUES (?, ?, ?)",
+        ((row.pop("topic"), row.pop("tier"), json.dumps(row, ensure_ascii=False)) for row in rows),
+    )
+    conn.commit()
+    conn.close()
+    return bank_dir, db_path
+
+
+def bench_task_bank(args: argparse.Namespace) -> None:
+    import gc
+    import os
+    import tempfile
+    import threading
+    import tracemalloc
+
+    import main
+    from metrics import process_memory
+    from task_bank import TaskBankStore
+
+    root = tempfile.mkdtemp(prefix="task-bank-")
+    bank_dir, db_path = _write_synthetic_bank(root, args.tasks, args.per_file)
+    print(f"synthetic bank: {args.tasks} tasks in {root}")
+    for name, path in (("json-dir", bank_dir), ("sqlite", db_path)):
+        gc.collect()
+        rss_before = process_memory().get(("rss",), 0.0)
+        tracemalloc.start()
+        start = time.perf_counter()
+        store = TaskBankStore(path, main.TASK_BANK, main._build_bank_snapshot, main._norm, poll_seconds=0)
+        startup = time.perf_counter() - start
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        rss = process_memory().get(("rss",), 0.0) - rss_before
+        snapshot = store.snapshot
+
+        topics = sorted(snapshot.index.topics)
+        tiers = ("basica", "intermedia", "avanzada")
+        ops = snapshot.index.ops()
+        start = time.perf_counter()
+        for i in range(args.picks):
+            group = snapshot.index.group(topics[i % len(topics)], tiers[i % 3])
+            group.index_of[group.tasks[i % len(group.tasks)]["id"]]
+        pick = (time.perf_counter() - start) / args.picks
+        start = time.perf_counter()
+        for i in range(args.picks):
+            snapshot.index.with_op(topics[i % len(topics)], tiers[i % 3], ops[i % len(ops)])
+        with_op = (time.perf_counter() - start) / args.picks
+
+        # Reload while another thread keeps reading the live snapshot.
+        latencies: List[float] = []
+        stop = threading.Event()
+
+        def reader() -> None:
+            i = 0
+            while not stop.is_set():
+                t0 = time.perf_counter()
+                current = store.snapshot
+                group = current.index.group(topics[i % len(topics)], tiers[i % 3])
+                current.templates[group.tasks[i % len(group.tasks)]["id"]]
+                latencies.append(time.perf_counter() - t0)
+                i += 1
+
+        thread = threading.Thread(target=reader)
+        thread.start()
+        time.sleep(0.05)
+        target = os.path.join(bank_dir, "tasks_00000.json") if path == bank_dir else path
+        os.utime(target, ns=(time.time_ns(), time.time_ns() + 1_000_000))
+        start = time.perf_counter()
+        reloaded = store.reload_if_changed()
+        reload_seconds = time.perf_counter() - start
+        time.sleep(0.05)
+        stop.set()
+        thread.join()
+
+        print(
+            f"{name:<9} startup={startup:.2f}s  retained={retained / 2**20:.1f}MiB  peak={peak / 2**20:.1f}MiB  "
+            f"rss+={rss / 2**20:.1f}MiB  bytes/task={retained / max(1, len(snapshot.index)):.0f}  "
+            f"pick={pick * 1e6:.2f}us  with_op={with_op * 1e6:.2f}us"
+        )
+        print_row(
+            "  reads during reload", latencies,
+            {
+                "p99": f"{percentile(latencies, 99) * 1000:.3f}ms",
+                "reloaded": reloaded,
+                "reload_s": f"{reload_seconds:.2f}",
+            },
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    decode = sub.add_parser("decode", help="Constrained decoding vs JSON retry cascade (LLM mode).")
+    decode.add_argument("--requests", type=int, default=20)
+    decode.add_argument("--topic", default="pandas")
+    decode.add_argument("--difficulty", default="basica")
+    decode.set_defaults(func=bench_decode)
+
+    early_stop = sub.add_parser("early-stop", help="Tokens decoded per request with and without JSON_EARLY_STOP.")
+    early_stop.add_argument("--requests", type=int, default=20)
+    early_stop.add_argument("--max-new-tokens", type=int, default=768)
+    early_stop.add_argument("--topic", default="pandas")
+    early_stop.add_argument("--difficulty", default="basica")
+    early_stop.set_defaults(func=bench_early_stop)
+
+    cpu = sub.add_parser("cpu", help="/generate latency and tokens/s per INFERENCE_BACKEND.")
+    cpu.add_argument("--backends", nargs="+", default=["cuda-4bit", "cpu-fp32", "cpu-bf16", "cpu-int8", "onnx"])
+    cpu.add_argument("--requests", type=int, default=10)
+    cpu.add_argument("--threads", type=int, default=0)
+    cpu.add_argument("--topic", default="pandas")
+    cpu.add_argument("--difficulty", default="basica")
+    cpu.set_defaults(func=bench_cpu)
+
+    template = sub.add_parser("template", help="Compiled templates + orjson vs legacy builder under load.")
+    template.add_argument("--requests", type=int, default=5000)
+    template.add_argument("--concurrency", type=int, default=256)
+    template.add_argument("--render-iterations", type=int, default=20000)
+    template.set_defaults(func=bench_template)
+
+    task_index = sub.add_parser("task-index", help="Indexed task selection vs linear history scan.")
+    task_index.add_argument("--bank-sizes", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    task_index.add_argument("--history-sizes", type=int, nargs="+", default=[50, 500, 5000])
+    task_index.add_argument("--keys", type=int, default=4)
+    task_index.add_argument("--picks", type=int, default=20000)
+    task_index.set_defaults(func=bench_task_index)
+
+    json_parse = sub.add_parser("json-parse", help="JSON extraction throughput on model outputs.")
+    json_parse.add_argument("--outputs", default="", help="JSONL of recorded outputs ({\"output\": ...} per line).")
+    json_parse.add_argument("--repeat", type=int, default=200)
+    json_parse.set_defaults(func=bench_json_parse)
+
+    task_bank = sub.add_parser("task-bank", help="Startup, memory, lookups and hot reload of a file/SQLite bank.")
+    task_bank.add_argument("--tasks", type=int, default=50000)
+    task_bank.add_argument("--per-file", type=int, default=1000)
+    task_bank.add_argument("--picks", type=int, default=100000)
+    task_bank.set_defaults(func=bench_task_bank)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+import argparse
+import hashlib
+import json
+import re
+import time
+import zlib
+from collections import Counter, OrderedDict, deque
+from pathlib import Path
+from typing import Any, Deque, Dict, List, Tuple
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:  # optional, lines fall back to json.loads
+    orjson = None
+
+
+# Runs of UTF-8 bytes that are not ASCII spaces/punctuation; accented letters
+# stay inside their word.
+_WORD = re.compile(rb"[^\x00-\x2f\x3a-\x40\x5b-\x60\x7b-\x7f]+")
+_MERSENNE = np.uint64((1 << 61) - 1)
+_MASK32 = np.uint64(0xFFFFFFFF)
+_SHINGLE_MIX = np.uint64(1_000_003)
+
+
+def content_text(messages: List[Dict[str, Any]]) -> Tuple[bytes, bytes]:
+    # (exact key text, near-duplicate text). The exact key covers every
+    # message; the MinHash text skips system prompts, which are usually the
+    # same for the whole file and would make every row look alike.
+    exact: List[bytes] = []
+    near: List[bytes] = []
+    for message in messages:
+        role = str(message.get("role", ""))
+        content = str(message.get("content", "")).encode("utf-8")
+        exact.append(role.encode("utf-8") + b"\x1f" + content)
+        if role != "system":
+            near.append(content)
+    return b"\x1e".join(exact), b"\n".join(near)
+
+
+# Streaming dedup over chat rows: exact duplicates by an 8-byte hash of the
+# messages, near duplicates by MinHash (`num_perm` word `shingle`-grams) with
+# LSH banding, confirmed by the estimated Jaccard >= `threshold` against the
+# kept row that shares a band. Only hashes are held, never the text, and both
+# indexes are windowed so memory does not grow with the file: the exact set
+# holds the `window` most recently seen row hashes, the LSH index the
+# signatures and band keys of the last `window` kept rows. A duplicate of a
+# row that has left both windows is kept.
+class Deduper:
+    def __init__(
+        self,
+        threshold: float = 0.85,
+        num_perm: int = 128,
+        bands: int = 16,
+        shingle: int = 5,
+        window: int = 200_000,
+        seed: int = 1,
+        near: bool = True,
+    ):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands})")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows_per_band = num_perm // bands
+        self.shingle = max(1, shingle)
+        self.window = window
+        self.near = near
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, 1 << 32, size=num_perm, dtype=np.uint64)
+        self._band_mix = rng.integers(1, 1 << 63, size=self.rows_per_band, dtype=np.uint64) | np.uint64(1)
+        self._exact: "OrderedDict[int, int]" = OrderedDict()
+        self._buckets: List[Dict[int, int]] = [{} for _ in range(bands)]
+        self._signatures: Dict[int, np.ndarray] = {}
+        self._order: Deque[int] = deque()
+        self.rows = 0
+        self.kept = 0
+        self.exact_duplicates = 0
+        self.near_duplicates = 0
+        self.cluster_sizes: Counter = Counter()
+
+    def signature(self, text: bytes) -> np.ndarray:
+        words = _WORD.findall(text.lower()) or [b""]
+        hashes = np.fromiter((zlib.crc32(word) for word in words), dtype=np.uint64, count=len(words))
+        span = len(hashes) - self.shingle + 1
+        if span > 1:
+            shingles = hashes[:span].copy()
+            for offset in range(1, self.shingle):
+                shingles = (shingles * _SHINGLE_MIX + hashes[offset:offset + span]) & _MASK32
+            hashes = shingles
+        hashes = np.unique(hashes)
+        # a, b and the hashes are < 2**32, so a * h + b never overflows uint64.
+        permuted = (np.outer(hashes, self._a) + self._b) % _MERSENNE & _MASK32
+        return permuted.min(axis=0).astype(np.uint32)
+
+    def _band_keys(self, signature: np.ndarray) -> List[int]:
+        # One 64-bit (wrapping) hash per band of `rows_per_band` values.
+        bands = signature.reshape(self.bands, self.rows_per_band).astype(np.uint64)
+        return (bands * self._band_mix).sum(axis=1, dtype=np.uint64).tolist()
+
+    def keep(self, messages: List[Dict[str, Any]]) -> bool:
+        self.rows += 1
+        exact_text, near_text = content_text(messages)
+        digest = int.from_bytes(hashlib.blake2b(exact_text, digest_size=8).digest(), "little")
+        if digest in self._exact:
+            self._exact.move_to_end(digest)
+            self.exact_duplicates += 1
+            self.cluster_sizes[self._exact[digest]] += 1
+            return False
+
+        row_id = self.kept
+        if self.near:
+            signature = self.signature(near_text)
+            keys = self._band_keys(signature)
+            candidates = {bucket[key] for bucket, key in zip(self._buckets, keys) if key in bucket}
+            for candidate in sorted(candidates):
+                if np.count_nonzero(self._signatures[candidate] == signature) >= self.threshold * self.num_perm:
+                    self.near_duplicates += 1
+                    self.cluster_sizes[candidate] += 1
+                    self._remember(digest, candidate)
+                    return False
+            for bucket, key in zip(self._buckets, keys):
+                bucket.setdefault(key, row_id)
+            self._signatures[row_id] = signature
+            self._order.append(row_id)
+            if len(self._order) > self.window:
+                self._evict(self._order.popleft())
+
+        self._remember(digest, row_id)
+        self.kept += 1
+        return True
+
+    def keep_line(self, line: str | bytes) -> bool:
+        row = orjson.loads(line) if orjson is not None else json.loads(line)
+        return self.keep(row.get("messages", []))
+
+    def _remember(self, digest: int, row_id: int) -> None:
+        self._exact[digest] = row_id
+        if len(self._exact) > self.window:
+            self._exact.popitem(last=False)
+
+    def _evict(self, row_id: int) -> None:
+        signature = self._signatures.pop(row_id)
+        for bucket, key in zip(self._buckets, self._band_keys(signature)):
+            if bucket.get(key) == row_id:
+                del bucket[key]
+
+    def report(self, top: int = 20) -> Dict[str, Any]:
+        # Cluster = a kept row plus the rows dropped as its duplicates; `row`
+        # is the 0-based line of the kept row in the deduplicated output.
+        histogram: Counter = Counter({"1": self.kept - len(self.cluster_sizes)})
+        for extra in self.cluster_sizes.values():
+            size = extra + 1
+            low = 1 << ((size - 1).bit_length() - 1)
+            histogram[f"{low + 1}-{low * 2}" if low > 1 else "2"] += 1
+        return {
+            "rows": self.rows,
+            "kept": self.kept,
+            "exact_duplicates": self.exact_duplicates,
+            "near_duplicates": self.near_duplicates,
+            "threshold": self.threshold,
+            "clusters_with_duplicates": len(self.cluster_sizes),
+            "cluster_size_histogram": dict(sorted((+histogram).items(), key=lambda item: int(item[0].split("-")[0]))),
+            "largest_clusters": [
+                {"row": row, "size": extra + 1} for row, extra in self.cluster_sizes.most_common(top)
+            ],
+        }
+
+    def summary(self) -> str:
+        dropped = self.rows - self.kept
+        return (
+            f"Dedup: kept {self.kept}/{self.rows} rows ({self.exact_duplicates} exact, "
+            f"{self.near_duplicates} near duplicates, {len(self.cluster_sizes)} clusters)"
+            + (f", {dropped / max(self.rows, 1):.0%} dropped" if dropped else "")
+        )
+
+
+def add_dedup_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--dedup", action="store_true", help="Drop exact and near-duplicate rows.")
+    parser.add_argument("--dedup-threshold", type=float, default=0.85, help="MinHash Jaccard for near duplicates.")
+    parser.add_argument("--dedup-exact-only", action="store_true", help="Only drop exact duplicates.")
+    parser.add_argument("--dedup-report", default="", help="Cluster report path (default: {output}.dedup.json).")
+    parser.add_argument(
+        "--dedup-window", type=int, default=200_000, help="Recent rows held in the exact and LSH indexes."
+    )
+
+
+def deduper_from_args(args: argparse.Namespace) -> Deduper | None:
+    if not args.dedup:
+        return None
+    return Deduper(threshold=args.dedup_threshold, window=args.dedup_window, near=not args.dedup_exact_only)
+
+
+def write_report(deduper: Deduper, path: str) -> None:
+    with open(path, "w", encoding="utf-8") as handle:
+        json.dump(deduper.report(), handle, indent=2)
+    print(deduper.summary())
+    print(f"Dedup report: {path}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", required=True)
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--threshold", type=float, default=0.85)
+    parser.add_argument("--num-perm", type=int, default=128)
+    parser.add_argument("--bands", type=int, default=16)
+    parser.add_argument("--shingle", type=int, default=5, help="Words per shingle.")
+    parser.add_argument("--window", type=int, default=200_000, help="Recent rows held in the exact and LSH indexes.")
+    parser.add_argument("--exact-only", action="store_true")
+    parser.add_argument("--report", default="", help="Default: {output}.dedup.json")
+    args = parser.parse_args()
+
+    deduper = Deduper(
+        threshold=args.threshold,
+        num_perm=args.num_perm,
+        bands=args.bands,
+        shingle=args.shingle,
+        window=args.window,
+        near=not args.exact_only,
+    )
+    started = time.perf_counter()
+    with Path(args.input).open("rb") as f_in, Path(args.output).open("wb") as f_out:
+        for line in f_in:
+            if line.strip() and deduper.keep_line(line):
+                f_out.write(line if line.endswith(b"\n") else line + b"\n")
+    elapsed = time.perf_counter() - started
+    print(f"{deduper.rows} rows in {elapsed:.1f}s ({deduper.rows / max(elapsed, 1e-9):.0f} rows/s)")
+    write_report(deduper, args.report or f"{args.output}.dedup.json")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+import asyncio
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Tuple
+
+# run_batch(prompts, gen_kwargs, timings) may record stage -> seconds in `timings`.
+# Kwargs named in MicroBatcher(per_row=...) arrive as one value per prompt.
+BatchRunner = Callable[[List[str], Dict[str, Any], Dict[str, float]], List[str]]
+
+
+@dataclass
+class _PendingPrompt:
+    prompt: str
+    gen_kwargs: Dict[str, Any]
+    future: Future = field(default_factory=Future)
+    enqueued_at: float = field(default_factory=time.perf_counter)
+    trace: Any = None
+
+
+# One worker thread owns the model: prompts queued within `max_wait_ms` of the
+# first one (up to `max_batch_size`) are decoded together, grouped by kwargs.
+# `per_row` kwargs (e.g. max_new_tokens) may differ inside a group.
+class MicroBatcher:
+    def __init__(
+        self,
+        run_batch: BatchRunner,
+        max_batch_size: int = 8,
+        max_wait_ms: float = 10.0,
+        on_wait: Callable[[float], None] | None = None,
+        per_row: Tuple[str, ...] = (),
+    ):
+        self.run_batch = run_batch
+        self.on_wait = on_wait
+        self.per_row = per_row
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self._queue: "queue.Queue[_PendingPrompt | None]" = queue.Queue()
+        self._closed = False
+        self._worker = threading.Thread(target=self._loop, name="micro-batcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, prompt: str, trace: Any = None, **gen_kwargs: Any) -> Future:
+        # `trace` (a metrics.StageTimer) receives queue wait and the batch timings.
+        if self._closed:
+            raise RuntimeError("batcher_closed")
+        pending = _PendingPrompt(prompt, gen_kwargs, trace=trace)
+        self._queue.put(pending)
+        return pending.future
+
+    def generate(self, prompt: str, trace: Any = None, **gen_kwargs: Any) -> str:
+        return self.submit(prompt, trace, **gen_kwargs).result()
+
+    def close(self) -> None:
+        self._closed = True
+        self._queue.put(None)
+        self._worker.join()
+
+    def _collect(self, first: _PendingPrompt) -> Tuple[List[_PendingPrompt], bool]:
+        batch = [first]
+        deadline = first.enqueued_at + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _loop(self) -> None:
+        stop = False
+        while not stop:
+            first = self._queue.get()
+            if first is None:
+                break
+            batch, stop = self._collect(first)
+            groups: Dict[Tuple, List[_PendingPrompt]] = {}
+            for item in batch:
+                groups.setdefault(self._group_key(item), []).append(item)
+            for items in groups.values():
+                self._run_group(items)
+
+    def _group_key(self, item: _PendingPrompt) -> Tuple:
+        return tuple(sorted((key, value) for key, value in item.gen_kwargs.items() if key not in self.per_row))
+
+    def _run_group(self, items: List[_PendingPrompt]) -> None:
+        started = time.perf_counter()
+        timings: Dict[str, float] = {}
+        for item in items:
+            if self.on_wait is not None:
+                self.on_wait(started - item.enqueued_at)
+            if item.trace is not None:
+                item.trace.add("queue_wait", started - item.enqueued_at)
+        gen_kwargs = dict(items[0].gen_kwargs)
+        for key in self.per_row:
+            if any(key in item.gen_kwargs for item in items):
+                gen_kwargs[key] = [item.gen_kwargs.get(key) for item in items]
+        try:
+            outputs = self.run_batch([item.prompt for item in items], gen_kwargs, timings)
+        except Exception as err:
+            for item in items:
+                item.future.set_exception(err)
+            return
+        for item, text in zip(items, outputs):
+            if item.trace is not None:
+                item.trace.merge(timings)
+            item.future.set_result(text)
+
+
+class QueueFullError(RuntimeError):
+    pass
+
+
+# Bounded executor for blocking inference work: at most `max_queue` calls may be
+# pending (running or waiting) at once, the rest are rejected immediately.
+class InferencePool:
+    def __init__(self, max_workers: int = 8, max_queue: int = 32):
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(self.max_workers, max_queue)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="inference")
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._rejected = 0
+
+    @property
+    def depth(self) -> int:
+        return self._pending
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "depth": self._pending,
+                "running": min(self._pending, self.max_workers),
+                "maxQueue": self.max_queue,
+                "workers": self.max_workers,
+                "rejected": self._rejected,
+            }
+
+    def submit(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Future:
+        with self._lock:
+            if self._pending >= self.max_queue:
+                self._rejected += 1
+                raise QueueFullError("inference_queue_full")
+            self._pending += 1
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    async def run(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def _release(self, _future: Future | None) -> None:
+        with self._lock:
+            self._pending -= 1
+
+
+# Small LRU of precomputed prompt-prefix states (token ids + past-key-values).
+# Keys must identify the model and adapter so a swap never reuses stale KV.
+class PrefixCache:
+    def __init__(self, max_entries: int = 4):
+        self.max_entries = max(1, max_entries)
+        self._entries: "OrderedDict[Tuple, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Tuple, build: Callable[[], Any]) -> Any:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        value = build()
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+# Model lifecycle as seen by /ready: idle -> loading -> warming -> ready
+# (or error). Stage durations are recorded in seconds.
+class ReadinessState:
+    def __init__(self, status: str = "idle"):
+        self._lock = threading.Lock()
+        self.status = status
+        self.error: str | None = None
+        self.timings: Dict[str, float] = {}
+        self._stage_started = time.perf_counter()
+
+    def enter(self, status: str) -> None:
+        now = time.perf_counter()
+        with self._lock:
+            if self.status in ("loading", "warming"):
+                self.timings[f"{self.status}Seconds"] = round(now - self._stage_started, 3)
+            self.status = status
+            self._stage_started = now
+
+    def fail(self, err: Exception) -> None:
+        self.enter("error")
+        with self._lock:
+            self.error = str(err)
+
+    @property
+    def ready(self) -> bool:
+        return self.status == "ready"
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"status": self.status, "timings": dict(self.timings), "error": self.error}
+
+
+# Per-request decode counters for speculative decoding. Target forwards are
+# counted by a hook: each verifies `drafted` candidates and emits accepted + 1
+# tokens, so accepted = new_tokens - forwards.
+@dataclass(eq=False)
+class DecodeStats:
+    new_tokens: int = 0
+    drafted: int = 0
+    forwards: int = 0
+    seconds: float = 0.0
+
+    def add(self, new_tokens: int, forward_lengths: List[int], prompt_len: int, seconds: float) -> None:
+        if forward_lengths:
+            self.drafted += max(0, forward_lengths[0] - prompt_len)
+            self.drafted += sum(length - 1 for length in forward_lengths[1:])
+        self.new_tokens += new_tokens
+        self.forwards += len(forward_lengths)
+        self.seconds += seconds
+
+    def as_meta(self) -> Dict[str, Any]:
+        accepted = max(0, self.new_tokens - self.forwards)
+        return {
+            "newTokens": self.new_tokens,
+            "draftedTokens": self.drafted,
+            "acceptedTokens": accepted,
+            "acceptanceRate": round(min(1.0, accepted / self.drafted), 4) if self.drafted else None,
+            "tokensPerForward": round(self.new_tokens / self.forwards, 3) if self.forwards else None,
+            "tokensPerSecond": round(self.new_tokens / self.seconds, 2) if self.seconds else None,
+        }
+
+
+# Filled in by the batch runner for one prompt (a `per_row` kwarg): the tokens
+# generated for that row, without the padding after it stopped.
+@dataclass(eq=False)
+class RowUsage:
+    new_tokens: int = 0
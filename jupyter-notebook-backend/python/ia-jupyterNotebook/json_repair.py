@@ -0,0 +1,156 @@
+import json
+import re
+from typing import Any, Dict, List
+
+from json_stream import loads, scan_json_objects
+
+# A string literal (possibly cut off), a structural char or a bare word.
+_TOKEN = re.compile(r'"([^"\\]*(?:\\.[^"\\]*)*)"?|([{}\[\]:,])|([^\s{}\[\]:,"]+)', re.S)
+_STRING_FIX = re.compile(r'\\(?:u[0-9a-fA-F]{4}|["\\/bfnrt])|\\|[\x00-\x1f]')
+_NUMBER = re.compile(r"-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?")
+_LITERALS = {"true": "true", "false": "false", "null": "null", "True": "true", "False": "false", "None": "null"}
+
+
+def _fix_escape(match: "re.Match[str]") -> str:
+    text = match.group()
+    if len(text) > 1:
+        return text
+    if text == "\\":
+        return "\\\\"
+    return json.dumps(text)[1:-1]
+
+
+def _string(body: str) -> str:
+    # Raw newlines/tabs become escapes, unknown escapes a literal backslash.
+    return '"' + _STRING_FIX.sub(_fix_escape, body) + '"'
+
+
+def _scalar(word: str) -> str | None:
+    if word in _LITERALS:
+        return _LITERALS[word]
+    return word if _NUMBER.fullmatch(word) else None
+
+
+# Frame: [kind ("{" or "["), state, start of the current member in `out`, members].
+# Object states: key, colon, value, next. Array states: value, next.
+def _close(out: List[str], stack: List[List[Any]]) -> None:
+    kind, state, member_start, members = stack.pop()
+    if kind == "{":
+        if state in ("colon", "value"):
+            # Key without a value: drop it (and the comma before it).
+            del out[member_start:]
+        elif out[-1] == ",":
+            out.pop()
+        out.append("}")
+    else:
+        if out[-1] == ",":
+            out.pop()
+        out.append("]")
+    if stack:
+        stack[-1][1] = "next"
+        stack[-1][3] += 1
+
+
+def repair_json(text: str) -> str:
+    # Rebuilds the first object in `text` token by token: closes cut-off
+    # strings and brackets, drops trailing commas and dangling keys, inserts
+    # missing commas/colons, fixes string escapes and maps Python literals.
+    # Tokens that fit nowhere are skipped. The result may still be invalid.
+    out: List[str] = []
+    stack: List[List[Any]] = []
+    for match in _TOKEN.finditer(text):
+        body, punct, word = match.groups()
+        if not stack:
+            if punct == "{":
+                stack.append(["{", "key", 0, 0])
+                out.append("{")
+            continue
+        frame = stack[-1]
+        kind, state = frame[0], frame[1]
+        if punct in ("}", "]"):
+            _close(out, stack)
+            if not stack:
+                break
+            continue
+        if punct == ",":
+            if state == "next":
+                frame[2] = len(out)
+                out.append(",")
+                frame[1] = "key" if kind == "{" else "value"
+            continue
+        if punct == ":":
+            if state == "colon":
+                out.append(":")
+                frame[1] = "value"
+            continue
+        if body is not None:
+            value = _string(body)
+        elif word is not None:
+            value = _scalar(word)
+            if value is None:
+                continue
+        else:
+            value = punct
+        if state == "next":
+            frame[2] = len(out)
+            out.append(",")
+            state = "key" if kind == "{" else "value"
+        if kind == "{" and state == "key":
+            if body is None:
+                continue
+            if out[-1] != ",":
+                frame[2] = len(out)
+            out.append(value)
+            frame[1] = "colon"
+            continue
+        if state == "colon":
+            out.append(":")
+        if value in ("{", "["):
+            out.append(value)
+            frame[1] = "value"
+            stack.append([value, "key" if value == "{" else "value", len(out), 0])
+            continue
+        out.append(value)
+        frame[1] = "next"
+        frame[3] += 1
+    while stack:
+        _close(out, stack)
+    return "".join(out)
+
+
+def conform(value: Any, schema: Any) -> Any:
+    # Keeps only what `schema_from_example` describes; mismatched values are
+    # dropped (None) so the caller fills them from the template.
+    if isinstance(schema, tuple) and schema[0] == "object":
+        if not isinstance(value, dict):
+            return None
+        result: Dict[str, Any] = {}
+        for key, spec in schema[1]:
+            if key in value:
+                member = conform(value[key], spec)
+                if member is not None:
+                    result[key] = member
+        return result
+    if isinstance(schema, tuple) and schema[0] == "array":
+        if not isinstance(value, list):
+            return None
+        return [item for item in (conform(item, schema[1]) for item in value) if item is not None]
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    return None
+
+
+def salvage_json(text: str, schema: Any) -> Dict[str, Any] | None:
+    for candidate in scan_json_objects(text):
+        try:
+            payload = loads(repair_json(candidate.text))
+        except ValueError:
+            continue
+        if "exercise" in payload and isinstance(payload["exercise"], dict):
+            payload = payload["exercise"]
+        payload = conform(payload, schema)
+        if payload:
+            return payload
+    return None
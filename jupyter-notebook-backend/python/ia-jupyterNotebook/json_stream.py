@@ -0,0 +1,160 @@
+import json
+import re
+from functools import lru_cache
+from typing import Any, List, NamedTuple, Tuple
+
+try:
+    import orjson
+except ImportError:  # optional, json.loads is used instead
+    orjson = None
+
+_OUTSIDE = re.compile(r"\{|```")
+# A whole string literal in one match (group 1 is None if it is cut off), or a bracket.
+_INSIDE = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*(")?|[{}\[\]]')
+_CLOSER = {"{": "}", "[": "]"}
+_DECODER = json.JSONDecoder()
+
+
+# Feeds model text chunk by chunk and yields each top-level member of the first
+# JSON object as soon as its value is complete (string/brace aware).
+class IncrementalJSONParser:
+    def __init__(self) -> None:
+        self._started = False
+        self._finished = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._member: List[str] = []
+
+    @property
+    def finished(self) -> bool:
+        return self._finished
+
+    def feed(self, chunk: str) -> List[Tuple[str, Any]]:
+        fields: List[Tuple[str, Any]] = []
+        for ch in chunk:
+            if self._finished:
+                break
+            if not self._started:
+                if ch == "{":
+                    self._started = True
+                    self._depth = 1
+                continue
+            if self._in_string:
+                self._member.append(ch)
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+            if ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+            if self._depth == 0 or (self._depth == 1 and ch == ","):
+                fields.extend(self._flush_member())
+                if self._depth == 0:
+                    self._finished = True
+                continue
+            self._member.append(ch)
+        return fields
+
+    def _flush_member(self) -> List[Tuple[str, Any]]:
+        text = "".join(self._member).strip()
+        self._member = []
+        if not text:
+            return []
+        try:
+            member = json.loads("{" + text + "}")
+        except ValueError:
+            return []
+        if not isinstance(member, dict):
+            return []
+        items = list(member.items())
+        if len(items) == 1 and items[0][0] == "exercise" and isinstance(items[0][1], dict):
+            return list(items[0][1].items())
+        return items
+
+
+class JSONCandidate(NamedTuple):
+    text: str
+    complete: bool
+    fenced: bool
+    # What a cut-off candidate is missing to balance its strings and brackets.
+    closers: str = ""
+
+
+def loads(text: str) -> Any:
+    return orjson.loads(text) if orjson is not None else json.loads(text)
+
+
+def _object_end(text: str, start: int) -> int:
+    # Well-formed objects need no bracket walk: the usual single object (up to
+    # the last "}") or, failing that, the C decoder's end position. 0 = walk.
+    end = text.rfind("}") + 1
+    if orjson is not None and end > start:
+        try:
+            orjson.loads(text[start:end])
+            return end
+        except ValueError:
+            pass
+    try:
+        return _DECODER.raw_decode(text, start)[1]
+    except ValueError:
+        return 0
+
+
+@lru_cache(maxsize=256)
+def scan_json_objects(text: str) -> Tuple[JSONCandidate, ...]:
+    # One pass over the model output. Top-level {...} spans are found by
+    # bracket matching that skips string literals, so braces, quotes and ```
+    # inside strings do not count. Objects inside ``` fences are kept but rank
+    # after unfenced ones; a cut-off object at the end comes last. Cached so
+    # the retry, repair and fix stages do not rescan the same output.
+    found: List[JSONCandidate] = []
+    fenced_found: List[JSONCandidate] = []
+    fenced = False
+    pos = 0
+    length = len(text)
+    while pos < length:
+        match = _OUTSIDE.search(text, pos)
+        if match is None:
+            break
+        if match.group() == "```":
+            fenced = not fenced
+            pos = match.end()
+            continue
+        start = match.start()
+        end = _object_end(text, start)
+        if end:
+            pos = end
+            (fenced_found if fenced else found).append(JSONCandidate(text[start:pos], True, fenced))
+            continue
+        stack = ["{"]
+        pos = match.end()
+        cut_string = False
+        while stack:
+            token = _INSIDE.search(text, pos)
+            if token is None:
+                pos = length
+                break
+            pos = token.end()
+            ch = token.group()[0]
+            if ch == '"':
+                if token.group(1) is None:
+                    cut_string = True
+                    break
+            elif ch in "{[":
+                stack.append(ch)
+            else:
+                stack.pop()
+        if stack:
+            closers = ('"' if cut_string else "") + "".join(_CLOSER[ch] for ch in reversed(stack))
+            tail = JSONCandidate(text[start:], False, fenced, closers)
+            return tuple(found) + tuple(fenced_found) + (tail,)
+        (fenced_found if fenced else found).append(JSONCandidate(text[start:pos], True, fenced))
+    return tuple(found) + tuple(fenced_found)
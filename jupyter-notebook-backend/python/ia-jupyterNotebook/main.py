@@ -1,22 +1,96 @@
+import asyncio
+import copy
+import hmac
 import json
 import os
-import random
-import re
+import threading
+import time
 import unicodedata
-from collections import deque
+from contextlib import asynccontextmanager
 from functools import lru_cache
-from typing import Any, Dict, List
+from typing import Any, Callable, Dict, List, NamedTuple, Tuple
 
 import torch
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel, Field
-from peft import PeftModel
-from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+from transformers import AutoTokenizer, LogitsProcessorList, StoppingCriteriaList, TextIteratorStreamer
+
+try:
+    import orjson
+except ImportError:  # optional, responses fall back to the stdlib encoder
+    orjson = None
+
+from adapters import (
+    DEFAULT_ADAPTER,
+    AdapterError,
+    AdapterRegistry,
+    UnknownAdapterError,
+    parse_adapter_paths,
+)
+from inference import (
+    DecodeStats,
+    InferencePool,
+    MicroBatcher,
+    PrefixCache,
+    QueueFullError,
+    ReadinessState,
+    RowUsage,
+)
+from json_repair import salvage_json
+from json_stream import IncrementalJSONParser, loads as json_loads, scan_json_objects
+from metrics import (
+    RATE_BUCKETS,
+    TOKEN_BUCKETS,
+    MetricsRegistry,
+    StageTimer,
+    process_memory,
+    timed,
+)
+from model_backends import configure_cpu_threads, load_draft_model, load_model, supports_prefix_cache
+from response_cache import make_response_cache
+from task_bank import TaskBankStore
+from task_index import TaskIndex, make_task_history_store
+from schema_decoding import JSONCloseCriteria, RowBudgetCriteria, SchemaLogitsProcessor, schema_from_example
+from token_budget import TokenBudget
 
 BASE_MODEL = os.getenv("BASE_MODEL", "Qwen/Qwen3-4B-Instruct-2507")
 LORA_PATH = os.getenv("LORA_PATH", "./qwen3-jupyter-lora")
-MAX_NEW_TOKENS = int(os.getenv("MAX_NEW_TOKENS", "128"))
+LORA_ADAPTERS = parse_adapter_paths(os.getenv("LORA_ADAPTERS", ""))
+MAX_LOADED_ADAPTERS = int(os.getenv("MAX_LOADED_ADAPTERS", "4"))
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+# Merging folds the LoRA into the weights, which rules out swapping adapters:
+# only the default when extra adapters or the admin endpoints are configured.
+LORA_MERGE = os.getenv("LORA_MERGE", "0" if LORA_ADAPTERS or ADMIN_TOKEN else "1") == "1"
+MAX_NEW_TOKENS = int(os.getenv("MAX_NEW_TOKENS", "512"))
+TOKEN_BUDGET_ADAPTIVE = os.getenv("TOKEN_BUDGET_ADAPTIVE", "1") == "1"
+TOKEN_BUDGET_MIN = int(os.getenv("TOKEN_BUDGET_MIN", "96"))
+TOKEN_BUDGET_MAX = int(os.getenv("TOKEN_BUDGET_MAX", "1024"))
+TOKEN_BUDGET_QUANTILE = float(os.getenv("TOKEN_BUDGET_QUANTILE", "0.95"))
+TOKEN_BUDGET_MARGIN = float(os.getenv("TOKEN_BUDGET_MARGIN", "1.15"))
+TOKEN_BUDGET_PATH = os.getenv("TOKEN_BUDGET_PATH", "token_budget.json")
+TOKEN_BUDGET_KEYS_MAX = int(os.getenv("TOKEN_BUDGET_KEYS_MAX", "1000"))
+JSON_EARLY_STOP = os.getenv("JSON_EARLY_STOP", "1") == "1"
 GENERATION_MODE = os.getenv("GENERATION_MODE", "template").lower()
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "auto").lower()
+CPU_THREADS = int(os.getenv("CPU_THREADS", "0"))
+CPU_INTEROP_THREADS = int(os.getenv("CPU_INTEROP_THREADS", "0"))
+ONNX_EXPORT_DIR = os.getenv("ONNX_EXPORT_DIR", "./onnx-export")
+SPECULATIVE_MODE = os.getenv("SPECULATIVE_MODE", "off").lower()
+DRAFT_MODEL = os.getenv("DRAFT_MODEL", "Qwen/Qwen3-0.6B")
+NUM_ASSISTANT_TOKENS = int(os.getenv("NUM_ASSISTANT_TOKENS", "8"))
+PROMPT_LOOKUP_TOKENS = int(os.getenv("PROMPT_LOOKUP_TOKENS", "10"))
+PROMPT_LOOKUP_NGRAM = int(os.getenv("PROMPT_LOOKUP_NGRAM", "3"))
+JSON_CONSTRAINED_DECODING = os.getenv("JSON_CONSTRAINED_DECODING", "1") == "1"
+PREFIX_CACHE_ENABLED = os.getenv("PREFIX_CACHE", "1") == "1"
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "memory")
+RESPONSE_CACHE_MAX = int(os.getenv("RESPONSE_CACHE_MAX", "1024"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "response_cache.sqlite3")
+MODEL_WARMUP = os.getenv("MODEL_WARMUP", "1") == "1"
+WARMUP_NEW_TOKENS = int(os.getenv("WARMUP_NEW_TOKENS", "8"))
+NOT_READY_POLICY = os.getenv("NOT_READY_POLICY", "template").lower()
 
 JSON_SCHEMA = (
     '{"title":"...","instructions":"...","starterCode":"...","solutionCode":"...",'
@@ -24,12 +98,145 @@ JSON_SCHEMA = (
     '"files":[{"filename":"...","description":"...","columns":["..."]}],'
     '"steps":["..."],"acceptanceCriteria":["..."]}'
 )
+EXERCISE_SCHEMA = schema_from_example(JSON_SCHEMA)
+PROMPT_PREFIX = "\n".join(
+    [
+        "You are an expert instructor creating beginner-friendly Jupyter exercises.",
+        "Return ONLY valid JSON, no markdown fences, no extra commentary.",
+        "All text must be in Spanish.",
+        "Use exactly this schema (no extra keys):",
+        JSON_SCHEMA,
+        "Use \\\\n for line breaks inside the instructions field.",
+        "Difficulty rubric:",
+        "- basica: 1 paso principal, 1 transformacion simple.",
+        "- intermedia: 2-3 pasos, incluye filtro + agregacion.",
+        "- avanzada: 3-4 pasos, incluye pivot o merge y validacion.",
+        "The solution MUST reflect the difficulty rubric.",
+        "",
+    ]
+)
 
 DEFAULT_COLUMNS = ["id", "fecha", "categoria", "ventas", "costo"]
 HISTORY_MAX = int(os.getenv("TASK_HISTORY_MAX", "50"))
-_recent_tasks = deque(maxlen=HISTORY_MAX)
+TASK_HISTORY_BACKEND = os.getenv("TASK_HISTORY_BACKEND", "memory")
+TASK_HISTORY_PATH = os.getenv("TASK_HISTORY_PATH", "task_history.sqlite3")
+TASK_HISTORY_SCOPES_MAX = int(os.getenv("TASK_HISTORY_SCOPES_MAX", "10000"))
+TASK_BANK_PATH = os.getenv("TASK_BANK_PATH", "")
+TASK_BANK_POLL_SECONDS = float(os.getenv("TASK_BANK_POLL_SECONDS", "5"))
 MAX_JSON_FIX_TOKENS = int(os.getenv("MAX_JSON_FIX_TOKENS", "320"))
 MAX_JSON_FIX_ATTEMPTS = int(os.getenv("MAX_JSON_FIX_ATTEMPTS", "3"))
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "10"))
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", str(BATCH_MAX_SIZE)))
+INFERENCE_QUEUE_MAX = int(os.getenv("INFERENCE_QUEUE_MAX", "32"))
+INFERENCE_RETRY_AFTER = int(os.getenv("INFERENCE_RETRY_AFTER", "2"))
+_batcher: MicroBatcher | None = None
+_batcher_lock = threading.Lock()
+_inference_pool = InferencePool(max_workers=INFERENCE_WORKERS, max_queue=INFERENCE_QUEUE_MAX)
+_prefix_cache = PrefixCache()
+_adapters = AdapterRegistry(LORA_PATH, LORA_ADAPTERS, MAX_LOADED_ADAPTERS)
+_token_budget = TokenBudget(
+    MAX_NEW_TOKENS,
+    minimum=TOKEN_BUDGET_MIN,
+    maximum=TOKEN_BUDGET_MAX,
+    quantile=TOKEN_BUDGET_QUANTILE,
+    margin=TOKEN_BUDGET_MARGIN,
+    path=TOKEN_BUDGET_PATH,
+    max_keys=TOKEN_BUDGET_KEYS_MAX,
+)
+_metrics = MetricsRegistry()
+_stage_seconds = _metrics.histogram(
+    "exercise_stage_seconds", "Latency of each /generate stage.", labels=("stage",)
+)
+_model_tokens = _metrics.histogram(
+    "exercise_model_tokens", "Prompt (in) and generated (out) tokens per model batch.",
+    labels=("direction",), buckets=TOKEN_BUCKETS,
+)
+_decode_rate = _metrics.histogram(
+    "exercise_decode_tokens_per_second", "Generated tokens per second of decode, per batch.", buckets=RATE_BUCKETS
+)
+_budget_tokens = _metrics.histogram(
+    "exercise_token_budget", "max_new_tokens given to each exercise generation.", buckets=TOKEN_BUCKETS
+)
+_early_stop_tokens = _metrics.histogram(
+    "exercise_json_early_stop_tokens",
+    "Budget left when a row stopped at its JSON close (upper bound on tokens saved).",
+    labels=("kind",),
+    buckets=TOKEN_BUCKETS,
+)
+_batch_sizes = _metrics.histogram(
+    "exercise_batch_size", "Prompts decoded together per model call.", buckets=(1, 2, 4, 8, 16, 32)
+)
+_model_calls = _metrics.counter(
+    "exercise_model_calls_total", "Model generations per request step (sample, retry, fix).", labels=("kind",)
+)
+_json_repairs = _metrics.counter(
+    "exercise_json_repairs_total", "Local repairs of unparseable model JSON by result.", labels=("result",)
+)
+_model_calls_saved = _metrics.counter(
+    "exercise_model_calls_saved_total", "Model generations (retry or fix) skipped thanks to a local JSON repair."
+)
+_responses = _metrics.counter(
+    "exercise_responses_total", "Responses by meta.source.", labels=("endpoint", "source", "cached")
+)
+
+
+def _cache_counts() -> Dict[str, Dict[str, Any]]:
+    caches = {"prefix": _prefix_cache.stats()}
+    if _response_cache is not None:
+        caches["response"] = _response_cache.stats()
+    return caches
+
+
+def _gpu_memory() -> Dict[tuple, float]:
+    if not torch.cuda.is_available():
+        return {}
+    return {
+        ("allocated",): float(torch.cuda.memory_allocated()),
+        ("reserved",): float(torch.cuda.memory_reserved()),
+        ("peak_allocated",): float(torch.cuda.max_memory_allocated()),
+    }
+
+
+_metrics.callback(
+    "exercise_cache_requests_total",
+    "Prefix KV and response cache lookups by result.",
+    lambda: {
+        (cache, result): float(stats[key])
+        for cache, stats in _cache_counts().items()
+        for result, key in (("hit", "hits"), ("miss", "misses"))
+    },
+    labels=("cache", "result"),
+    kind="counter",
+)
+_metrics.callback(
+    "exercise_cache_hit_ratio",
+    "Hit ratio since startup per cache.",
+    lambda: {
+        (cache,): stats["hits"] / (stats["hits"] + stats["misses"])
+        for cache, stats in _cache_counts().items()
+        if stats["hits"] + stats["misses"]
+    },
+    labels=("cache",),
+)
+_metrics.callback(
+    "inference_pool_calls",
+    "Inference pool calls admitted (pending includes running) and running.",
+    lambda: {(state,): float(_inference_pool.stats()[key]) for state, key in (("pending", "depth"), ("running", "running"))},
+    labels=("state",),
+)
+_metrics.callback(
+    "inference_rejected_total",
+    "Calls rejected with 503 because the inference queue was full.",
+    lambda: {(): float(_inference_pool.stats()["rejected"])},
+    kind="counter",
+)
+_metrics.callback("process_memory_bytes", "Resident memory of the server process.", process_memory, labels=("kind",))
+_metrics.callback("gpu_memory_bytes", "CUDA memory held by torch.", _gpu_memory, labels=("kind",))
+_readiness = ReadinessState("ready" if GENERATION_MODE == "template" else "idle")
+_response_cache = make_response_cache(
+    RESPONSE_CACHE_BACKEND, RESPONSE_CACHE_MAX, RESPONSE_CACHE_TTL, RESPONSE_CACHE_PATH
+)
 
 TASK_BANK: Dict[str, Dict[str, List[Dict[str, Any]]]] = {
     "pandas": {
@@ -237,7 +444,58 @@ print(resumen)
     },
 }
 
-app = FastAPI(title="Jupyter Exercise AI", version="1.0.0")
+_task_history = make_task_history_store(
+    TASK_HISTORY_BACKEND, HISTORY_MAX, TASK_HISTORY_PATH, TASK_HISTORY_SCOPES_MAX
+)
+
+
+
+def _warm_up() -> None:
+    try:
+        _readiness.enter("loading")
+        load_pipeline()
+        _readiness.enter("warming")
+        payload = ExerciseRequest(
+            topic="pandas", difficulty="basica", exerciseType="completar_codigo", datasetSize="pequeno"
+        )
+        snapshot = _task_bank.snapshot
+        group = snapshot.index.group("pandas", "basica")
+        get_batcher().generate(
+            build_prompt(payload, group.tasks[0] if group else snapshot.default_task),
+            schema_constrained=JSON_CONSTRAINED_DECODING,
+            max_new_tokens=WARMUP_NEW_TOKENS,
+            temperature=0.5,
+            top_p=0.9,
+            top_k=40,
+        )
+        _readiness.enter("ready")
+    except Exception as err:
+        _readiness.fail(err)
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    _task_bank.start()
+    if GENERATION_MODE != "template" and MODEL_WARMUP:
+        threading.Thread(target=_warm_up, name="model-warmup", daemon=True).start()
+    yield
+    _task_bank.stop()
+    _token_budget.save()
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        if orjson is None:
+            return super().render(content)
+        return orjson.dumps(content)
+
+
+app = FastAPI(
+    title="Jupyter Exercise AI",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse,
+)
 
 
 class ExerciseRequest(BaseModel):
@@ -245,8 +503,18 @@ class ExerciseRequest(BaseModel):
     difficulty: str = Field(..., examples=["basica"])
     exerciseType: str = Field(..., examples=["completar_codigo"])
     datasetSize: str = Field(..., examples=["pequeno"])
+    userId: str | None = Field(None, examples=["usuario-123"], description="Usuario o sesion para el historial de tareas.")
+    noCache: bool = Field(False, description="Ignora la cache de respuestas para esta peticion.")
+    adapter: str | None = Field(None, examples=["default"], description="Adaptador LoRA registrado a usar.")
+    includeTimings: bool = Field(False, description="Agrega meta.timings con la duracion de cada etapa (ms).")
 
 
+class AdapterLoadRequest(BaseModel):
+    name: str = Field(..., examples=["jupyter-v2"])
+    path: str = Field(..., examples=["./qwen3-jupyter-lora-v2"])
+
+
+@lru_cache(maxsize=4096)
 def _norm(value: str) -> str:
     value = value.strip().lower()
     value = unicodedata.normalize("NFKD", value)
@@ -259,6 +527,7 @@ def _dataset_rows(size: str) -> int:
     return {"pequeno": 40, "mediano": 200, "grande": 1000}.get(size, 40)
 
 
+@lru_cache(maxsize=1024)
 def _difficulty_tier(difficulty: str) -> str:
     difficulty = _norm(difficulty)
     if difficulty in ("basica", "basico", "principiante"):
@@ -270,6 +539,7 @@ def _difficulty_tier(difficulty: str) -> str:
     return "basica"
 
 
+@lru_cache(maxsize=1024)
 def _dataset_description(topic: str) -> str:
     topic = _norm(topic)
     if "pandas" in topic or "analisis" in topic:
@@ -285,44 +555,71 @@ def _task_key(payload: ExerciseRequest) -> str:
     return f"{_norm(payload.topic)}::{_difficulty_tier(payload.difficulty)}::{_norm(payload.exerciseType)}"
 
 
-def _register_task(task_key: str, task_id: str) -> None:
-    _recent_tasks.append((task_key, task_id))
+def _adapter_name(payload: ExerciseRequest) -> str:
+    return payload.adapter or DEFAULT_ADAPTER
+
+
+def _response_cache_key(payload: ExerciseRequest, task_spec: Dict[str, Any]) -> str:
+    # The raw fields are echoed verbatim in title/instructions, so they are part
+    # of the key next to the normalized task key.
+    return json.dumps(
+        [
+            _task_key(payload),
+            _norm(payload.datasetSize),
+            task_spec.get("id", ""),
+            _task_bank.snapshot.version,
+            GENERATION_MODE,
+            _adapter_name(payload),
+            _adapters.path(_adapter_name(payload)),
+            payload.topic,
+            payload.difficulty,
+            payload.exerciseType,
+            payload.datasetSize,
+        ],
+        ensure_ascii=False,
+    )
+
+
+def _cached_response(payload: ExerciseRequest, task_spec: Dict[str, Any]) -> Dict[str, Any] | None:
+    if _response_cache is None or payload.noCache:
+        return None
+    cached = _response_cache.get(_response_cache_key(payload, task_spec))
+    if cached is not None:
+        cached["meta"]["cached"] = True
+    return cached
 
 
-def _is_recent(task_key: str, task_id: str) -> bool:
-    return any(key == task_key and tid == task_id for key, tid in _recent_tasks)
+def _store_response(payload: ExerciseRequest, task_spec: Dict[str, Any], result: Dict[str, Any]) -> None:
+    if _response_cache is not None and not result["meta"].get("fallback"):
+        _response_cache.set(_response_cache_key(payload, task_spec), result)
+
+
+async def _off_loop(blocking: bool, fn: Callable[..., Any], *args: Any) -> Any:
+    # SQLite-backed history/cache calls block on file I/O; in-memory ones are
+    # cheaper than the hop to the threadpool.
+    if blocking:
+        return await run_in_threadpool(fn, *args)
+    return fn(*args)
+
+
+def _cache_blocking() -> bool:
+    return _response_cache is not None and _response_cache.blocking
 
 
 def _pick_task(payload: ExerciseRequest) -> Dict[str, Any]:
-    topic = _norm(payload.topic)
-    difficulty = _difficulty_tier(payload.difficulty)
-    bank = TASK_BANK.get(topic, TASK_BANK["general"]).get(difficulty, [])
-    if not bank:
-        return TASK_BANK["general"]["basica"][0]
-    task_key = _task_key(payload)
-    candidates = [t for t in bank if not _is_recent(task_key, t["id"])]
-    choice = random.choice(candidates if candidates else bank)
-    _register_task(task_key, choice["id"])
-    return choice
+    snapshot = _task_bank.snapshot
+    group = snapshot.index.group(_norm(payload.topic), _difficulty_tier(payload.difficulty))
+    if group is None:
+        return snapshot.default_task
+    return _task_history.pick(payload.userId or "", _task_key(payload), group)
 
 
 def build_prompt(payload: ExerciseRequest, task_spec: Dict[str, Any]) -> str:
     dataset_rows = _dataset_rows(payload.datasetSize)
     dataset_description = _dataset_description(payload.topic)
     difficulty = _difficulty_tier(payload.difficulty)
-    return "\n".join(
+    return PROMPT_PREFIX + "\n".join(
         [
-            "You are an expert instructor creating beginner-friendly Jupyter exercises.",
-            "Return ONLY valid JSON, no markdown fences, no extra commentary.",
-            "All text must be in Spanish.",
-            "Use exactly this schema (no extra keys):",
-            JSON_SCHEMA,
-            "Use \\\\n for line breaks inside the instructions field.",
-            "Difficulty rubric:",
-            "- basica: 1 paso principal, 1 transformacion simple.",
-            "- intermedia: 2-3 pasos, incluye filtro + agregacion.",
-            "- avanzada: 3-4 pasos, incluye pivot o merge y validacion.",
-            "The solution MUST reflect the difficulty rubric.",
             f"topic: {payload.topic}",
             f"difficulty: {difficulty}",
             f"exerciseType: {payload.exerciseType}",
@@ -338,32 +635,34 @@ def build_prompt(payload: ExerciseRequest, task_spec: Dict[str, Any]) -> str:
 
 
 def parse_json_response(text: str) -> Dict[str, Any]:
-    cleaned = re.sub(r"```.*?```", "", text, flags=re.S).strip()
-    start, end = cleaned.find("{"), cleaned.rfind("}")
-    if start == -1 or end == -1 or end <= start:
-        raise ValueError("no_json_object")
-    payload = json.loads(cleaned[start : end + 1])
-    if not isinstance(payload, dict):
-        raise ValueError("json_not_object")
-    if "exercise" in payload and isinstance(payload["exercise"], dict):
-        payload = payload["exercise"]
-    if "title" not in payload:
-        raise ValueError("missing_title")
-    return payload
+    # First complete object that parses and has a title; prose, trailing junk
+    # and extra objects around it are ignored.
+    error = "no_json_object"
+    for candidate in scan_json_objects(text):
+        if not candidate.complete:
+            if error == "no_json_object":
+                error = "incomplete_json"
+            break
+        try:
+            payload = json_loads(candidate.text)
+        except ValueError:
+            error = "invalid_json"
+            continue
+        if "exercise" in payload and isinstance(payload["exercise"], dict):
+            payload = payload["exercise"]
+        if "title" in payload:
+            return payload
+        error = "missing_title"
+    raise ValueError(error)
 
 
 def _extract_json_blob(text: str) -> str:
-    cleaned = re.sub(r"```.*?```", "", text, flags=re.S).strip()
-    start, end = cleaned.find("{"), cleaned.rfind("}")
-    if start == -1 or end == -1 or end <= start:
-        return ""
-    return cleaned[start : end + 1]
+    candidates = scan_json_objects(text)
+    return candidates[0].text if candidates else ""
 
 
-def _fix_json_with_model(
-    tokenizer, model, raw_text: str, schema: str = JSON_SCHEMA
-) -> str:
-    fix_prompt = "\n".join(
+def _fix_prompt_prefix(schema: str) -> str:
+    return "\n".join(
         [
             "You are a strict JSON fixer.",
             "Return ONLY valid JSON, no commentary, no markdown.",
@@ -372,27 +671,37 @@ def _fix_json_with_model(
             "Fix the following output to match the schema exactly:",
             schema,
             "Broken output:",
-            raw_text.strip(),
+            "",
         ]
     )
-    inputs = tokenizer(fix_prompt, return_tensors="pt").to(model.device)
-    with torch.inference_mode():
-        output = model.generate(
-            **inputs,
-            max_new_tokens=MAX_JSON_FIX_TOKENS,
-            temperature=0.1,
-            top_p=0.7,
-            top_k=50,
-            do_sample=True,
-            repetition_penalty=1.08,
-            eos_token_id=tokenizer.eos_token_id,
-            pad_token_id=tokenizer.pad_token_id,
-            num_beams=1,
-            early_stopping=True,
-        )
-    prompt_len = inputs["input_ids"].shape[-1]
-    generated_tokens = output[0][prompt_len:]
-    return tokenizer.decode(generated_tokens, skip_special_tokens=True)
+
+
+FIX_PROMPT_PREFIX = _fix_prompt_prefix(JSON_SCHEMA)
+# Constant prompt headers whose KV cache is computed once and reused.
+CACHED_PROMPT_PREFIXES = (PROMPT_PREFIX, FIX_PROMPT_PREFIX)
+
+
+def _fix_json_with_model(
+    raw_text: str,
+    schema: str = JSON_SCHEMA,
+    stats: DecodeStats | None = None,
+    adapter: str = DEFAULT_ADAPTER,
+    trace: StageTimer | None = None,
+) -> str:
+    prefix = FIX_PROMPT_PREFIX if schema == JSON_SCHEMA else _fix_prompt_prefix(schema)
+    # Only the JSON part of the output (cut-off objects included) when there is one.
+    fix_prompt = prefix + (_extract_json_blob(raw_text) or raw_text).strip()
+    return get_batcher().generate(
+        fix_prompt,
+        trace,
+        **_decode_kwargs(adapter, stats),
+        schema_constrained=JSON_CONSTRAINED_DECODING,
+        stop_on_json_close="fix" if JSON_EARLY_STOP else "",
+        max_new_tokens=MAX_JSON_FIX_TOKENS,
+        temperature=0.1,
+        top_p=0.7,
+        top_k=50,
+    )
 
 
 def parse_key_value_response(text: str) -> Dict[str, str]:
@@ -411,25 +720,17 @@ def parse_key_value_response(text: str) -> Dict[str, str]:
     return kv
 
 
-def build_fallback_exercise(
-    payload: ExerciseRequest, kv: Dict[str, str], task_spec: Dict[str, Any] | None = None
-) -> Dict[str, Any]:
-    topic = _norm(payload.topic)
-    difficulty = _difficulty_tier(payload.difficulty)
-    exercise_type = _norm(payload.exerciseType)
-    dataset_rows = _dataset_rows(payload.datasetSize)
-    dataset_description = kv.get("datasetDescription") or _dataset_description(payload.topic)
-    columns = DEFAULT_COLUMNS
-    task_spec = task_spec or {}
+@lru_cache(maxsize=1024)
+def _topic_family(topic: str) -> str:
+    topic = _norm(topic)
+    for family in ("pandas", "numpy", "markdown"):
+        if family in topic:
+            return family
+    return "general"
 
-    base_instructions = [
-        f"Practica {payload.topic} con dificultad {payload.difficulty}.",
-        f"Tipo de actividad: {payload.exerciseType}.",
-        f"Trabaja con un dataset de tamano {payload.datasetSize} (~{dataset_rows} filas).",
-        f"Contexto del archivo: {dataset_description}.",
-    ]
 
-    if "pandas" in topic:
+def _exercise_parts(family: str, task_spec: Dict[str, Any]) -> Tuple[str, str, str, str]:
+    if family == "pandas":
         task = task_spec.get("task", "calcular el promedio de ventas por categoria")
         starter = task_spec.get(
             "starter",
@@ -450,7 +751,7 @@ print(resumen)
 """,
         )
         expected = task_spec.get("expected", "Resultado tabular con el resumen solicitado.")
-    elif "numpy" in topic:
+    elif family == "numpy":
         task = task_spec.get("task", "calcular media y desviacion estandar por columna")
         starter = task_spec.get(
             "starter",
@@ -476,7 +777,7 @@ print('desv:', desv)
 """,
         )
         expected = task_spec.get("expected", "Salida con media y desviacion estandar por columna numerica.")
-    elif "markdown" in topic:
+    elif family == "markdown":
         task = task_spec.get("task", "redactar un reporte corto en Markdown")
         starter = task_spec.get(
             "starter",
@@ -519,15 +820,50 @@ print('desv:', desv)
         )
         expected = task_spec.get("expected", "Salida coherente con la logica solicitada.")
 
+    return task, starter, solution, expected
+
+
+HINTS = (
+    "Verifica que el archivo cargue sin columnas nulas inesperadas.",
+    "Descompone el problema en pasos pequenos y validables.",
+    "Compara tu salida con el criterio de aceptacion.",
+)
+STEPS = (
+    "Carga el archivo de datos y revisa columnas y tipos.",
+    "Aplica la operacion solicitada segun el tema.",
+    "Muestra la salida final y valida que sea consistente.",
+)
+ACCEPTANCE_CRITERIA = (
+    "El codigo se ejecuta sin errores.",
+    "La salida cumple el objetivo del ejercicio.",
+    "El resultado usa correctamente las columnas esperadas.",
+)
+
+
+def build_fallback_exercise(
+    payload: ExerciseRequest, kv: Dict[str, str], task_spec: Dict[str, Any] | None = None
+) -> Dict[str, Any]:
+    difficulty = _difficulty_tier(payload.difficulty)
+    exercise_type = _norm(payload.exerciseType)
+    dataset_rows = _dataset_rows(payload.datasetSize)
+    dataset_description = kv.get("datasetDescription") or _dataset_description(payload.topic)
+    columns = DEFAULT_COLUMNS
+    task_spec = task_spec or {}
+
+    base_instructions = [
+        f"Practica {payload.topic} con dificultad {payload.difficulty}.",
+        f"Tipo de actividad: {payload.exerciseType}.",
+        f"Trabaja con un dataset de tamano {payload.datasetSize} (~{dataset_rows} filas).",
+        f"Contexto del archivo: {dataset_description}.",
+    ]
+
+    task, starter, solution, expected = _exercise_parts(_topic_family(payload.topic), task_spec)
+
     instructions = "\n".join(base_instructions)
     if exercise_type not in ("completar_codigo", "completar-codigo"):
         instructions += f"\nActividad sugerida: {task}."
 
-    hints = [
-        "Verifica que el archivo cargue sin columnas nulas inesperadas.",
-        "Descompone el problema en pasos pequenos y validables.",
-        "Compara tu salida con el criterio de aceptacion.",
-    ]
+    hints = list(HINTS)
     if difficulty == "avanzada":
         hints = hints[:2]
 
@@ -545,19 +881,89 @@ print('desv:', desv)
                 "columns": columns,
             }
         ],
-        "steps": [
-            "Carga el archivo de datos y revisa columnas y tipos.",
-            "Aplica la operacion solicitada segun el tema.",
-            "Muestra la salida final y valida que sea consistente.",
-        ],
-        "acceptanceCriteria": [
-            "El codigo se ejecuta sin errores.",
-            "La salida cumple el objetivo del ejercicio.",
-            "El resultado usa correctamente las columnas esperadas.",
-        ],
+        "steps": list(STEPS),
+        "acceptanceCriteria": list(ACCEPTANCE_CRITERIA),
+    }
+
+
+# Per task: the family-dependent parts resolved once, shared by every request.
+class ExerciseTemplate(NamedTuple):
+    task: str
+    starter: str
+    solution: str
+    expected: str
+
+
+TOPIC_FAMILIES = ("pandas", "numpy", "markdown", "general")
+_HINTS_BY_TIER = {"basica": HINTS, "intermedia": HINTS, "avanzada": HINTS[:2]}
+
+
+def _compile_templates(bank: Dict[str, Dict[str, List[Dict[str, Any]]]]) -> Dict[str, Tuple[ExerciseTemplate, ...]]:
+    templates: Dict[str, Tuple[ExerciseTemplate, ...]] = {}
+    for tiers in bank.values():
+        for tasks in tiers.values():
+            for task_spec in tasks:
+                variants: Dict[Tuple[str, ...], ExerciseTemplate] = {}
+                per_family = []
+                for family in TOPIC_FAMILIES:
+                    parts = _exercise_parts(family, task_spec)
+                    # Complete task specs render the same for every family: keep one object.
+                    per_family.append(variants.setdefault(parts, ExerciseTemplate(*parts)))
+                templates[task_spec["id"]] = tuple(per_family)
+    return templates
+
+
+# Same output as build_fallback_exercise(payload, {}, task_spec), but only the
+# request-specific strings are built per call. Tasks outside the compiled bank
+# go through the generic builder.
+def render_exercise(payload: ExerciseRequest, task_spec: Dict[str, Any]) -> Dict[str, Any]:
+    variants = _task_bank.snapshot.templates.get(task_spec.get("id", ""))
+    if variants is None:
+        return build_fallback_exercise(payload, {}, task_spec)
+    template = variants[TOPIC_FAMILIES.index(_topic_family(payload.topic))]
+    description = _dataset_description(payload.topic)
+    instructions = (
+        f"Practica {payload.topic} con dificultad {payload.difficulty}.\n"
+        f"Tipo de actividad: {payload.exerciseType}.\n"
+        f"Trabaja con un dataset de tamano {payload.datasetSize} (~{_dataset_rows(payload.datasetSize)} filas).\n"
+        f"Contexto del archivo: {description}."
+    )
+    if _norm(payload.exerciseType) not in ("completar_codigo", "completar-codigo"):
+        instructions += f"\nActividad sugerida: {template.task}."
+    return {
+        "title": f"Ejercicio de {payload.topic} ({payload.difficulty})",
+        "instructions": instructions,
+        "starterCode": template.starter,
+        "solutionCode": template.solution,
+        "expectedOutput": template.expected,
+        # Fresh lists, as build_fallback_exercise returns: callers may append.
+        "hints": list(_HINTS_BY_TIER[_difficulty_tier(payload.difficulty)]),
+        "files": [{"filename": "datos_practica.csv", "description": description, "columns": list(DEFAULT_COLUMNS)}],
+        "steps": list(STEPS),
+        "acceptanceCriteria": list(ACCEPTANCE_CRITERIA),
     }
 
 
+# Everything derived from one version of the bank, swapped as a unit on reload.
+class BankSnapshot(NamedTuple):
+    index: TaskIndex
+    templates: Dict[str, Tuple[ExerciseTemplate, ...]]
+    default_task: Dict[str, Any]
+    version: str
+
+
+def _build_bank_snapshot(bank: Dict[str, Dict[str, List[Dict[str, Any]]]], version: str) -> BankSnapshot:
+    index = TaskIndex(bank)
+    if not len(index):
+        raise ValueError("Task bank is empty")
+    group = index.group("general", "basica")
+    default_task = group.tasks[0] if group else next(t for tiers in bank.values() for ts in tiers.values() for t in ts)
+    return BankSnapshot(index, _compile_templates(bank), default_task, version)
+
+
+_task_bank = TaskBankStore(TASK_BANK_PATH, TASK_BANK, _build_bank_snapshot, _norm, TASK_BANK_POLL_SECONDS)
+
+
 def _merge_missing(base: Dict[str, Any], defaults: Dict[str, Any]) -> Dict[str, Any]:
     for key, value in defaults.items():
         if key not in base or base[key] in (None, ""):
@@ -565,100 +971,535 @@ def _merge_missing(base: Dict[str, Any], defaults: Dict[str, Any]) -> Dict[str,
     return base
 
 
+def _inference_backend() -> str:
+    if INFERENCE_BACKEND == "auto":
+        return "cuda-4bit" if torch.cuda.is_available() else "cpu-bf16"
+    return INFERENCE_BACKEND
+
+
 @lru_cache(maxsize=1)
 def load_pipeline():
     tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL, use_fast=True, trust_remote_code=True)
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token
+    # Batched prompts must end at the same position so decoding starts aligned.
+    tokenizer.padding_side = "left"
 
-    bnb_config = BitsAndBytesConfig(
-        load_in_4bit=True,
-        bnb_4bit_quant_type="nf4",
-        bnb_4bit_compute_dtype=torch.float16,
-        bnb_4bit_use_double_quant=True,
-    )
-
-    base_model = AutoModelForCausalLM.from_pretrained(
-        BASE_MODEL,
-        device_map="auto",
-        quantization_config=bnb_config,
-        torch_dtype=torch.float16,
-        trust_remote_code=True,
-    )
-    model = PeftModel.from_pretrained(base_model, LORA_PATH)
-    model.eval()
+    configure_cpu_threads(CPU_THREADS, CPU_INTEROP_THREADS)
+    model = load_model(_inference_backend(), BASE_MODEL, LORA_PATH, ONNX_EXPORT_DIR, merge_lora=LORA_MERGE)
+    _adapters.attach(model)
+    _prefix_cache.clear()
     return tokenizer, model
 
 
-@app.get("/health")
-def health():
-    return {"ok": True}
+@lru_cache(maxsize=1)
+def load_draft():
+    return load_draft_model(_inference_backend(), DRAFT_MODEL)
 
 
-@app.post("/generate")
-def generate(payload: ExerciseRequest):
-    try:
-        task_spec = _pick_task(payload)
-        if GENERATION_MODE == "template":
-            exercise = build_fallback_exercise(payload, {}, task_spec)
-            return {"exercise": exercise, "meta": {"fallback": False, "source": "template"}}
-
-        tokenizer, model = load_pipeline()
-        prompt = build_prompt(payload, task_spec)
-        inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
-        raw_output = ""
-        for attempt in range(2):
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-            with torch.inference_mode():
+def _speculative_kwargs() -> Dict[str, Any]:
+    # Assisted generation in transformers only decodes one sequence at a time.
+    if SPECULATIVE_MODE == "draft":
+        draft = load_draft()
+        draft.generation_config.num_assistant_tokens = NUM_ASSISTANT_TOKENS
+        return {"assistant_model": draft}
+    if SPECULATIVE_MODE == "prompt_lookup":
+        return {
+            "prompt_lookup_num_tokens": PROMPT_LOOKUP_TOKENS,
+            "max_matching_ngram_size": PROMPT_LOOKUP_NGRAM,
+        }
+    return {}
+
+
+def _decode_kwargs(adapter: str, stats: DecodeStats | None) -> Dict[str, Any]:
+    # The adapter is part of the kwargs so the batcher never mixes adapters in a batch.
+    kwargs: Dict[str, Any] = {"adapter": adapter}
+    if stats is not None:
+        kwargs["decode_stats"] = stats
+    return kwargs
+
+
+def _new_decode_stats() -> DecodeStats | None:
+    return DecodeStats() if SPECULATIVE_MODE != "off" else None
+
+
+def _encode_prefix(tokenizer, model, prefix: str):
+    prefix_ids = tokenizer(prefix, return_tensors="pt")["input_ids"].to(model.device)
+    past_key_values = model(input_ids=prefix_ids, use_cache=True).past_key_values
+    return prefix_ids, past_key_values
+
+
+def _prefixed_inputs(tokenizer, model, adapter: str, prefix: str, prompts: List[str]) -> Dict[str, Any]:
+    # The shared prefix comes from the cache; suffixes are left-padded after it,
+    # the padding sits between prefix and suffix and is masked out.
+    prefix_ids, prefix_kv = _prefix_cache.get(
+        (id(model), BASE_MODEL, adapter, _adapters.path(adapter), prefix),
+        lambda: _encode_prefix(tokenizer, model, prefix),
+    )
+    suffix = tokenizer(
+        [prompt[len(prefix) :] for prompt in prompts],
+        return_tensors="pt",
+        padding=True,
+        add_special_tokens=False,
+    ).to(model.device)
+    batch_size = len(prompts)
+    past_key_values = copy.deepcopy(prefix_kv)
+    if batch_size > 1:
+        past_key_values.batch_repeat_interleave(batch_size)
+    prefix_mask = torch.ones(
+        (batch_size, prefix_ids.shape[-1]), dtype=suffix["attention_mask"].dtype, device=model.device
+    )
+    return {
+        "input_ids": torch.cat([prefix_ids.expand(batch_size, -1), suffix["input_ids"]], dim=1),
+        "attention_mask": torch.cat([prefix_mask, suffix["attention_mask"]], dim=1),
+        "past_key_values": past_key_values,
+    }
+
+
+def _shared_prefix(prompts: List[str]) -> str:
+    for prefix in CACHED_PROMPT_PREFIXES:
+        if all(prompt.startswith(prefix) and len(prompt) > len(prefix) for prompt in prompts):
+            return prefix
+    return ""
+
+
+def _generate_batch(
+    prompts: List[str], gen_kwargs: Dict[str, Any], timings: Dict[str, float] | None = None
+) -> List[str]:
+    timings = timings if timings is not None else {}
+    tokenizer, model = load_pipeline()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    gen_kwargs = dict(gen_kwargs)
+    schema_constrained = gen_kwargs.pop("schema_constrained", False)
+    stats = gen_kwargs.pop("decode_stats", None)
+    adapter = gen_kwargs.pop("adapter", DEFAULT_ADAPTER)
+    # Truthy value = label for the early-stop metric ("sample", "stream", "fix").
+    stop_on_json_close = gen_kwargs.pop("stop_on_json_close", "")
+    budgets = gen_kwargs.pop("max_new_tokens", MAX_NEW_TOKENS)
+    budgets = budgets if isinstance(budgets, list) else [budgets] * len(prompts)
+    # A row without a value of its own (e.g. warm-up next to a request) gets the default.
+    budgets = [MAX_NEW_TOKENS if budget is None else budget for budget in budgets]
+    usages = gen_kwargs.pop("usage", None)
+    usages = usages if isinstance(usages, list) else [usages] * len(prompts)
+    gen_kwargs["max_new_tokens"] = max(budgets)
+    gen_kwargs.update(_speculative_kwargs())
+    with _adapters.lock:
+        # Activation may load the adapter's weights; outside inference_mode they
+        # are normal tensors, as with POST /admin/adapters.
+        _adapters.activate(adapter)
+        with torch.inference_mode():
+            use_prefix = (
+                PREFIX_CACHE_ENABLED
+                and SPECULATIVE_MODE == "off"
+                and supports_prefix_cache(_inference_backend())
+            )
+            prefix = _shared_prefix(prompts) if use_prefix else ""
+            started = time.perf_counter()
+            if prefix:
+                inputs = _prefixed_inputs(tokenizer, model, adapter, prefix, prompts)
+            else:
+                inputs = tokenizer(prompts, return_tensors="pt", padding=True).to(model.device)
+            prompt_len = inputs["input_ids"].shape[-1]
+            timings["tokenize"] = time.perf_counter() - started
+            if schema_constrained:
+                gen_kwargs["logits_processor"] = LogitsProcessorList(
+                    [SchemaLogitsProcessor(tokenizer, EXERCISE_SCHEMA, prompt_len)]
+                )
+            stopping = StoppingCriteriaList()
+            if min(budgets) < max(budgets):
+                stopping.append(RowBudgetCriteria(prompt_len, budgets))
+            json_close = JSONCloseCriteria(tokenizer, prompt_len) if stop_on_json_close else None
+            if json_close is not None:
+                stopping.append(json_close)
+            if stopping:
+                gen_kwargs["stopping_criteria"] = stopping
+            forward_lengths: List[int] = []
+            first_forward_done: List[float] = []
+
+            def mark_prefill(*_: Any) -> None:
+                # The first forward is the prefill; everything after it is decode.
+                if not first_forward_done:
+                    first_forward_done.append(time.perf_counter())
+
+            target = model.get_base_model() if hasattr(model, "get_base_model") else model
+            # ORT models are not nn.Modules: no hooks, only wall-clock timing.
+            hooks = [target.register_forward_hook(mark_prefill)] if isinstance(target, torch.nn.Module) else []
+            if stats is not None and hooks:
+                hooks.append(
+                    target.register_forward_pre_hook(
+                        lambda _module, args, kwargs: forward_lengths.append(
+                            (kwargs.get("input_ids") if kwargs.get("input_ids") is not None else args[0]).shape[-1]
+                        ),
+                        with_kwargs=True,
+                    )
+                )
+            started = time.perf_counter()
+            try:
                 output = model.generate(
                     **inputs,
-                    max_new_tokens=MAX_NEW_TOKENS,
-                    temperature=0.35 if attempt else 0.5,
-                    top_p=0.9,
-                    top_k=40,
+                    **gen_kwargs,
                     do_sample=True,
                     repetition_penalty=1.08,
                     eos_token_id=tokenizer.eos_token_id,
                     pad_token_id=tokenizer.pad_token_id,
                     num_beams=1,
-                    early_stopping=True,
                 )
-            prompt_len = inputs["input_ids"].shape[-1]
-            generated_tokens = output[0][prompt_len:]
-            raw_output = tokenizer.decode(generated_tokens, skip_special_tokens=True)
-            try:
+            finally:
+                for hook in hooks:
+                    hook.remove()
+    finished = time.perf_counter()
+    if first_forward_done:
+        timings["prefill"] = first_forward_done[0] - started
+        timings["decode"] = finished - first_forward_done[0]
+    else:
+        # Prefill and decode cannot be told apart without the hook.
+        timings["generate"] = finished - started
+    row_tokens = (output[:, prompt_len:] != tokenizer.pad_token_id).sum(dim=1).tolist()
+    new_tokens = sum(row_tokens)
+    for usage, tokens in zip(usages, row_tokens):
+        if usage is not None:
+            usage.new_tokens = tokens
+    for stage in ("tokenize", "prefill", "decode", "generate"):
+        if stage in timings:
+            _stage_seconds.observe(timings[stage], stage=stage)
+    _batch_sizes.observe(len(prompts))
+    _model_tokens.observe(int(inputs["attention_mask"].sum()), direction="in")
+    _model_tokens.observe(new_tokens, direction="out")
+    decode_seconds = timings.get("decode", timings.get("generate", 0.0))
+    if decode_seconds > 0:
+        _decode_rate.observe(new_tokens / decode_seconds)
+    if stats is not None:
+        stats.add(new_tokens, forward_lengths, prompt_len, finished - started)
+    if json_close is not None:
+        for budget, closed_at in zip(budgets, json_close.closed_at):
+            if closed_at is not None:
+                _early_stop_tokens.observe(max(0, budget - closed_at), kind=stop_on_json_close)
+    return tokenizer.batch_decode(output[:, prompt_len:], skip_special_tokens=True)
+
+
+def get_batcher() -> MicroBatcher:
+    global _batcher
+    with _batcher_lock:
+        if _batcher is None:
+            _batcher = MicroBatcher(
+                _generate_batch,
+                max_batch_size=BATCH_MAX_SIZE if SPECULATIVE_MODE == "off" else 1,
+                max_wait_ms=BATCH_MAX_WAIT_MS,
+                on_wait=lambda seconds: _stage_seconds.observe(seconds, stage="queue_wait"),
+                per_row=("max_new_tokens", "usage"),
+            )
+        return _batcher
+
+
+def _generate_llm(
+    payload: ExerciseRequest,
+    task_spec: Dict[str, Any],
+    first_output: str | None = None,
+    stats: DecodeStats | None = None,
+    trace: StageTimer | None = None,
+    first_tokens: int = 0,
+) -> Dict[str, Any]:
+    # `first_tokens`: tokens generated for `first_output`.
+    stats = stats or _new_decode_stats()
+    result = _decode_exercise(payload, task_spec, first_output, stats, trace, first_tokens)
+    if stats is not None:
+        result["meta"]["decoding"] = {"mode": SPECULATIVE_MODE, **stats.as_meta()}
+    return result
+
+
+def _max_new_tokens(budget_key: str) -> int:
+    return _token_budget.budget(budget_key) if TOKEN_BUDGET_ADAPTIVE else MAX_NEW_TOKENS
+
+
+def _learn_budget(budget_key: str, raw_output: str, new_tokens: int, budget: int) -> None:
+    # Complete objects teach the tokens it took to generate them; an object cut
+    # off mid-way says the budget was too small. Outputs without any JSON teach
+    # nothing.
+    if not TOKEN_BUDGET_ADAPTIVE:
+        return
+    candidates = scan_json_objects(raw_output)
+    if not candidates:
+        return
+    if not candidates[0].complete:
+        _token_budget.observe_truncated(budget_key, budget)
+        return
+    _token_budget.observe(budget_key, new_tokens)
+
+
+def _repair_json_output(raw_output: str, trace: StageTimer | None) -> Dict[str, Any] | None:
+    # Mechanical breakage (cut at MAX_NEW_TOKENS, trailing commas, raw newlines)
+    # is fixed here before spending another generation on it.
+    with timed(_stage_seconds, "repair", trace):
+        response = salvage_json(raw_output, EXERCISE_SCHEMA)
+    if response is None or not response.get("title"):
+        _json_repairs.inc(result="failed")
+        return None
+    _json_repairs.inc(result="repaired")
+    _model_calls_saved.inc()
+    return response
+
+
+def _decode_exercise(
+    payload: ExerciseRequest,
+    task_spec: Dict[str, Any],
+    first_output: str | None,
+    stats: DecodeStats | None,
+    trace: StageTimer | None,
+    first_tokens: int = 0,
+) -> Dict[str, Any]:
+    prompt = build_prompt(payload, task_spec)
+    batcher = get_batcher()
+    budget_key = _task_key(payload)
+    budget = _max_new_tokens(budget_key)
+    raw_output = ""
+    for attempt in range(2):
+        usage = RowUsage(first_tokens)
+        if attempt == 0 and first_output is not None:
+            raw_output = first_output
+        else:
+            _model_calls.inc(kind="retry" if attempt else "sample")
+            _budget_tokens.observe(budget)
+            raw_output = batcher.generate(
+                prompt,
+                trace,
+                **_decode_kwargs(_adapter_name(payload), stats),
+                usage=usage,
+                schema_constrained=JSON_CONSTRAINED_DECODING,
+                stop_on_json_close=("retry" if attempt else "sample") if JSON_EARLY_STOP else "",
+                max_new_tokens=budget,
+                temperature=0.35 if attempt else 0.5,
+                top_p=0.9,
+                top_k=40,
+            )
+        _learn_budget(budget_key, raw_output, usage.new_tokens, budget)
+        source = "json"
+        try:
+            with timed(_stage_seconds, "parse", trace):
                 response = parse_json_response(raw_output)
-                defaults = build_fallback_exercise(payload, {}, task_spec)
-                response = _merge_missing(response, defaults)
-                return {"exercise": response, "meta": {"fallback": False, "source": "json"}}
-            except ValueError:
+        except ValueError:
+            response = _repair_json_output(raw_output, trace)
+            if response is None:
                 continue
-
-        # Attempt a JSON fix pass with the model
-        for _ in range(MAX_JSON_FIX_ATTEMPTS):
-            fixed_output = _fix_json_with_model(tokenizer, model, raw_output)
-            try:
+            source = "json_repair"
+        response = _merge_missing(response, render_exercise(payload, task_spec))
+        return {"exercise": response, "meta": {"fallback": False, "source": source}}
+
+    # Attempt a JSON fix pass with the model
+    for _ in range(MAX_JSON_FIX_ATTEMPTS):
+        _model_calls.inc(kind="fix")
+        with timed(_stage_seconds, "fix", trace):
+            fixed_output = _fix_json_with_model(
+                raw_output, stats=stats, adapter=_adapter_name(payload), trace=trace
+            )
+        try:
+            with timed(_stage_seconds, "parse", trace):
                 response = parse_json_response(fixed_output)
-                defaults = build_fallback_exercise(payload, {}, task_spec)
-                response = _merge_missing(response, defaults)
-                return {
-                    "exercise": response,
-                    "meta": {"fallback": False, "source": "json_fix"},
-                }
-            except ValueError:
-                continue
-
-        parsed_kv = parse_key_value_response(raw_output)
-        if parsed_kv:
-            coerced = build_fallback_exercise(payload, parsed_kv, task_spec)
+            defaults = render_exercise(payload, task_spec)
+            response = _merge_missing(response, defaults)
             return {
-                "exercise": coerced,
+                "exercise": response,
                 "meta": {"fallback": False, "source": "json_fix"},
             }
+        except ValueError:
+            continue
+
+    parsed_kv = parse_key_value_response(raw_output)
+    if parsed_kv:
+        coerced = build_fallback_exercise(payload, parsed_kv, task_spec)
+        return {
+            "exercise": coerced,
+            "meta": {"fallback": False, "source": "json_fix"},
+        }
+
+    fallback = render_exercise(payload, task_spec)
+    return {"exercise": fallback, "meta": {"fallback": True, "source": "template_fallback"}}
+
+
+def _stream_llm(
+    payload: ExerciseRequest,
+    task_spec: Dict[str, Any],
+    emit: Callable[[str, Dict[str, Any]], None],
+    trace: StageTimer,
+) -> None:
+    tokenizer, _ = load_pipeline()
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    stats = _new_decode_stats()
+    usage = RowUsage()
+    budget = _max_new_tokens(_task_key(payload))
+    _model_calls.inc(kind="sample")
+    _budget_tokens.observe(budget)
+    job = get_batcher().submit(
+        build_prompt(payload, task_spec),
+        trace,
+        **_decode_kwargs(_adapter_name(payload), stats),
+        usage=usage,
+        streamer=streamer,
+        schema_constrained=JSON_CONSTRAINED_DECODING,
+        stop_on_json_close="stream" if JSON_EARLY_STOP else "",
+        max_new_tokens=budget,
+        temperature=0.5,
+        top_p=0.9,
+        top_k=40,
+    )
+    # Unblock the streamer loop below if generation fails before it finishes.
+    job.add_done_callback(lambda done: done.exception() is not None and streamer.end())
+    parser = IncrementalJSONParser()
+    chunks: List[str] = []
+    for chunk in streamer:
+        if not chunk:
+            continue
+        chunks.append(chunk)
+        emit("token", {"text": chunk})
+        for key, value in parser.feed(chunk):
+            emit("field", {"key": key, "value": value})
+    job.result()
+    result = _generate_llm(
+        payload, task_spec, first_output="".join(chunks), stats=stats, trace=trace, first_tokens=usage.new_tokens
+    )
+    _store_response(payload, task_spec, result)
+    emit("done", _finish_response(payload, result, trace, "stream"))
+
+
+def _finish_response(
+    payload: ExerciseRequest, result: Dict[str, Any], trace: StageTimer, endpoint: str
+) -> Dict[str, Any]:
+    # Called after _store_response so timings never end up in the response cache.
+    meta = result["meta"]
+    _responses.inc(endpoint=endpoint, source=meta["source"], cached=str(bool(meta.get("cached"))).lower())
+    total = time.perf_counter() - trace.started
+    _stage_seconds.observe(total, stage="total")
+    if payload.includeTimings:
+        trace.add("total", total)
+        meta["timings"] = trace.as_meta()
+    return result
+
+
+def _check_adapter(payload: ExerciseRequest) -> None:
+    if GENERATION_MODE != "template" and not _adapters.known(_adapter_name(payload)):
+        raise HTTPException(status_code=404, detail=f"Adaptador no encontrado: {_adapter_name(payload)}")
+
+
+def _require_admin(token: str | None) -> None:
+    if not ADMIN_TOKEN or not hmac.compare_digest(token or "", ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="No autorizado.")
+
+
+def _model_warming() -> bool:
+    # "idle" means warm-up is disabled and the model loads lazily as before.
+    return GENERATION_MODE != "template" and _readiness.status in ("loading", "warming", "error")
+
+
+def _not_ready_response(payload: ExerciseRequest, task_spec: Dict[str, Any]) -> Dict[str, Any]:
+    if NOT_READY_POLICY == "503":
+        raise HTTPException(
+            status_code=503,
+            detail="Modelo cargando. Intenta de nuevo en unos segundos.",
+            headers={"Retry-After": str(INFERENCE_RETRY_AFTER)},
+        )
+    exercise = render_exercise(payload, task_spec)
+    return {"exercise": exercise, "meta": {"fallback": True, "source": "template_warmup"}}
+
+
+def _sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _queue_full_error() -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail="Servidor ocupado: cola de inferencia llena. Intenta de nuevo.",
+        headers={"Retry-After": str(INFERENCE_RETRY_AFTER)},
+    )
+
+
+@app.get("/health")
+def health():
+    return {
+        "ok": True,
+        "queue": _inference_pool.stats(),
+        "prefixCache": _prefix_cache.stats(),
+        "responseCache": _response_cache.stats() if _response_cache is not None else None,
+        "adapters": _adapters.stats(),
+        "tokenBudget": _token_budget.stats(),
+        "taskBank": {**_task_bank.stats(), "tasks": len(_task_bank.snapshot.index)},
+    }
+
+
+@app.get("/ready")
+def ready():
+    state = _readiness.snapshot()
+    body = {"ready": _readiness.ready, "mode": GENERATION_MODE, "backend": _inference_backend(), **state}
+    return JSONResponse(body, status_code=200 if _readiness.ready else 503)
+
+
+@app.get("/admin/adapters")
+def list_adapters(x_admin_token: str | None = Header(None)):
+    _require_admin(x_admin_token)
+    return _adapters.stats()
+
+
+@app.post("/admin/adapters")
+def load_adapter(body: AdapterLoadRequest, x_admin_token: str | None = Header(None)):
+    _require_admin(x_admin_token)
+    if GENERATION_MODE == "template":
+        raise HTTPException(status_code=409, detail="GENERATION_MODE=template no usa adaptadores.")
+    load_pipeline()
+    try:
+        _adapters.load(body.name, body.path)
+    except AdapterError as err:
+        raise HTTPException(status_code=409, detail=str(err)) from err
+    _prefix_cache.clear()
+    return _adapters.stats()
 
-        fallback = build_fallback_exercise(payload, {}, task_spec)
-        return {"exercise": fallback, "meta": {"fallback": True, "source": "template_fallback"}}
+
+@app.delete("/admin/adapters/{name}")
+def unload_adapter(name: str, x_admin_token: str | None = Header(None)):
+    _require_admin(x_admin_token)
+    try:
+        _adapters.unload(name)
+    except UnknownAdapterError as err:
+        raise HTTPException(status_code=404, detail=str(err)) from err
+    except AdapterError as err:
+        raise HTTPException(status_code=409, detail=str(err)) from err
+    _prefix_cache.clear()
+    return _adapters.stats()
+
+
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(_metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.post("/generate")
+async def generate(payload: ExerciseRequest):
+    _check_adapter(payload)
+    trace = StageTimer()
+    try:
+        with timed(_stage_seconds, "pick_task", trace):
+            task_spec = await _off_loop(_task_history.blocking, _pick_task, payload)
+        with timed(_stage_seconds, "cache_lookup", trace):
+            cached = await _off_loop(_cache_blocking(), _cached_response, payload, task_spec)
+        # Returned as a response object so FastAPI skips jsonable_encoder.
+        if cached is not None:
+            return FastJSONResponse(_finish_response(payload, cached, trace, "generate"))
+        if _model_warming():
+            result = _not_ready_response(payload, task_spec)
+            return FastJSONResponse(_finish_response(payload, result, trace, "generate"))
+        if GENERATION_MODE == "template":
+            with timed(_stage_seconds, "template", trace):
+                exercise = render_exercise(payload, task_spec)
+            result = {"exercise": exercise, "meta": {"fallback": False, "source": "template"}}
+        else:
+            result = await _inference_pool.run(_generate_llm, payload, task_spec, None, None, trace)
+        await _off_loop(_cache_blocking(), _store_response, payload, task_spec, result)
+        return FastJSONResponse(_finish_response(payload, result, trace, "generate"))
+    except QueueFullError as err:
+        raise _queue_full_error() from err
+    except UnknownAdapterError as err:
+        raise HTTPException(status_code=404, detail=str(err)) from err
+    except HTTPException:
+        raise
     except Exception as err:
         if "out of memory" in str(err).lower():
             if torch.cuda.is_available():
@@ -668,3 +1509,51 @@ def generate(payload: ExerciseRequest):
                 detail="GPU sin memoria. Baja MAX_NEW_TOKENS o usa un modelo mas pequeno.",
             ) from err
         raise HTTPException(status_code=500, detail=str(err)) from err
+
+
+@app.post("/generate/stream")
+async def generate_stream(payload: ExerciseRequest):
+    _check_adapter(payload)
+    trace = StageTimer()
+    with timed(_stage_seconds, "pick_task", trace):
+        task_spec = await _off_loop(_task_history.blocking, _pick_task, payload)
+    loop = asyncio.get_running_loop()
+    events: asyncio.Queue = asyncio.Queue()
+
+    def emit(event: str | None, data: Any) -> None:
+        loop.call_soon_threadsafe(events.put_nowait, (event, data))
+
+    with timed(_stage_seconds, "cache_lookup", trace):
+        result = await _off_loop(_cache_blocking(), _cached_response, payload, task_spec)
+    if result is None and _model_warming():
+        result = _not_ready_response(payload, task_spec)
+    if result is None and GENERATION_MODE == "template":
+        exercise = render_exercise(payload, task_spec)
+        result = {"exercise": exercise, "meta": {"fallback": False, "source": "template"}}
+        await _off_loop(_cache_blocking(), _store_response, payload, task_spec, result)
+    if result is not None:
+        for key, value in result["exercise"].items():
+            emit("field", {"key": key, "value": value})
+        emit("done", _finish_response(payload, result, trace, "stream"))
+        emit(None, None)
+    else:
+        try:
+            job = _inference_pool.submit(_stream_llm, payload, task_spec, emit, trace)
+        except QueueFullError as err:
+            raise _queue_full_error() from err
+        job.add_done_callback(lambda done: emit(None, done.exception()))
+
+    async def event_stream():
+        while True:
+            event, data = await events.get()
+            if event is None:
+                if data is not None:
+                    yield _sse("error", {"detail": str(data)})
+                break
+            yield _sse(event, data)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,104 @@
+import os
+from typing import Any
+
+import torch
+from peft import PeftModel
+from transformers import AutoModelForCausalLM, BitsAndBytesConfig
+
+# cuda-4bit: the original GPU path (bitsandbytes nf4 + LoRA adapter on top).
+# cpu-*:     LoRA merged into the base weights, no bitsandbytes/CUDA needed.
+# onnx:      merged model exported once with optimum and run by onnxruntime.
+BACKENDS = ("cuda-4bit", "cpu-fp32", "cpu-bf16", "cpu-int8", "onnx")
+
+
+def configure_cpu_threads(threads: int, interop_threads: int) -> None:
+    if threads > 0:
+        torch.set_num_threads(threads)
+    if interop_threads > 0:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            # Only allowed before the first parallel op; keep the current value.
+            pass
+
+
+def supports_prefix_cache(backend: str) -> bool:
+    # ORT models do not accept a prebuilt transformers Cache as past_key_values.
+    return backend != "onnx"
+
+
+def _merged_model(base_model: str, lora_path: str, dtype: torch.dtype, merge: bool = True):
+    model = AutoModelForCausalLM.from_pretrained(
+        base_model,
+        torch_dtype=dtype,
+        low_cpu_mem_usage=True,
+        trust_remote_code=True,
+    )
+    model = PeftModel.from_pretrained(model, lora_path)
+    # Unmerged keeps the PeftModel so more adapters can be loaded next to it.
+    return model.merge_and_unload() if merge else model
+
+
+def _load_onnx(base_model: str, lora_path: str, export_dir: str):
+    try:
+        from optimum.onnxruntime import ORTModelForCausalLM
+    except ImportError as err:
+        raise RuntimeError("INFERENCE_BACKEND=onnx requiere `pip install optimum[onnxruntime]`") from err
+
+    if os.path.isfile(os.path.join(export_dir, "model.onnx")):
+        return ORTModelForCausalLM.from_pretrained(export_dir, use_cache=True)
+    merged_dir = os.path.join(export_dir, "merged")
+    _merged_model(base_model, lora_path, torch.float32).save_pretrained(merged_dir)
+    model = ORTModelForCausalLM.from_pretrained(merged_dir, export=True, use_cache=True)
+    model.save_pretrained(export_dir)
+    return model
+
+
+def load_model(backend: str, base_model: str, lora_path: str, onnx_dir: str, merge_lora: bool = True) -> Any:
+    if backend == "cuda-4bit":
+        bnb_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.float16,
+            bnb_4bit_use_double_quant=True,
+        )
+        model = AutoModelForCausalLM.from_pretrained(
+            base_model,
+            device_map="auto",
+            quantization_config=bnb_config,
+            torch_dtype=torch.float16,
+            trust_remote_code=True,
+        )
+        model = PeftModel.from_pretrained(model, lora_path)
+    elif backend == "cpu-fp32":
+        model = _merged_model(base_model, lora_path, torch.float32, merge_lora)
+    elif backend == "cpu-bf16":
+        model = _merged_model(base_model, lora_path, torch.bfloat16, merge_lora)
+    elif backend == "cpu-int8":
+        # Dynamic int8 only covers nn.Linear; it needs fp32 weights to start from.
+        model = torch.ao.quantization.quantize_dynamic(
+            _merged_model(base_model, lora_path, torch.float32), {torch.nn.Linear}, dtype=torch.qint8
+        )
+    elif backend == "onnx":
+        return _load_onnx(base_model, lora_path, onnx_dir)
+    else:
+        raise ValueError(f"Unknown INFERENCE_BACKEND: {backend}")
+    model.eval()
+    return model
+
+
+def load_draft_model(backend: str, draft_model: str) -> Any:
+    # The drafter must share the tokenizer of BASE_MODEL (e.g. Qwen3-0.6B for Qwen3-4B).
+    if backend == "onnx":
+        raise ValueError("SPECULATIVE_MODE=draft is not supported with INFERENCE_BACKEND=onnx")
+    if backend == "cuda-4bit":
+        model = AutoModelForCausalLM.from_pretrained(
+            draft_model, device_map="auto", torch_dtype=torch.float16, trust_remote_code=True
+        )
+    else:
+        dtype = torch.bfloat16 if backend == "cpu-bf16" else torch.float32
+        model = AutoModelForCausalLM.from_pretrained(
+            draft_model, torch_dtype=dtype, low_cpu_mem_usage=True, trust_remote_code=True
+        )
+    model.eval()
+    return model
@@ -1,11 +1,18 @@
 import argparse
+import bisect
 import json
-from typing import Any, Dict, List
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List
 
 from datasets import load_dataset
 
+from dedup_dataset import add_dedup_args, deduper_from_args, write_report
+
 
 DEFAULT_SYSTEM = "You are a helpful Jupyter Notebook assistant."
+MAP_BATCH_SIZE = 1000
 
 
 def normalize_messages(sample: Dict[str, Any]) -> List[Dict[str, str]]:
@@ -31,12 +38,18 @@ def normalize_messages(sample: Dict[str, Any]) -> List[Dict[str, str]]:
     ]
 
 
-def passes_package_filter(sample: Dict[str, Any], include_packages: List[str]) -> bool:
+def package_mask(packages_column: List[Any], include_packages: List[str]) -> List[bool]:
     if not include_packages:
-        return True
-    packages = sample.get("packages_used") or []
-    packages_lower = {str(pkg).lower() for pkg in packages}
-    return any(pkg in packages_lower for pkg in include_packages)
+        return [True] * len(packages_column)
+    wanted = frozenset(include_packages)
+    return [
+        not wanted.isdisjoint(str(pkg).lower() for pkg in (packages or []))
+        for packages in packages_column
+    ]
+
+
+def passes_package_filter(sample: Dict[str, Any], include_packages: List[str]) -> bool:
+    return package_mask([sample.get("packages_used")], include_packages)[0]
 
 
 def build_training_row(messages: List[Dict[str, str]], system_prompt: str) -> Dict[str, Any]:
@@ -49,13 +62,125 @@ def build_training_row(messages: List[Dict[str, str]], system_prompt: str) -> Di
     return {"messages": messages}
 
 
+def convert_batch(
+    batch: Dict[str, List[Any]],
+    indices: List[int],
+    include_packages: List[str],
+    system_prompt: str,
+    offset: int = 0,
+) -> Dict[str, List[Any]]:
+    # Filter + normalize + serialize in the map workers; the writer only joins
+    # ready-made JSON lines. `source_index` lets a checkpoint point back into
+    # the input.
+    size = len(indices)
+    keep = package_mask(batch.get("packages_used", [None] * size), include_packages)
+    columns = list(batch)
+    lines: List[str] = []
+    source_index: List[int] = []
+    for i in range(size):
+        if not keep[i]:
+            continue
+        row = build_training_row(normalize_messages({key: batch[key][i] for key in columns}), system_prompt)
+        if row:
+            lines.append(json.dumps(row, ensure_ascii=False))
+            source_index.append(offset + indices[i])
+    return {"line": lines, "source_index": source_index}
+
+
+def shard_path(output: str, shard: int, shard_size: int) -> Path:
+    if shard_size <= 0:
+        return Path(output)
+    path = Path(output)
+    return path.with_name(f"{path.stem}-{shard:05d}{path.suffix}")
+
+
+def load_checkpoint(path: Path) -> Dict[str, Any]:
+    if path.exists():
+        with path.open(encoding="utf-8") as f:
+            return json.load(f)
+    return {"consumed": 0, "kept": 0, "shards": []}
+
+
+# Writes `{stem}-00000.jsonl`, `{stem}-00001.jsonl`, ... of `shard_size` rows
+# (or one file when 0). Each shard is written to a .tmp file and renamed when
+# full; only then the checkpoint moves forward, so a crash loses at most the
+# shard in progress.
+class ShardWriter:
+    def __init__(self, output: str, shard_size: int, checkpoint_path: Path, checkpoint: Dict[str, Any]):
+        self.output = output
+        self.shard_size = shard_size
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint = checkpoint
+        self.pending: List[str] = []
+        self.pending_consumed = checkpoint["consumed"]
+        self.handle = None
+        self.rows_in_shard = 0
+
+    @property
+    def kept(self) -> int:
+        return self.checkpoint["kept"] + self.rows_in_shard + len(self.pending)
+
+    def write(self, lines: List[str], source_index: List[int]) -> None:
+        for line, index in zip(lines, source_index):
+            self.pending.append(line)
+            self.pending_consumed = index + 1
+            if self.shard_size > 0 and self.rows_in_shard + len(self.pending) >= self.shard_size:
+                self._flush()
+                self._finish_shard()
+        if len(self.pending) >= MAP_BATCH_SIZE:
+            self._flush()
+
+    def _flush(self) -> None:
+        if not self.pending:
+            return
+        if self.handle is None:
+            path = shard_path(self.output, len(self.checkpoint["shards"]), self.shard_size)
+            self.handle = open(f"{path}.tmp", "w", encoding="utf-8")
+        self.handle.write("\n".join(self.pending) + "\n")
+        self.rows_in_shard += len(self.pending)
+        self.pending = []
+
+    def _finish_shard(self) -> None:
+        if self.handle is None:
+            return
+        path = shard_path(self.output, len(self.checkpoint["shards"]), self.shard_size)
+        self.handle.close()
+        self.handle = None
+        os.replace(f"{path}.tmp", path)
+        self.checkpoint["shards"].append({"path": str(path), "rows": self.rows_in_shard})
+        self.checkpoint["kept"] += self.rows_in_shard
+        self.checkpoint["consumed"] = self.pending_consumed
+        self.rows_in_shard = 0
+        if self.shard_size <= 0:
+            return
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.checkpoint, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def close(self) -> None:
+        self._flush()
+        self._finish_shard()
+
+
+def stream_batches(source: Any, offset: int, fn_kwargs: Dict[str, Any]) -> Iterable[Dict[str, List[Any]]]:
+    # Iterable datasets have no num_proc (and often no column names to drop
+    # for a row-count-changing map), so batches are converted here.
+    position = offset
+    for batch in source.iter(batch_size=MAP_BATCH_SIZE):
+        size = len(next(iter(batch.values()), []))
+        yield convert_batch(batch, list(range(size)), offset=position, **fn_kwargs)
+        position += size
+
+
 def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--dataset",
         default="jupyter-agent/jupyter-agent-dataset",
-        help="Hugging Face dataset path",
+        help="Hugging Face dataset path, or a builder (json, parquet) with --data-files",
     )
+    parser.add_argument("--data-files", default="", help="Local files or globs (comma-separated).")
     parser.add_argument("--split", default="non_thinking")
     parser.add_argument("--output", default="hf_jupyter_messages.jsonl")
     parser.add_argument("--max-samples", type=int, default=5000)
@@ -70,6 +195,19 @@ def main() -> None:
         action="store_true",
         help="Stream samples from HF without downloading full split first.",
     )
+    parser.add_argument("--num-proc", type=int, default=min(8, os.cpu_count() or 1))
+    parser.add_argument(
+        "--shard-size",
+        type=int,
+        default=0,
+        help="Rows per output file ({stem}-00000{suffix}, ...). 0 writes a single --output file.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="With --shard-size: continue after the last finished shard in {output}.checkpoint.json.",
+    )
+    add_dedup_args(parser)
     args = parser.parse_args()
 
     include_packages = [
@@ -77,28 +215,72 @@ def main() -> None:
         for pkg in args.include_packages.split(",")
         if pkg.strip()
     ]
+    data_files = [path.strip() for path in args.data_files.split(",") if path.strip()] or None
 
-    dataset = load_dataset(args.dataset, split=args.split, streaming=args.streaming)
-
-    kept = 0
-    with open(args.output, "w", encoding="utf-8") as f:
-        iterator = dataset if args.streaming else range(min(args.max_samples, len(dataset)))
-        for item in iterator:
-            sample = item if args.streaming else dataset[item]
-            if not passes_package_filter(sample, include_packages):
-                continue
+    checkpoint_path = Path(f"{args.output}.checkpoint.json")
+    checkpoint = load_checkpoint(checkpoint_path) if args.resume else {"consumed": 0, "kept": 0, "shards": []}
+    if checkpoint["kept"] >= args.max_samples:
+        print(f"Nothing to do: {checkpoint['kept']} rows already in {len(checkpoint['shards'])} shards")
+        return
+    deduper = deduper_from_args(args)
+    if deduper is not None:
+        # The dedup index is not checkpointed; rebuild it from the finished shards.
+        for shard in checkpoint["shards"]:
+            with open(shard["path"], "rb") as f:
+                for line in f:
+                    deduper.keep_line(line)
 
-            messages = normalize_messages(sample)
-            row = build_training_row(messages, args.system_prompt)
-            if not row:
-                continue
+    started = time.perf_counter()
+    dataset = load_dataset(args.dataset, data_files=data_files, split=args.split, streaming=args.streaming)
+    fn_kwargs = {"include_packages": include_packages, "system_prompt": args.system_prompt}
+    if args.streaming:
+        source = dataset.skip(checkpoint["consumed"]) if checkpoint["consumed"] else dataset
+        batches = stream_batches(source, checkpoint["consumed"], fn_kwargs)
+    else:
+        # Same rows as before: the first --max-samples rows of the split. The
+        # map result is cached by `datasets`, so a resumed run reuses it.
+        source = dataset.select(range(min(args.max_samples, len(dataset))))
+        processed = source.map(
+            convert_batch,
+            batched=True,
+            batch_size=MAP_BATCH_SIZE,
+            with_indices=True,
+            remove_columns=source.column_names,
+            num_proc=args.num_proc if args.num_proc > 1 else None,
+            fn_kwargs=fn_kwargs,
+        )
+        if checkpoint["consumed"]:
+            start = bisect.bisect_left(processed["source_index"], checkpoint["consumed"])
+            processed = processed.select(range(start, len(processed)))
+        batches = processed.iter(batch_size=MAP_BATCH_SIZE)
 
-            f.write(json.dumps(row, ensure_ascii=False) + "\n")
-            kept += 1
-            if kept >= args.max_samples:
-                break
+    writer = ShardWriter(args.output, args.shard_size, checkpoint_path, checkpoint)
+    resumed = checkpoint["kept"]
+    for batch in batches:
+        remaining = args.max_samples - writer.kept
+        lines, source_index = batch["line"], batch["source_index"]
+        if deduper is not None:
+            keep: List[int] = []
+            for i, line in enumerate(lines):
+                if len(keep) >= remaining:
+                    break
+                if deduper.keep_line(line):
+                    keep.append(i)
+            lines = [lines[i] for i in keep]
+            source_index = [source_index[i] for i in keep]
+        writer.write(lines[:remaining], source_index[:remaining])
+        if writer.kept >= args.max_samples:
+            break
+    writer.close()
 
-    print(f"Saved {kept} rows to {args.output}")
+    elapsed = time.perf_counter() - started
+    written = checkpoint["kept"] - resumed
+    files = ", ".join(shard["path"] for shard in checkpoint["shards"][-3:])
+    more = " ..." if len(checkpoint["shards"]) > 3 else ""
+    print(f"Saved {checkpoint['kept']} rows to {len(checkpoint['shards'])} file(s): {files}{more}")
+    print(f"{written} rows in {elapsed:.1f}s ({written / max(elapsed, 1e-9):.0f} rows/s)")
+    if deduper is not None:
+        write_report(deduper, args.dedup_report or f"{args.output}.dedup.json")
 
 
 if __name__ == "__main__":
@@ -1,8 +1,21 @@
 import argparse
 import json
+import os
 import random
+import sys
+import time
+from collections import deque
+from functools import lru_cache
+from multiprocessing import Pool
 from pathlib import Path
-from typing import Dict, List
+from typing import Deque, Dict, Iterator, List, Tuple
+
+from dedup_dataset import add_dedup_args, deduper_from_args, write_report
+
+try:
+    import orjson
+except ImportError:  # optional, input lines fall back to json.loads
+    orjson = None
 
 
 SCHEMA_KEYS = [
@@ -17,6 +30,14 @@ SCHEMA_KEYS = [
     "acceptanceCriteria",
 ]
 
+DIFFICULTIES = ["basica", "media"]
+EXERCISE_TYPES = ["completar_codigo", "corregir_errores", "explicar_resultado"]
+DATASET_SIZES = ["pequeno", "mediano"]
+CHUNK_SIZE = 2000
+
+# (difficulty, exercise_type, dataset_size) for each line of a chunk.
+Draw = Tuple[str, str, str]
+
 
 def infer_topic(text: str) -> str:
     t = text.lower()
@@ -120,12 +141,109 @@ def build_sample(topic: str, difficulty: str, exercise_type: str, dataset_size:
     }
 
 
+def loads(line: bytes) -> Dict:
+    return orjson.loads(line) if orjson is not None else json.loads(line)
+
+
+@lru_cache(maxsize=None)
+def structured_line(topic: str, difficulty: str, exercise_type: str, dataset_size: str) -> str:
+    # Only topic x difficulty x type x size (a few dozen) distinct rows exist,
+    # so each is serialized once. Kept on the stdlib encoder: orjson's compact
+    # separators would change the training text.
+    schema = build_sample(topic, difficulty, exercise_type, dataset_size)
+    structured = {
+        "messages": [
+            {
+                "role": "system",
+                "content": "Eres un generador de ejercicios de Jupyter. Devuelve solo JSON.",
+            },
+            {
+                "role": "user",
+                "content": (
+                    "Genera un ejercicio con el siguiente schema JSON EXACTO:\n"
+                    + ", ".join(SCHEMA_KEYS)
+                ),
+            },
+            {"role": "assistant", "content": json.dumps(schema, ensure_ascii=False)},
+        ]
+    }
+    return json.dumps(structured, ensure_ascii=False) + "\n"
+
+
+def convert_chunk(chunk: Tuple[List[bytes], List[Draw]]) -> str:
+    lines, draws = chunk
+    out: List[str] = []
+    for line, (difficulty, exercise_type, dataset_size) in zip(lines, draws):
+        messages = loads(line).get("messages", [])
+        user_text = " ".join(
+            m.get("content", "") for m in messages if m.get("role") == "user"
+        )
+        out.append(structured_line(infer_topic(user_text), difficulty, exercise_type, dataset_size))
+    return "".join(out)
+
+
+def read_chunks(path: Path, max_samples: int, chunk_size: int) -> Iterator[Tuple[List[bytes], List[Draw]]]:
+    # The parent draws the random fields in input order (same calls as the
+    # one-row-at-a-time loop), so the output only depends on --seed.
+    count = 0
+    with path.open("rb") as f_in:
+        while count < max_samples:
+            lines: List[bytes] = []
+            for line in f_in:
+                lines.append(line)
+                if len(lines) >= min(chunk_size, max_samples - count):
+                    break
+            if not lines:
+                return
+            draws = [
+                (
+                    random.choice(DIFFICULTIES),
+                    random.choice(EXERCISE_TYPES),
+                    random.choice(DATASET_SIZES),
+                )
+                for _ in lines
+            ]
+            count += len(lines)
+            yield lines, draws
+
+
+def convert_ordered(chunks: Iterator[Tuple[List[bytes], List[Draw]]], num_proc: int) -> Iterator[str]:
+    if num_proc <= 1:
+        yield from map(convert_chunk, chunks)
+        return
+    # apply_async with a bounded window instead of Pool.imap: imap drains the
+    # whole input into its task queue, which for multi-GB files means memory.
+    with Pool(num_proc) as pool:
+        pending: Deque = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(convert_chunk, (chunk,)))
+            if len(pending) >= 2 * num_proc:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def peak_rss_mb() -> float:
+    try:
+        import resource
+    except ImportError:  # Windows
+        return 0.0
+    # ru_maxrss is KiB on Linux and bytes on macOS; children = pool workers.
+    unit = 1 if sys.platform == "darwin" else 1024
+    parent = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(parent, children) * unit / (1024 * 1024)
+
+
 def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument("--input", default="hf_jupyter_messages.jsonl")
     parser.add_argument("--output", default="hf_jupyter_structured.jsonl")
     parser.add_argument("--max-samples", type=int, default=2000)
     parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--num-proc", type=int, default=min(8, os.cpu_count() or 1))
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="Lines per worker task.")
+    add_dedup_args(parser)
     args = parser.parse_args()
 
     random.seed(args.seed)
@@ -136,45 +254,26 @@ def main() -> None:
     if not in_path.exists():
         raise FileNotFoundError(f"Input file not found: {in_path}")
 
+    deduper = deduper_from_args(args)
+    started = time.perf_counter()
     count = 0
-    with in_path.open() as f_in, out_path.open("w") as f_out:
-        for line in f_in:
-            obj = json.loads(line)
-            messages = obj.get("messages", [])
-            user_text = " ".join(
-                m.get("content", "") for m in messages if m.get("role") == "user"
-            )
-            topic = infer_topic(user_text)
-            difficulty = random.choice(["basica", "media"])
-            exercise_type = random.choice(
-                ["completar_codigo", "corregir_errores", "explicar_resultado"]
-            )
-            dataset_size = random.choice(["pequeno", "mediano"])
-
-            schema = build_sample(topic, difficulty, exercise_type, dataset_size)
-
-            structured = {
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": "Eres un generador de ejercicios de Jupyter. Devuelve solo JSON.",
-                    },
-                    {
-                        "role": "user",
-                        "content": (
-                            "Genera un ejercicio con el siguiente schema JSON EXACTO:\n"
-                            + ", ".join(SCHEMA_KEYS)
-                        ),
-                    },
-                    {"role": "assistant", "content": json.dumps(schema, ensure_ascii=False)},
-                ]
-            }
-            f_out.write(json.dumps(structured, ensure_ascii=False) + "\n")
-            count += 1
-            if count >= args.max_samples:
-                break
+    chunks = read_chunks(in_path, args.max_samples, max(1, args.chunk_size))
+    with out_path.open("w", encoding="utf-8") as f_out:
+        for block in convert_ordered(chunks, args.num_proc):
+            if deduper is not None:
+                block = "".join(line for line in block.splitlines(keepends=True) if deduper.keep_line(line))
+            f_out.write(block)
+            count += block.count("\n")
 
+    elapsed = time.perf_counter() - started
+    rows = deduper.rows if deduper is not None else count
     print(f"Saved {count} rows to {out_path}")
+    print(
+        f"{rows} rows in {elapsed:.1f}s ({rows / max(elapsed, 1e-9):.0f} rows/s), "
+        f"peak RSS {peak_rss_mb():.0f} MB"
+    )
+    if deduper is not None:
+        write_report(deduper, args.dedup_report or f"{out_path}.dedup.json")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,431 @@
+import argparse
+import bisect
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Sequence as SequenceType, Tuple
+
+import numpy as np
+import torch
+from datasets import Dataset, Features, Sequence, Value, load_dataset, load_from_disk
+from transformers import AutoTokenizer
+
+
+# Bump when the stored columns or how they are computed change.
+CACHE_VERSION = 3
+DEFAULT_CACHE_DIR = ".tokenized_cache"
+MAP_BATCH_SIZE = 256
+# Share of rows allowed to fall back to full-chat loss before the build fails.
+DEFAULT_MAX_MASK_FALLBACK = 0.05
+CACHE_FEATURES = Features(
+    {
+        "input_ids": Sequence(Value("int32")),
+        "loss_mask": Sequence(Value("uint8")),
+        "length": Value("int32"),
+        "mask_fallback": Value("bool"),
+    }
+)
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    # Vocab, merges, normalizer and added tokens all live in the backend JSON of
+    # fast tokenizers; slow ones fall back to the vocab.
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        payload = backend.to_str()
+    else:
+        payload = json.dumps(tokenizer.get_vocab(), sort_keys=True)
+    payload += json.dumps(
+        [type(tokenizer).__name__, tokenizer.special_tokens_map], sort_keys=True, default=str
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def source_fingerprint(path: str) -> Dict[str, Any]:
+    stat = os.stat(path)
+    return {"path": str(Path(path).resolve()), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def cache_key(tokenizer, train_file: str, max_seq_length: int, assistant_only_loss: bool = True) -> Dict[str, Any]:
+    return {
+        "version": CACHE_VERSION,
+        "tokenizer": tokenizer_fingerprint(tokenizer),
+        "chat_template": hashlib.sha256(
+            json.dumps(tokenizer.chat_template, sort_keys=True).encode("utf-8")
+        ).hexdigest(),
+        "max_seq_length": max_seq_length,
+        "assistant_only_loss": assistant_only_loss,
+        "source": source_fingerprint(train_file),
+    }
+
+
+def cache_path(cache_dir: str, train_file: str, key: Dict[str, Any]) -> Path:
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    return Path(cache_dir) / f"{Path(train_file).stem}-{digest}"
+
+
+def render_chat(tokenizer, messages: List[Dict[str, Any]]) -> Tuple[str, List[Tuple[int, int]] | None]:
+    # The rendered chat plus the character span of every assistant turn: from
+    # the end of the prompt rendered with add_generation_prompt up to the end
+    # of the chat rendered through that turn, so the end-of-turn marker is
+    # learned too. None when a prefix does not render as a prefix of the full
+    # chat (templates that rewrite earlier turns); such rows keep full loss
+    # and are counted as `mask_fallback` in the cache.
+    text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=False)
+    spans: List[Tuple[int, int]] = []
+    for index, message in enumerate(messages):
+        if message.get("role") != "assistant":
+            continue
+        prompt = tokenizer.apply_chat_template(messages[:index], tokenize=False, add_generation_prompt=True)
+        through = tokenizer.apply_chat_template(messages[: index + 1], tokenize=False, add_generation_prompt=False)
+        if not (text.startswith(prompt) and text.startswith(through)):
+            return text, None
+        spans.append((len(prompt), len(through)))
+    return text, spans
+
+
+def span_mask(offsets: List[Tuple[int, int]], spans: List[Tuple[int, int]]) -> List[int]:
+    # 1 for tokens overlapping an assistant span; both lists are in text order.
+    mask: List[int] = []
+    current = 0
+    for start, end in offsets:
+        while current < len(spans) and spans[current][1] <= start:
+            current += 1
+        inside = current < len(spans) and start < spans[current][1] and end > spans[current][0]
+        mask.append(1 if inside else 0)
+    return mask
+
+
+def tokenize_batch(
+    batch: Dict[str, List[Any]],
+    tokenizer,
+    max_seq_length: int,
+    assistant_only_loss: bool = True,
+) -> Dict[str, List[Any]]:
+    # The chat template already adds the special tokens. With
+    # assistant_only_loss, system/user tokens get loss_mask 0 and rows left
+    # with no assistant token after truncation are dropped. `mask_fallback`
+    # marks rows whose spans could not be found and that train on every token.
+    rendered = [render_chat(tokenizer, messages) for messages in batch["messages"]]
+    encoded = tokenizer(
+        [text for text, _ in rendered],
+        add_special_tokens=False,
+        truncation=True,
+        max_length=max_seq_length,
+        return_attention_mask=False,
+        return_offsets_mapping=assistant_only_loss,
+    )
+    out: Dict[str, List[Any]] = {"input_ids": [], "loss_mask": [], "length": [], "mask_fallback": []}
+    for row, ids in enumerate(encoded["input_ids"]):
+        spans = rendered[row][1]
+        if assistant_only_loss and spans is not None:
+            loss_mask = span_mask(encoded["offset_mapping"][row], spans)
+            if not any(loss_mask):
+                continue
+        else:
+            loss_mask = [1] * len(ids)
+        out["input_ids"].append(ids)
+        out["loss_mask"].append(loss_mask)
+        out["length"].append(len(ids))
+        out["mask_fallback"].append(assistant_only_loss and spans is None)
+    return out
+
+
+def check_masks(tokenizer, train_file: str, max_seq_length: int, rows: int) -> int:
+    # Re-tokenizes the first `rows` chats and checks that the loss covers
+    # exactly the assistant turns: every assistant message is inside the
+    # masked text and every system/user message is inside the unmasked text
+    # (rows cut by max_seq_length are skipped). Returns the failures.
+    failures = 0
+    checked = 0
+    with open(train_file, encoding="utf-8") as f:
+        for line in f:
+            if checked >= rows:
+                break
+            messages = json.loads(line).get("messages", [])
+            batch = tokenize_batch({"messages": [messages]}, tokenizer, max_seq_length)
+            if not batch["input_ids"] or batch["length"][0] >= max_seq_length:
+                continue
+            checked += 1
+            ids = np.asarray(batch["input_ids"][0])
+            mask = np.asarray(batch["loss_mask"][0], dtype=bool)
+            learned = tokenizer.decode(ids[mask].tolist())
+            ignored = tokenizer.decode(ids[~mask].tolist())
+            for message in messages:
+                content = str(message.get("content", ""))
+                target = learned if message.get("role") == "assistant" else ignored
+                if content and content not in target:
+                    failures += 1
+                    print(f"Row {checked - 1}: {message.get('role')} turn not where expected: {content[:60]!r}")
+    print(f"Checked {checked} rows: {'OK' if not failures else f'{failures} failures'}")
+    return failures
+
+
+def load_pretokenized(path: Path, key: Dict[str, Any]) -> Dataset | None:
+    meta_path = path / "cache_meta.json"
+    if not meta_path.exists():
+        return None
+    with meta_path.open(encoding="utf-8") as f:
+        if json.load(f).get("key") != key:
+            return None
+    # Arrow files are memory-mapped: rows are read from the page cache on
+    # demand, nothing is copied into the Python heap up front.
+    return load_from_disk(str(path)).with_format("numpy")
+
+
+def report_mask_fallback(dataset: Dataset, max_ratio: float = DEFAULT_MAX_MASK_FALLBACK) -> int:
+    # Rows where the chat template did not render its prefixes consistently
+    # train on the whole chat: warn about any, fail above `max_ratio`.
+    fallback = int(np.count_nonzero(np.asarray(dataset["mask_fallback"])))
+    if not fallback:
+        return 0
+    ratio = fallback / max(len(dataset), 1)
+    message = (
+        f"{fallback}/{len(dataset)} rows ({ratio:.1%}) keep the loss on the whole chat: the chat template "
+        "does not render earlier turns as a prefix of the full chat, so the assistant spans were not found"
+    )
+    if ratio > max_ratio:
+        raise ValueError(f"{message} (above --max-mask-fallback {max_ratio:.1%})")
+    print(f"Warning: {message}")
+    return fallback
+
+
+def build_pretokenized(
+    tokenizer,
+    train_file: str,
+    max_seq_length: int,
+    path: Path,
+    key: Dict[str, Any],
+    num_proc: int | None = None,
+    max_mask_fallback: float = DEFAULT_MAX_MASK_FALLBACK,
+) -> Dataset:
+    started = time.perf_counter()
+    assistant_only_loss = key["assistant_only_loss"]
+    raw = load_dataset("json", data_files=train_file, split="train")
+    tokenized = raw.map(
+        tokenize_batch,
+        batched=True,
+        batch_size=MAP_BATCH_SIZE,
+        remove_columns=raw.column_names,
+        features=CACHE_FEATURES,
+        num_proc=num_proc if num_proc and num_proc > 1 else None,
+        fn_kwargs={
+            "tokenizer": tokenizer,
+            "max_seq_length": max_seq_length,
+            "assistant_only_loss": assistant_only_loss,
+        },
+        desc="Tokenizing",
+    )
+    lengths = np.asarray(tokenized["length"], dtype=np.int64)
+    loss_tokens = sum(int(mask.sum()) for mask in tokenized.with_format("numpy")["loss_mask"])
+    stats = {
+        "rows": len(tokenized),
+        "dropped_rows": len(raw) - len(tokenized),
+        "tokens": int(lengths.sum()),
+        "loss_tokens": loss_tokens,
+        "truncated_rows": int((lengths >= max_seq_length).sum()),
+        "mask_fallback_rows": int(np.count_nonzero(np.asarray(tokenized["mask_fallback"]))),
+        "seconds": round(time.perf_counter() - started, 1),
+    }
+
+    # Written next to the final directory and renamed, so an interrupted run
+    # never leaves a half-written cache that matches the key.
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tokenized.save_to_disk(str(tmp_path))
+    with (tmp_path / "cache_meta.json").open("w", encoding="utf-8") as f:
+        json.dump({"key": key, "stats": stats}, f, indent=2)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    print(
+        f"Tokenized {stats['rows']} rows ({stats['tokens']} tokens, {stats['loss_tokens']} with loss, "
+        f"{stats['truncated_rows']} truncated, {stats['dropped_rows']} dropped) in {stats['seconds']}s -> {path}"
+    )
+    dataset = load_pretokenized(path, key)
+    report_mask_fallback(dataset, max_mask_fallback)
+    return dataset
+
+
+def get_pretokenized(
+    tokenizer,
+    train_file: str,
+    max_seq_length: int,
+    cache_dir: str = DEFAULT_CACHE_DIR,
+    num_proc: int | None = None,
+    assistant_only_loss: bool = True,
+    max_mask_fallback: float = DEFAULT_MAX_MASK_FALLBACK,
+) -> Dataset:
+    key = cache_key(tokenizer, train_file, max_seq_length, assistant_only_loss)
+    path = cache_path(cache_dir, train_file, key)
+    dataset = load_pretokenized(path, key)
+    if dataset is not None:
+        print(f"Using pretokenized cache {path} ({len(dataset)} rows)")
+        report_mask_fallback(dataset, max_mask_fallback)
+        return dataset
+    return build_pretokenized(tokenizer, train_file, max_seq_length, path, key, num_proc, max_mask_fallback)
+
+
+def pack_sequences(lengths: SequenceType[int], max_seq_length: int) -> List[List[int]]:
+    # Best-fit decreasing: longest rows first, each into the pack with the
+    # least room that still fits it. `free` is sorted (room left, pack id).
+    order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+    packs: List[List[int]] = []
+    free: List[Tuple[int, int]] = []
+    for index in order:
+        length = lengths[index]
+        slot = bisect.bisect_left(free, (length, -1))
+        if slot < len(free):
+            room, pack_id = free.pop(slot)
+            packs[pack_id].append(index)
+        else:
+            room, pack_id = max_seq_length, len(packs)
+            packs.append([index])
+        if room - length > 0:
+            bisect.insort(free, (room - length, pack_id))
+    return packs
+
+
+# Rows of the cache concatenated into windows of up to `max_seq_length`
+# tokens, as a small table of (row indices, length) whose transform reads the
+# rows from the memory-mapped cache on access. `position_ids` restart at 0 for
+# every row; with no attention_mask and no KV cache (training sets
+# use_cache=False), transformers >= 4.53 (and flash-attention's varlen path)
+# turns that into a block-diagonal causal mask, so rows never attend to each
+# other.
+def pack_dataset(dataset: Dataset, max_seq_length: int) -> Dataset:
+    lengths = np.asarray(dataset["length"])
+    packs = pack_sequences(lengths.tolist(), max_seq_length)
+    packed = Dataset.from_dict({"pack": packs, "length": [int(lengths[pack].sum()) for pack in packs]})
+
+    def concat(batch: Dict[str, List[Any]]) -> Dict[str, List[Any]]:
+        if "pack" not in batch:  # column reads such as packed["length"]
+            return batch
+        out: Dict[str, List[Any]] = {key: value for key, value in batch.items() if key != "pack"}
+        out.update(input_ids=[], loss_mask=[], position_ids=[])
+        for pack in batch["pack"]:
+            rows = dataset[list(pack)]
+            out["input_ids"].append(np.concatenate(rows["input_ids"]))
+            out["loss_mask"].append(np.concatenate(rows["loss_mask"]))
+            out["position_ids"].append(np.concatenate([np.arange(len(ids)) for ids in rows["input_ids"]]))
+        return out
+
+    return packed.with_transform(concat)
+
+
+def supports_packed_position_ids() -> bool:
+    try:
+        from transformers.masking_utils import find_packed_sequence_indices  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def padding_ratio(lengths: SequenceType[int], batch_size: int, group_by_length: bool = False, seed: int = 42) -> float:
+    # Share of padded slots when batches are padded to their longest row:
+    # random batches, or sorted inside megabatches of 50 batches the way
+    # LengthGroupedSampler does.
+    lengths = np.asarray(lengths)
+    if len(lengths) == 0:
+        return 0.0
+    order = np.random.default_rng(seed).permutation(len(lengths))
+    if group_by_length:
+        megabatch = 50 * batch_size
+        order = np.concatenate(
+            [
+                chunk[np.argsort(-lengths[chunk], kind="stable")]
+                for chunk in np.array_split(order, range(megabatch, len(order), megabatch))
+            ]
+        )
+    slots = 0
+    for start in range(0, len(order), batch_size):
+        batch = lengths[order[start:start + batch_size]]
+        slots += int(batch.max()) * len(batch)
+    return 1.0 - float(lengths.sum()) / slots
+
+
+# Pads `input_ids` from the cache; tokens with loss_mask 0 and padding get
+# label -100. Packed rows also carry `position_ids` (padding continues the
+# last row's positions) and get no attention_mask; the first token of each
+# packed row gets no label, so no row is predicted from the one before it.
+# `tokens`/`slots` count real vs padded-to positions for throughput logs.
+class PretokenizedCollator:
+    def __init__(self, pad_token_id: int):
+        self.pad_token_id = pad_token_id
+        self.tokens = 0
+        self.slots = 0
+
+    def __call__(self, examples: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
+        width = max(len(example["input_ids"]) for example in examples)
+        packed = "position_ids" in examples[0]
+        input_ids = torch.full((len(examples), width), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((len(examples), width), -100, dtype=torch.long)
+        attention_mask = torch.zeros((len(examples), width), dtype=torch.long)
+        position_ids = torch.zeros((len(examples), width), dtype=torch.long)
+        for row, example in enumerate(examples):
+            ids = torch.as_tensor(np.asarray(example["input_ids"], dtype=np.int64))
+            mask = torch.as_tensor(np.asarray(example["loss_mask"], dtype=bool))
+            length = len(ids)
+            input_ids[row, :length] = ids
+            labels[row, :length] = ids.masked_fill(~mask, -100)
+            attention_mask[row, :length] = 1
+            if packed:
+                positions = torch.as_tensor(np.asarray(example["position_ids"], dtype=np.int64))
+                position_ids[row, :length] = positions
+                position_ids[row, length:] = torch.arange(width - length) + int(positions[-1]) + 1
+                labels[row, :length][positions == 0] = -100
+            self.tokens += length
+        self.slots += len(examples) * width
+        if packed:
+            return {"input_ids": input_ids, "labels": labels, "position_ids": position_ids}
+        return {"input_ids": input_ids, "labels": labels, "attention_mask": attention_mask}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-name", default="Qwen/Qwen3-4B-Instruct-2507")
+    parser.add_argument("--train-file", default="hf_jupyter_messages.jsonl")
+    parser.add_argument("--max-seq-length", type=int, default=256)
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--num-proc", type=int, default=min(8, os.cpu_count() or 1))
+    parser.add_argument("--force", action="store_true", help="Rebuild even if the cache key matches.")
+    parser.add_argument(
+        "--assistant-only-loss",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Compute the loss only on assistant turns (system/user tokens are masked).",
+    )
+    parser.add_argument(
+        "--max-mask-fallback",
+        type=float,
+        default=DEFAULT_MAX_MASK_FALLBACK,
+        help="Fail if more than this share of rows cannot be masked and would train on the whole chat.",
+    )
+    parser.add_argument(
+        "--check-masks",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Check the assistant masks of the first N rows and exit (non-zero on failure).",
+    )
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name, use_fast=True)
+    if args.check_masks:
+        raise SystemExit(1 if check_masks(tokenizer, args.train_file, args.max_seq_length, args.check_masks) else 0)
+    key = cache_key(tokenizer, args.train_file, args.max_seq_length, args.assistant_only_loss)
+    path = cache_path(args.cache_dir, args.train_file, key)
+    dataset = None if args.force else load_pretokenized(path, key)
+    if dataset is not None:
+        print(f"Cache is up to date: {path}")
+        report_mask_fallback(dataset, args.max_mask_fallback)
+        return
+    build_pretokenized(
+        tokenizer, args.train_file, args.max_seq_length, path, key, args.num_proc, args.max_mask_fallback
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+import json
+from typing import Any, Dict, List, Tuple
+
+import torch
+from transformers import LogitsProcessor, StoppingCriteria
+
+MAX_WHITESPACE_RUN = 16
+_WHITESPACE = " \t\n\r"
+_ESCAPES = '"\\/bfnrt'
+_HEX = "0123456789abcdefABCDEF"
+
+
+def schema_from_example(example: str) -> Any:
+    # JSON_SCHEMA is itself valid JSON: "..." marks a string, ["x"] an array of x
+    # and {...} an object whose keys must appear exactly once, in that order.
+    def convert(node: Any) -> Any:
+        if isinstance(node, dict):
+            return ("object", [(key, convert(value)) for key, value in node.items()])
+        if isinstance(node, list):
+            return ("array", convert(node[0]) if node else "string")
+        return "string"
+
+    return convert(json.loads(example))
+
+
+# Character-level pushdown automaton accepting only JSON that matches a schema
+# built by `schema_from_example`. Frames are small lists so copies stay cheap:
+#   ["obj", members, index, phase, literal_pos]
+#   ["arr", item_spec, phase]
+#   ["str", escape_state]   (0 normal, 1 after backslash, 2..5 hex digits left + 1)
+class SchemaJSONState:
+    __slots__ = ("schema", "stack", "started", "done", "ws_run")
+
+    def __init__(self, schema: Any):
+        self.schema = schema
+        self.stack: List[List[Any]] = []
+        self.started = False
+        self.done = False
+        self.ws_run = 0
+
+    def copy(self) -> "SchemaJSONState":
+        clone = SchemaJSONState.__new__(SchemaJSONState)
+        clone.schema = self.schema
+        clone.stack = [frame[:] for frame in self.stack]
+        clone.started = self.started
+        clone.done = self.done
+        clone.ws_run = self.ws_run
+        return clone
+
+    def feed_text(self, text: str) -> bool:
+        return all(self.feed(ch) for ch in text)
+
+    def feed(self, ch: str) -> bool:
+        if self.done:
+            return False
+        if self.stack and self.stack[-1][0] == "str":
+            return self._feed_string(ch)
+        if ch in _WHITESPACE:
+            if self.ws_run >= MAX_WHITESPACE_RUN or not self._whitespace_allowed():
+                return False
+            self.ws_run += 1
+            return True
+        self.ws_run = 0
+        if not self.started:
+            if ch != "{" or self.schema[0] != "object":
+                return False
+            self.started = True
+            self._push(self.schema)
+            return True
+        frame = self.stack[-1]
+        if frame[0] == "obj":
+            return self._feed_object(frame, ch)
+        return self._feed_array(frame, ch)
+
+    def _whitespace_allowed(self) -> bool:
+        if not self.stack:
+            return not self.started
+        frame = self.stack[-1]
+        return not (frame[0] == "obj" and frame[3] == "key")
+
+    def _push(self, spec: Any) -> None:
+        if spec == "string":
+            self.stack.append(["str", 0])
+        elif spec[0] == "array":
+            self.stack.append(["arr", spec[1], "first"])
+        else:
+            self.stack.append(["obj", spec[1], 0, "key_start", 0])
+
+    def _pop(self) -> None:
+        self.stack.pop()
+        if not self.stack:
+            self.done = True
+
+    def _start_value(self, spec: Any, ch: str) -> bool:
+        opener = '"' if spec == "string" else ("[" if spec[0] == "array" else "{")
+        if ch != opener:
+            return False
+        self._push(spec)
+        return True
+
+    def _feed_string(self, ch: str) -> bool:
+        frame = self.stack[-1]
+        escape = frame[1]
+        if escape == 0:
+            if ch == '"':
+                self._pop()
+            elif ch == "\\":
+                frame[1] = 1
+            elif ord(ch) < 0x20:
+                return False
+            return True
+        if escape == 1:
+            if ch == "u":
+                frame[1] = 5
+                return True
+            if ch in _ESCAPES:
+                frame[1] = 0
+                return True
+            return False
+        if ch not in _HEX:
+            return False
+        frame[1] = 0 if escape == 2 else escape - 1
+        return True
+
+    def _feed_object(self, frame: List[Any], ch: str) -> bool:
+        members, index, phase = frame[1], frame[2], frame[3]
+        if phase in ("key_start", "key"):
+            literal = f'"{members[index][0]}"'
+            pos = frame[4] if phase == "key" else 0
+            if ch != literal[pos]:
+                return False
+            pos += 1
+            frame[3], frame[4] = ("colon", 0) if pos == len(literal) else ("key", pos)
+            return True
+        if phase == "colon":
+            if ch != ":":
+                return False
+            frame[3] = "value"
+            return True
+        if phase == "value":
+            frame[3] = "after_value"
+            if self._start_value(members[index][1], ch):
+                return True
+            frame[3] = "value"
+            return False
+        if ch == "," and index + 1 < len(members):
+            frame[2], frame[3] = index + 1, "key_start"
+            return True
+        if ch == "}" and index + 1 == len(members):
+            self._pop()
+            return True
+        return False
+
+    def _feed_array(self, frame: List[Any], ch: str) -> bool:
+        phase = frame[2]
+        if ch == "]" and phase in ("first", "after_value"):
+            self._pop()
+            return True
+        if phase == "after_value":
+            if ch != ",":
+                return False
+            frame[2] = "value"
+            return True
+        frame[2] = "after_value"
+        if self._start_value(frame[1], ch):
+            return True
+        frame[2] = phase
+        return False
+
+
+_token_tables: Dict[int, Tuple[List[str], set]] = {}
+
+
+def _token_table(tokenizer) -> Tuple[List[str], set]:
+    key = id(tokenizer)
+    if key not in _token_tables:
+        strings = tokenizer.batch_decode([[i] for i in range(len(tokenizer))], skip_special_tokens=False)
+        _token_tables[key] = (strings, set(tokenizer.all_special_ids))
+    return _token_tables[key]
+
+
+# Masks every token that would take the generated text outside the schema. Only
+# the highest scoring candidates are checked (widening when none fit), so the
+# cost per step is a few dozen automaton feeds instead of the whole vocabulary.
+class SchemaLogitsProcessor(LogitsProcessor):
+    def __init__(self, tokenizer, schema: Any, prompt_len: int, candidate_k: int = 64):
+        self.schema = schema
+        self.prompt_len = prompt_len
+        self.candidate_k = candidate_k
+        self.eos_token_id = tokenizer.eos_token_id
+        self.pad_token_id = tokenizer.pad_token_id
+        self.token_strings, self.special_ids = _token_table(tokenizer)
+        self._rows: Dict[int, Tuple[List[int], SchemaJSONState]] = {}
+
+    def _state_for(self, row: int, generated: List[int]) -> SchemaJSONState:
+        cached = self._rows.get(row)
+        if cached is not None and generated[: len(cached[0])] == cached[0]:
+            known, state = cached
+        else:
+            known, state = [], SchemaJSONState(self.schema)
+        for token_id in generated[len(known) :]:
+            state.feed_text(self._token_text(token_id) or "")
+        self._rows[row] = (generated, state)
+        return state
+
+    def _token_text(self, token_id: int) -> str | None:
+        if token_id in self.special_ids or token_id >= len(self.token_strings):
+            return None
+        return self.token_strings[token_id] or None
+
+    def _allowed(self, state: SchemaJSONState, ranked: List[int]) -> List[int]:
+        allowed = []
+        for token_id in ranked:
+            text = self._token_text(token_id)
+            if text is not None and state.copy().feed_text(text):
+                allowed.append(token_id)
+        return allowed
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        masked = torch.full_like(scores, float("-inf"))
+        vocab = scores.shape[-1]
+        for row in range(scores.shape[0]):
+            generated = input_ids[row, self.prompt_len :].tolist()
+            if self.eos_token_id in generated:
+                masked[row] = scores[row]
+                continue
+            state = self._state_for(row, generated)
+            if state.done:
+                allowed = [self.eos_token_id]
+            else:
+                checked, k = 0, min(self.candidate_k, vocab)
+                while True:
+                    ranked = torch.topk(scores[row], k).indices.tolist()
+                    allowed = self._allowed(state, ranked[checked:])
+                    if allowed or k == vocab:
+                        break
+                    checked, k = k, min(k * 2, vocab)
+                allowed = allowed or [self.eos_token_id]
+            index = torch.tensor(allowed, device=scores.device)
+            values = scores[row, index]
+            if torch.isinf(values).all():
+                values = torch.zeros_like(values)
+            masked[row, index] = values
+        return masked
+
+
+# Brace/string tracker for the first top-level object; `closed` flips on the
+# "}" that balances the first "{". Text before that "{" is ignored.
+class _ObjectCloseTracker:
+    __slots__ = ("depth", "in_string", "escape", "closed")
+
+    def __init__(self) -> None:
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.closed = False
+
+    def feed(self, text: str) -> bool:
+        for ch in text:
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = self.depth > 0
+            elif ch == "{":
+                self.depth += 1
+            elif ch == "}" and self.depth > 0:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.closed = True
+                    break
+        return self.closed
+
+
+# Ends each row as soon as its first JSON object is complete, instead of
+# decoding on to EOS or max_new_tokens. Only the tokens added since the last
+# step are fed, so the cost per step is one short string per row.
+class JSONCloseCriteria(StoppingCriteria):
+    def __init__(self, tokenizer, prompt_len: int):
+        self.prompt_len = prompt_len
+        self.token_strings, self.special_ids = _token_table(tokenizer)
+        self._rows: List[_ObjectCloseTracker] = []
+        self._seen = 0
+        # Generated tokens per row when its object closed (None: never closed).
+        self.closed_at: List[int | None] = []
+
+    def __call__(self, input_ids: torch.LongTensor, scores: Any, **kwargs: Any) -> torch.BoolTensor:
+        rows, length = input_ids.shape
+        while len(self._rows) < rows:
+            self._rows.append(_ObjectCloseTracker())
+            self.closed_at.append(None)
+        start = self.prompt_len + self._seen
+        new_ids = input_ids[:, start:].tolist() if length > start else [[] for _ in range(rows)]
+        self._seen = length - self.prompt_len
+        done = []
+        for row, (tracker, ids) in enumerate(zip(self._rows, new_ids)):
+            if not tracker.closed:
+                for token_id in ids:
+                    if token_id not in self.special_ids and token_id < len(self.token_strings):
+                        if tracker.feed(self.token_strings[token_id]):
+                            self.closed_at[row] = self._seen
+                            break
+            done.append(tracker.closed)
+        return torch.tensor(done, device=input_ids.device, dtype=torch.bool)
+
+
+# Per-row max_new_tokens for a batch decoded with the largest budget.
+class RowBudgetCriteria(StoppingCriteria):
+    def __init__(self, prompt_len: int, budgets: List[int]):
+        self.prompt_len = prompt_len
+        self.budgets = torch.tensor(budgets)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: Any, **kwargs: Any) -> torch.BoolTensor:
+        generated = input_ids.shape[-1] - self.prompt_len
+        return (self.budgets <= generated).to(input_ids.device)
@@ -0,0 +1,185 @@
+import hashlib
+import json
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
+
+Task = Dict[str, Any]
+Bank = Dict[str, Dict[str, List[Task]]]
+
+BANK_FILE_SUFFIXES = (".json", ".yaml", ".yml")
+SQLITE_SUFFIXES = (".sqlite", ".sqlite3", ".db")
+
+
+def _read_yaml(path: Path) -> Any:
+    try:
+        import yaml
+    except ImportError as err:
+        raise RuntimeError(f"{path.name}: YAML task files need `pip install pyyaml`") from err
+    with path.open(encoding="utf-8") as handle:
+        return yaml.safe_load(handle)
+
+
+def _entries_from_document(document: Any, source: str) -> Iterator[Tuple[str, str, Task]]:
+    # Either {topic: {tier: [task, ...]}} (the TASK_BANK layout) or a flat list
+    # of tasks carrying their own "topic" and "tier" (also under {"tasks": [...]}).
+    if isinstance(document, dict) and "tasks" in document:
+        document = document["tasks"]
+    if isinstance(document, list):
+        for task in document:
+            if not isinstance(task, dict) or "topic" not in task or "tier" not in task:
+                raise ValueError(f"{source}: each task needs 'topic' and 'tier'")
+            task = dict(task)
+            yield task.pop("topic"), task.pop("tier"), task
+        return
+    if not isinstance(document, dict):
+        raise ValueError(f"{source}: expected a mapping or a list of tasks")
+    for topic, tiers in document.items():
+        for tier, tasks in (tiers or {}).items():
+            for task in tasks or []:
+                yield topic, tier, task
+
+
+def _sqlite_entries(path: Path) -> Iterator[Tuple[str, str, Task]]:
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        rows = conn.execute("SELECT topic, tier, data FROM tasks ORDER BY rowid")
+        for topic, tier, data in rows:
+            yield topic, tier, json.loads(data)
+    finally:
+        conn.close()
+
+
+def _bank_files(path: Path) -> List[Path]:
+    return sorted(p for p in path.rglob("*") if p.suffix.lower() in BANK_FILE_SUFFIXES and p.is_file())
+
+
+def _entries(path: Path) -> Iterator[Tuple[str, str, Task]]:
+    if path.is_dir():
+        for file in _bank_files(path):
+            if file.suffix.lower() == ".json":
+                with file.open(encoding="utf-8") as handle:
+                    document = json.load(handle)
+            else:
+                document = _read_yaml(file)
+            yield from _entries_from_document(document, file.name)
+    elif path.suffix.lower() in SQLITE_SUFFIXES:
+        yield from _sqlite_entries(path)
+    else:
+        raise ValueError(f"TASK_BANK_PATH must be a directory or a SQLite file: {path}")
+
+
+def _intern(value: Any) -> Any:
+    # Starters, solutions and op names repeat across thousands of tasks; one
+    # shared str per distinct value keeps memory proportional to unique text.
+    if isinstance(value, str):
+        return sys.intern(value)
+    if isinstance(value, list):
+        return [_intern(item) for item in value]
+    return value
+
+
+def build_bank(entries: Iterable[Tuple[str, str, Task]], normalize: Callable[[str], str]) -> Bank:
+    bank: Bank = {}
+    seen: Dict[str, str] = {}
+    for topic, tier, task in entries:
+        task_id = task.get("id")
+        if not task_id:
+            raise ValueError(f"Task without 'id' in {topic}/{tier}")
+        if task_id in seen:
+            raise ValueError(f"Duplicate task id {task_id!r} ({seen[task_id]} and {topic}/{tier})")
+        seen[task_id] = f"{topic}/{tier}"
+        clean = {key: _intern(value) for key, value in task.items()}
+        bank.setdefault(normalize(topic), {}).setdefault(normalize(tier), []).append(clean)
+    return bank
+
+
+def load_task_bank(path: str, normalize: Callable[[str], str]) -> Bank:
+    return build_bank(_entries(Path(path)), normalize)
+
+
+def source_fingerprint(path: str) -> str:
+    # Cheap change detection: names, sizes and mtimes, no file contents.
+    source = Path(path)
+    if source.is_dir():
+        files = _bank_files(source)
+    else:
+        files = [p for p in (source, Path(f"{path}-wal")) if p.exists()]
+    digest = hashlib.sha1()
+    for file in files:
+        stat = file.stat()
+        digest.update(f"{file}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+# Holds the current snapshot built by `build_snapshot(bank)`. Reloads build a
+# complete new snapshot off to the side and swap one reference, so requests
+# always read a consistent (bank, index, templates) set without locking.
+class TaskBankStore:
+    def __init__(
+        self,
+        path: str,
+        default_bank: Bank,
+        build_snapshot: Callable[[Bank, str], Any],
+        normalize: Callable[[str], str],
+        poll_seconds: float = 5.0,
+    ):
+        self.path = path
+        self.build_snapshot = build_snapshot
+        self.normalize = normalize
+        self.poll_seconds = poll_seconds
+        self.reloads = 0
+        self.last_error: str | None = None
+        self.loaded_at = time.time()
+        self._reload_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        if path:
+            self._fingerprint = source_fingerprint(path)
+            self.snapshot = build_snapshot(load_task_bank(path, normalize), self._fingerprint)
+        else:
+            self._fingerprint = "builtin"
+            self.snapshot = build_snapshot(default_bank, self._fingerprint)
+
+    def start(self) -> None:
+        if not self.path or self.poll_seconds <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._poll, name="task-bank-reload", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _poll(self) -> None:
+        while not self._stop.wait(self.poll_seconds):
+            self.reload_if_changed()
+
+    def reload_if_changed(self) -> bool:
+        with self._reload_lock:
+            try:
+                fingerprint = source_fingerprint(self.path)
+                if fingerprint == self._fingerprint:
+                    return False
+                snapshot = self.build_snapshot(load_task_bank(self.path, self.normalize), fingerprint)
+            except Exception as err:
+                # Keep serving the previous snapshot; retry on the next poll.
+                self.last_error = f"{type(err).__name__}: {err}"
+                return False
+            self.snapshot = snapshot
+            self._fingerprint = fingerprint
+            self.reloads += 1
+            self.loaded_at = time.time()
+            self.last_error = None
+            return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "source": self.path or "builtin",
+            "version": self._fingerprint[:12],
+            "reloads": self.reloads,
+            "loadedAt": self.loaded_at,
+            "lastError": self.last_error,
+        }
@@ -0,0 +1,293 @@
+import random
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from typing import Any, Dict, List, NamedTuple, Tuple
+
+Task = Dict[str, Any]
+
+
+class TaskGroup(NamedTuple):
+    tasks: Tuple[Task, ...]
+    index_of: Dict[str, int]
+
+
+# Prebuilt (topic, tier) -> TaskGroup map. Lookup mirrors the original
+# `TASK_BANK.get(topic, TASK_BANK[default]).get(tier, [])` fallback rules.
+# `required_ops` are indexed too: (topic, tier, op) -> positions in the group.
+class TaskIndex:
+    def __init__(self, bank: Dict[str, Dict[str, List[Task]]], default_topic: str = "general"):
+        self.default_topic = default_topic
+        self.topics = frozenset(bank)
+        self._groups: Dict[Tuple[str, str], TaskGroup] = {}
+        self._ops: Dict[Tuple[str, str, str], Tuple[int, ...]] = {}
+        for topic, tiers in bank.items():
+            for tier, tasks in tiers.items():
+                if tasks:
+                    self._groups[(topic, tier)] = TaskGroup(
+                        tuple(tasks), {task["id"]: pos for pos, task in enumerate(tasks)}
+                    )
+                    self._index_ops(topic, tier, tasks)
+
+    def _index_ops(self, topic: str, tier: str, tasks: List[Task]) -> None:
+        positions: Dict[str, List[int]] = {}
+        for pos, task in enumerate(tasks):
+            for op in task.get("required_ops", ()):
+                positions.setdefault(op, []).append(pos)
+        for op, found in positions.items():
+            self._ops[(topic, tier, op)] = tuple(found)
+
+    def group(self, topic: str, tier: str) -> TaskGroup | None:
+        if topic not in self.topics:
+            topic = self.default_topic
+        return self._groups.get((topic, tier))
+
+    def with_op(self, topic: str, tier: str, op: str) -> List[Task]:
+        group = self.group(topic, tier)
+        if group is None:
+            return []
+        if topic not in self.topics:
+            topic = self.default_topic
+        return [group.tasks[pos] for pos in self._ops.get((topic, tier, op), ())]
+
+    def ops(self) -> List[str]:
+        return sorted({op for (_, _, op) in self._ops})
+
+    def __len__(self) -> int:
+        return sum(len(group.tasks) for group in self._groups.values())
+
+
+# Positions of the group's tasks; the first `available` entries of `order` are
+# the tasks not seen recently, so picking and removing are both O(1).
+class _Pool:
+    __slots__ = ("group", "order", "pos", "available")
+
+    def __init__(self, group: TaskGroup):
+        size = len(group.tasks)
+        self.group = group
+        self.order = list(range(size))
+        self.pos = list(range(size))
+        self.available = size
+
+    def remove(self, index: int) -> None:
+        slot = self.pos[index]
+        if slot >= self.available:
+            return
+        last = self.available - 1
+        other = self.order[last]
+        self.order[slot], self.order[last] = other, index
+        self.pos[other], self.pos[index] = slot, last
+        self.available = last
+
+    def restore(self, index: int) -> None:
+        slot = self.pos[index]
+        if slot < self.available:
+            return
+        first = self.available
+        other = self.order[first]
+        self.order[slot], self.order[first] = other, index
+        self.pos[other], self.pos[index] = slot, first
+        self.available = first + 1
+
+
+# Ring buffer of the last `max_size` (task_key, task_id) picks plus, per key,
+# the pool of tasks still eligible. Pools exist only while a key has entries
+# in the ring, so memory stays bounded by `max_size` keys.
+class RecentTaskHistory:
+    def __init__(self, max_size: int, rng: random.Random | None = None):
+        self.max_size = max(0, max_size)
+        self.rng = rng or random.Random()
+        self._ring: deque = deque()
+        self._counts: Dict[Tuple[str, str], int] = {}
+        self._pools: Dict[str, _Pool] = {}
+        self._key_entries: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def pick(self, task_key: str, group: TaskGroup) -> Task:
+        with self._lock:
+            pool = self._pools.get(task_key)
+            if pool is not None and pool.group is not group:
+                pool = self._rebuild_pool(task_key, group)
+            if pool is None or pool.available == 0:
+                index = self.rng.randrange(len(group.tasks))
+            else:
+                index = pool.order[self.rng.randrange(pool.available)]
+            task = group.tasks[index]
+            self._register(task_key, task["id"], group)
+            return task
+
+    def is_recent(self, task_key: str, task_id: str) -> bool:
+        with self._lock:
+            return (task_key, task_id) in self._counts
+
+    def _rebuild_pool(self, task_key: str, group: TaskGroup) -> _Pool:
+        # The bank changed under this key: recompute eligibility once.
+        pool = _Pool(group)
+        for (key, task_id) in self._counts:
+            if key == task_key and task_id in group.index_of:
+                pool.remove(group.index_of[task_id])
+        self._pools[task_key] = pool
+        return pool
+
+    def _register(self, task_key: str, task_id: str, group: TaskGroup) -> None:
+        if self.max_size == 0:
+            return
+        entry = (task_key, task_id)
+        self._ring.append(entry)
+        self._key_entries[task_key] = self._key_entries.get(task_key, 0) + 1
+        count = self._counts.get(entry, 0) + 1
+        self._counts[entry] = count
+        if count == 1:
+            pool = self._pools.get(task_key)
+            if pool is None:
+                pool = self._pools[task_key] = _Pool(group)
+            pool.remove(group.index_of[task_id])
+        if len(self._ring) > self.max_size:
+            self._evict(self._ring.popleft())
+
+    def _evict(self, entry: Tuple[str, str]) -> None:
+        task_key, task_id = entry
+        count = self._counts[entry] - 1
+        if count:
+            self._counts[entry] = count
+        else:
+            del self._counts[entry]
+            pool = self._pools.get(task_key)
+            if pool is not None and task_id in pool.group.index_of:
+                pool.restore(pool.group.index_of[task_id])
+        remaining = self._key_entries[task_key] - 1
+        if remaining:
+            self._key_entries[task_key] = remaining
+        else:
+            del self._key_entries[task_key]
+            self._pools.pop(task_key, None)
+
+
+# Task recency is tracked per scope (user/session id, "" for anonymous calls).
+# Only the `max_scopes` most recently active scopes are kept. `blocking` stores
+# do file I/O and should be called off the event loop.
+class TaskHistoryStore(ABC):
+    blocking = False
+
+    @abstractmethod
+    def pick(self, scope: str, task_key: str, group: TaskGroup) -> Task:
+        ...
+
+
+class MemoryTaskHistoryStore(TaskHistoryStore):
+    def __init__(self, history_max: int, max_scopes: int = 10000):
+        self.history_max = history_max
+        self.max_scopes = max(1, max_scopes)
+        self.rng = random.Random()
+        self._scopes: "OrderedDict[str, RecentTaskHistory]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def pick(self, scope: str, task_key: str, group: TaskGroup) -> Task:
+        with self._lock:
+            history = self._scopes.get(scope)
+            if history is None:
+                history = self._scopes[scope] = RecentTaskHistory(self.history_max, self.rng)
+                while len(self._scopes) > self.max_scopes:
+                    self._scopes.popitem(last=False)
+            else:
+                self._scopes.move_to_end(scope)
+        return history.pick(task_key, group)
+
+
+# History kept in a SQLite file so every uvicorn worker on the host sees the
+# same recency. Each pick is one IMMEDIATE transaction (read, insert, trim).
+# task_history_scopes holds the last history id per scope; a pick that adds a
+# new scope drops the history of the least recently active ones.
+class SqliteTaskHistoryStore(TaskHistoryStore):
+    blocking = True
+
+    def __init__(self, path: str, history_max: int, max_scopes: int = 10000):
+        self.history_max = max(0, history_max)
+        self.max_scopes = max(1, max_scopes)
+        self.rng = random.Random()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS task_history ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, scope TEXT NOT NULL, "
+            "task_key TEXT NOT NULL, task_id TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS task_history_scope ON task_history (scope, id)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS task_history_scopes (scope TEXT PRIMARY KEY, last_id INTEGER NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS task_history_scopes_last ON task_history_scopes (last_id)"
+        )
+        # Files written before the scope table existed.
+        self._conn.execute(
+            "INSERT OR IGNORE INTO task_history_scopes "
+            "SELECT scope, MAX(id) FROM task_history GROUP BY scope"
+        )
+
+    def pick(self, scope: str, task_key: str, group: TaskGroup) -> Task:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    "SELECT task_key, task_id FROM task_history WHERE scope = ? ORDER BY id DESC LIMIT ?",
+                    (scope, self.history_max),
+                ).fetchall()
+                recent = {task_id for key, task_id in rows if key == task_key}
+                task = group.tasks[self._choose(group, recent)]
+                if self.history_max:
+                    last_id = self._conn.execute(
+                        "INSERT INTO task_history (scope, task_key, task_id) VALUES (?, ?, ?)",
+                        (scope, task_key, task["id"]),
+                    ).lastrowid
+                    self._conn.execute(
+                        "DELETE FROM task_history WHERE scope = ? AND id <= ("
+                        "SELECT id FROM task_history WHERE scope = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                        (scope, scope, self.history_max),
+                    )
+                    self._touch_scope(scope, last_id)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return task
+
+    def _touch_scope(self, scope: str, last_id: int) -> None:
+        updated = self._conn.execute(
+            "UPDATE task_history_scopes SET last_id = ? WHERE scope = ?", (last_id, scope)
+        ).rowcount
+        if updated:
+            return
+        self._conn.execute("INSERT INTO task_history_scopes VALUES (?, ?)", (scope, last_id))
+        stale = [
+            row[0]
+            for row in self._conn.execute(
+                "SELECT scope FROM task_history_scopes ORDER BY last_id DESC LIMIT -1 OFFSET ?",
+                (self.max_scopes,),
+            )
+        ]
+        for old in stale:
+            self._conn.execute("DELETE FROM task_history WHERE scope = ?", (old,))
+            self._conn.execute("DELETE FROM task_history_scopes WHERE scope = ?", (old,))
+
+    def _choose(self, group: TaskGroup, recent: set) -> int:
+        size = len(group.tasks)
+        # With few recent ids rejection sampling needs ~1 draw; fall back to a scan otherwise.
+        if len(recent) * 2 < size:
+            while True:
+                index = self.rng.randrange(size)
+                if group.tasks[index]["id"] not in recent:
+                    return index
+        candidates = [i for i, task in enumerate(group.tasks) if task["id"] not in recent]
+        return self.rng.choice(candidates) if candidates else self.rng.randrange(size)
+
+
+def make_task_history_store(backend: str, history_max: int, path: str, max_scopes: int) -> TaskHistoryStore:
+    backend = backend.lower()
+    if backend == "memory":
+        return MemoryTaskHistoryStore(history_max, max_scopes)
+    if backend == "sqlite":
+        return SqliteTaskHistoryStore(path, history_max, max_scopes)
+    raise ValueError(f"Unknown TASK_HISTORY_BACKEND: {backend}")
@@ -0,0 +1,112 @@
+import importlib
+import os
+import sys
+from pathlib import Path
+
+import pytest
+import torch
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+CHAT_TEMPLATE = (
+    "{% for m in messages %}<|im_start|>{{ m['role'] }}\n{{ m['content'] }}<|im_end|>\n{% endfor %}"
+    "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}"
+)
+
+
+def _train_tokenizer():
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    # Byte-level BPE trained on the repo sources: offline, deterministic, and
+    # it can encode any text the tests throw at it.
+    corpus = [path.read_text(encoding="utf-8") for path in sorted(ROOT.glob("*.py"))]
+    tok = Tokenizer(models.BPE())
+    tok.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tok.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=600,
+        special_tokens=["<|endoftext|>", "<|im_start|>", "<|im_end|>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    tok.train_from_iterator(corpus, trainer)
+    fast = PreTrainedTokenizerFast(tokenizer_object=tok, eos_token="<|im_end|>", pad_token="<|endoftext|>")
+    fast.chat_template = CHAT_TEMPLATE
+    return fast
+
+
+@pytest.fixture(scope="session")
+def tiny_dir(tmp_path_factory):
+    # Random 2-layer Qwen2 plus two LoRA adapters ("lora_a", "lora_b") on it.
+    from peft import LoraConfig, get_peft_model
+    from transformers import Qwen2Config, Qwen2ForCausalLM
+
+    root = tmp_path_factory.mktemp("tiny")
+    tokenizer = _train_tokenizer()
+    tokenizer.save_pretrained(root / "base")
+    config = Qwen2Config(
+        vocab_size=len(tokenizer),
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=2048,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+        tie_word_embeddings=True,
+    )
+    torch.manual_seed(0)
+    Qwen2ForCausalLM(config).save_pretrained(root / "base")
+    for seed, name in enumerate(("lora_a", "lora_b", "lora_c")):
+        torch.manual_seed(seed + 1)
+        model = get_peft_model(
+            Qwen2ForCausalLM.from_pretrained(root / "base"),
+            LoraConfig(r=2, lora_alpha=4, target_modules=["q_proj", "v_proj"], task_type="CAUSAL_LM", init_lora_weights=False),
+        )
+        model.save_pretrained(root / name)
+    return root
+
+
+@pytest.fixture(scope="session")
+def tiny_tokenizer(tiny_dir):
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(tiny_dir / "base")
+
+
+@pytest.fixture(scope="session")
+def server(tiny_dir, tmp_path_factory):
+    # main.py reads its settings at import time: LLM mode on the tiny model,
+    # LoRA left unmerged (the default with LORA_ADAPTERS) so adapters can be
+    # swapped, nothing persisted in the repo.
+    state = tmp_path_factory.mktemp("server")
+    os.environ.pop("LORA_MERGE", None)
+    os.environ.update(
+        {
+            "GENERATION_MODE": "llm",
+            "BASE_MODEL": str(tiny_dir / "base"),
+            "LORA_PATH": str(tiny_dir / "lora_a"),
+            "LORA_ADAPTERS": f"b={tiny_dir / 'lora_b'}",
+            "INFERENCE_BACKEND": "cpu-fp32",
+            "ADMIN_TOKEN": "test-token",
+            "MODEL_WARMUP": "0",
+            "MAX_NEW_TOKENS": "16",
+            "TOKEN_BUDGET_MIN": "8",
+            "TOKEN_BUDGET_MAX": "16",
+            "MAX_JSON_FIX_ATTEMPTS": "0",
+            "TOKEN_BUDGET_PATH": str(state / "token_budget.json"),
+            "RESPONSE_CACHE_BACKEND": "none",
+            "TASK_BANK_PATH": "",
+        }
+    )
+    return importlib.import_module("main")
+
+
+@pytest.fixture(scope="session")
+def client(server):
+    from fastapi.testclient import TestClient
+
+    with TestClient(server.app) as test_client:
+        yield test_client
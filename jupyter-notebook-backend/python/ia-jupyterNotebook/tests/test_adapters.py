@@ -0,0 +1,70 @@
+import pytest
+
+ADMIN = {"X-Admin-Token": "test-token"}
+BODY = {"topic": "pandas", "difficulty": "basica", "exerciseType": "completar_codigo", "datasetSize": "pequeno"}
+GREEDY = {"top_k": 1, "max_new_tokens": 6}
+
+
+def _generate(client, adapter):
+    return client.post("/generate", json={**BODY, "adapter": adapter, "noCache": True})
+
+
+@pytest.fixture
+def admin(client):
+    loaded = []
+
+    def load(name, path):
+        response = client.post("/admin/adapters", json={"name": name, "path": str(path)}, headers=ADMIN)
+        if response.status_code == 200:
+            loaded.append(name)
+        return response
+
+    yield load
+    for name in loaded:
+        client.delete(f"/admin/adapters/{name}", headers=ADMIN)
+
+
+def test_admin_load_after_lazy_load(server, client, admin, tiny_dir):
+    # "b" comes from LORA_ADAPTERS and is only loaded by its first request.
+    assert "b" not in client.get("/admin/adapters", headers=ADMIN).json()["loaded"]
+    assert admin("c", tiny_dir / "lora_c").status_code == 200
+    assert _generate(client, "c").status_code == 200
+    assert _generate(client, "b").status_code == 200
+    assert "b" in client.get("/admin/adapters", headers=ADMIN).json()["loaded"]
+    response = admin("e", tiny_dir / "lora_b")
+    assert response.status_code == 200, response.text
+    assert _generate(client, "e").status_code == 200
+
+
+def test_failed_load_does_not_register(client, admin):
+    response = admin("missing", "/nonexistent")
+    assert response.status_code == 409
+    stats = client.get("/admin/adapters", headers=ADMIN).json()
+    assert "missing" not in stats["registered"]
+    assert "missing" not in stats["loaded"]
+    assert _generate(client, "missing").status_code == 404
+
+
+def test_failed_reload_keeps_previous_adapter(server, client, admin, tiny_dir):
+    assert admin("c", tiny_dir / "lora_c").status_code == 200
+    before = server._generate_batch(["def _norm"], {**GREEDY, "adapter": "c"})
+    assert admin("c", "/nonexistent").status_code == 409
+    stats = client.get("/admin/adapters", headers=ADMIN).json()
+    assert stats["registered"]["c"] == str(tiny_dir / "lora_c")
+    assert "c" in stats["loaded"]
+    assert server._generate_batch(["def _norm"], {**GREEDY, "adapter": "c"}) == before
+
+
+def test_reload_swaps_weights(server, admin, tiny_dir):
+    assert admin("c", tiny_dir / "lora_c").status_code == 200
+    with_c = server._generate_batch(["def _norm"], {**GREEDY, "adapter": "c"})
+    assert admin("c", tiny_dir / "lora_b").status_code == 200
+    assert server._generate_batch(["def _norm"], {**GREEDY, "adapter": "c"}) == server._generate_batch(
+        ["def _norm"], {**GREEDY, "adapter": "b"}
+    )
+    assert admin("c", tiny_dir / "lora_c").status_code == 200
+    assert server._generate_batch(["def _norm"], {**GREEDY, "adapter": "c"}) == with_c
+
+
+def test_extra_adapters_default_to_unmerged(server):
+    assert server.LORA_ADAPTERS and not server.LORA_MERGE
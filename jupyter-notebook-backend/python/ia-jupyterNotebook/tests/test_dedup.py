@@ -0,0 +1,33 @@
+from dedup_dataset import Deduper
+
+
+def _row(index):
+    return [{"role": "user", "content": f"fila {index}"}, {"role": "assistant", "content": f"respuesta numero {index}"}]
+
+
+def test_exact_duplicates_within_window_are_dropped():
+    deduper = Deduper(near=False, window=100)
+    assert [deduper.keep(_row(i % 50)) for i in range(100)] == [True] * 50 + [False] * 50
+    assert deduper.exact_duplicates == 50
+
+
+def test_indexes_stay_within_window():
+    window = 64
+    for near in (False, True):
+        deduper = Deduper(window=window, near=near)
+        for index in range(1000):
+            deduper.keep(_row(index))
+            assert len(deduper._exact) <= window
+            assert len(deduper._signatures) <= window
+            assert all(len(bucket) <= window for bucket in deduper._buckets)
+        assert deduper.kept == 1000
+        # Row 0 left the window, so it is no longer recognised.
+        assert deduper.keep(_row(0)) and not deduper.keep(_row(999))
+
+
+def test_near_duplicates_are_dropped():
+    deduper = Deduper(window=100)
+    text = " ".join(f"palabra{i}" for i in range(60))
+    assert deduper.keep([{"role": "assistant", "content": text}])
+    assert not deduper.keep([{"role": "assistant", "content": text + " extra"}])
+    assert deduper.near_duplicates == 1
@@ -0,0 +1,139 @@
+import threading
+
+import pytest
+
+from inference import InferencePool, MicroBatcher, QueueFullError
+
+PROMPTS = [
+    "Crea un ejercicio de pandas",
+    "def _norm(value: str) -> str:",
+    "Return ONLY valid JSON, no markdown fences, no extra commentary.",
+]
+# top_k=1 makes the sampling in _generate_batch greedy.
+GREEDY = {"top_k": 1, "temperature": 1.0, "top_p": 1.0}
+
+
+class RecordingRunner:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, prompts, gen_kwargs, timings):
+        self.calls.append((list(prompts), dict(gen_kwargs)))
+        return [f"{prompt}|{gen_kwargs.get('temperature')}" for prompt in prompts]
+
+
+def _submit_all(batcher, jobs):
+    futures = [batcher.submit(prompt, **kwargs) for prompt, kwargs in jobs]
+    return [future.result(timeout=10) for future in futures]
+
+
+def test_batches_are_grouped_by_kwargs():
+    runner = RecordingRunner()
+    batcher = MicroBatcher(runner, max_batch_size=8, max_wait_ms=200)
+    try:
+        jobs = [(f"p{i}", {"temperature": 0.5 if i % 2 else 0.35}) for i in range(6)]
+        outputs = _submit_all(batcher, jobs)
+    finally:
+        batcher.close()
+    assert outputs == [f"p{i}|{0.5 if i % 2 else 0.35}" for i in range(6)]
+    assert sorted(len(prompts) for prompts, _ in runner.calls) == [3, 3]
+    for prompts, kwargs in runner.calls:
+        assert all(int(p[1:]) % 2 == (kwargs["temperature"] == 0.5) for p in prompts)
+
+
+def test_batch_size_is_capped():
+    runner = RecordingRunner()
+    batcher = MicroBatcher(runner, max_batch_size=2, max_wait_ms=200)
+    try:
+        _submit_all(batcher, [(f"p{i}", {}) for i in range(5)])
+    finally:
+        batcher.close()
+    assert max(len(prompts) for prompts, _ in runner.calls) <= 2
+    assert sum(len(prompts) for prompts, _ in runner.calls) == 5
+
+
+def test_max_new_tokens_is_kept_per_row():
+    runner = RecordingRunner()
+    batcher = MicroBatcher(runner, max_batch_size=8, max_wait_ms=200, per_row=("max_new_tokens",))
+    try:
+        _submit_all(batcher, [(f"p{i}", {"temperature": 0.5, "max_new_tokens": 10 * (i + 1)}) for i in range(3)])
+    finally:
+        batcher.close()
+    assert len(runner.calls) == 1
+    prompts, kwargs = runner.calls[0]
+    assert kwargs["max_new_tokens"] == [10 * (int(p[1:]) + 1) for p in prompts]
+
+
+def test_runner_errors_reach_every_caller():
+    def failing(prompts, gen_kwargs, timings):
+        raise RuntimeError("boom")
+
+    batcher = MicroBatcher(failing, max_wait_ms=50)
+    try:
+        futures = [batcher.submit("a"), batcher.submit("b")]
+        for future in futures:
+            with pytest.raises(RuntimeError, match="boom"):
+                future.result(timeout=10)
+    finally:
+        batcher.close()
+
+
+def test_pool_rejects_when_full():
+    pool = InferencePool(max_workers=1, max_queue=2)
+    release = threading.Event()
+    try:
+        pool.submit(release.wait)
+        pool.submit(release.wait)
+        with pytest.raises(QueueFullError):
+            pool.submit(release.wait)
+        assert pool.stats()["rejected"] == 1
+    finally:
+        release.set()
+
+
+def test_generate_returns_503_with_retry_after_when_pool_is_full(server, client, monkeypatch):
+    pool = InferencePool(max_workers=1, max_queue=1)
+    release = threading.Event()
+    monkeypatch.setattr(server, "_inference_pool", pool)
+    pool.submit(release.wait)
+    try:
+        response = client.post(
+            "/generate",
+            json={"topic": "pandas", "difficulty": "basica", "exerciseType": "completar_codigo", "datasetSize": "pequeno"},
+        )
+    finally:
+        release.set()
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(server.INFERENCE_RETRY_AFTER)
+
+
+def test_batched_greedy_matches_unbatched(server):
+    single = [server._generate_batch([prompt], {**GREEDY, "max_new_tokens": 8}) for prompt in PROMPTS]
+    batched = server._generate_batch(PROMPTS, {**GREEDY, "max_new_tokens": 8})
+    assert batched == [out[0] for out in single]
+
+
+def test_batched_row_budgets_match_unbatched(server):
+    budgets = [2, 8, 5]
+    single = [server._generate_batch([p], {**GREEDY, "max_new_tokens": b})[0] for p, b in zip(PROMPTS, budgets)]
+    batched = server._generate_batch(PROMPTS, {**GREEDY, "max_new_tokens": budgets})
+    assert batched == single
+
+
+class _PlainModel:
+    # Stands in for an ORT model: generate() and device, but no nn.Module hooks.
+    def __init__(self, model):
+        self._model = model
+        self.device = model.device
+
+    def generate(self, **kwargs):
+        return self._model.generate(**kwargs)
+
+
+def test_models_without_hooks_use_wall_clock(server, monkeypatch):
+    tokenizer, model = server.load_pipeline()
+    expected = server._generate_batch(PROMPTS[:1], {**GREEDY, "max_new_tokens": 4})
+    monkeypatch.setattr(server, "load_pipeline", lambda: (tokenizer, _PlainModel(model)))
+    timings = {}
+    assert server._generate_batch(PROMPTS[:1], {**GREEDY, "max_new_tokens": 4}, timings) == expected
+    assert "prefill" not in timings and timings["generate"] > 0
@@ -0,0 +1,114 @@
+import json
+import random
+
+import pytest
+
+from json_repair import conform, salvage_json
+from json_stream import scan_json_objects
+
+CASES = 500
+NOISE = '{}[]"\\`,: ab\n'
+TEXT_CHARS = 'abc xyz{}[]":,\\\n\t`áñ€😀'
+
+
+def _random_text(rng):
+    return "".join(rng.choice(TEXT_CHARS) for _ in range(rng.randint(0, 12)))
+
+
+def _random_value(rng, depth=0):
+    kind = rng.randrange(6 if depth < 3 else 3)
+    if kind == 0:
+        return _random_text(rng)
+    if kind == 1:
+        return rng.choice([0, -7, 3.5, 1e20, True, False, None])
+    if kind == 2:
+        return rng.randint(-1000, 1000)
+    if kind in (3, 4):
+        return {_random_text(rng): _random_value(rng, depth + 1) for _ in range(rng.randint(0, 4))}
+    return [_random_value(rng, depth + 1) for _ in range(rng.randint(0, 4))]
+
+
+def _random_object(rng):
+    return {_random_text(rng): _random_value(rng, 1) for _ in range(rng.randint(1, 5))}
+
+
+@pytest.fixture(scope="module")
+def exercises(server):
+    # Template exercises: the shape the model is asked for.
+    found = []
+    for topic in ("pandas", "numpy", "markdown", "python"):
+        for difficulty in ("basica", "intermedia", "avanzada"):
+            payload = server.ExerciseRequest(
+                topic=topic, difficulty=difficulty, exerciseType="explicar", datasetSize="mediano"
+            )
+            found.append(server.render_exercise(payload, server._pick_task(payload)))
+    return found
+
+
+def _blob(rng, exercises):
+    value = rng.choice(exercises) if rng.random() < 0.5 else _random_object(rng)
+    return json.dumps(value, ensure_ascii=rng.random() < 0.5)
+
+
+def test_scanner_matches_json_loads_on_valid_input(exercises):
+    rng = random.Random(0)
+    for _ in range(CASES):
+        blob = _blob(rng, exercises)
+        candidates = scan_json_objects(blob)
+        assert len(candidates) == 1 and candidates[0].complete
+        assert json.loads(candidates[0].text) == json.loads(blob)
+
+
+def test_parse_finds_object_between_prose_and_junk(server, exercises):
+    # parse_json_response wants an exercise (it requires a title).
+    rng = random.Random(1)
+    for _ in range(CASES):
+        blob = json.dumps(rng.choice(exercises), ensure_ascii=rng.random() < 0.5)
+        prose = "".join(rng.choice("abc xyz:.\n") for _ in range(rng.randint(0, 40)))
+        junk = "".join(rng.choice(NOISE) for _ in range(rng.randint(0, 40)))
+        assert server.parse_json_response(prose + blob + junk) == json.loads(blob), prose + blob + junk
+
+
+def test_salvage_matches_json_loads_on_valid_input(server, exercises):
+    rng = random.Random(2)
+    for _ in range(CASES):
+        blob = _blob(rng, exercises)
+        expected = conform(json.loads(blob), server.EXERCISE_SCHEMA) or None
+        assert salvage_json(blob, server.EXERCISE_SCHEMA) == expected
+    for exercise in exercises:
+        blob = json.dumps(exercise)
+        assert salvage_json(blob, server.EXERCISE_SCHEMA) == json.loads(blob)
+
+
+def test_truncated_input_never_raises(server, exercises):
+    rng = random.Random(3)
+    for _ in range(CASES):
+        blob = _blob(rng, exercises)
+        cut = blob[: rng.randint(1, len(blob) - 1)]
+        tail = scan_json_objects(cut)[-1]
+        assert not tail.complete and tail.text == cut
+        # An odd run of trailing backslashes is a cut escape the closers cannot finish.
+        if (len(cut) - len(cut.rstrip("\\"))) % 2 == 0:
+            assert scan_json_objects(cut + tail.closers)[0].complete
+        repaired = salvage_json(cut, server.EXERCISE_SCHEMA)
+        assert repaired is None or isinstance(repaired, dict)
+
+
+def test_garbled_input_never_raises(server, exercises):
+    rng = random.Random(4)
+    for _ in range(CASES):
+        text = list(_blob(rng, exercises))
+        for _ in range(rng.randint(1, 8)):
+            position = rng.randint(0, len(text))
+            if rng.random() < 0.3 and position < len(text):
+                del text[position]
+            else:
+                text.insert(position, rng.choice(NOISE))
+        garbled = "".join(text)
+        scan_json_objects(garbled)
+        repaired = salvage_json(garbled, server.EXERCISE_SCHEMA)
+        assert repaired is None or isinstance(repaired, dict)
+        try:
+            server.parse_json_response(garbled)
+        except ValueError:
+            pass
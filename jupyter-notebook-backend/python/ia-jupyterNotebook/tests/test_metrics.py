@@ -0,0 +1,17 @@
+import pytest
+
+from metrics import Counter, _Metric
+
+
+def test_metric_without_samples_fails_at_creation():
+    class Incomplete(_Metric):
+        kind = "gauge"
+
+    with pytest.raises(TypeError):
+        Incomplete("incomplete", "Missing _samples.")
+
+
+def test_counter_renders():
+    counter = Counter("requests_total", "Requests.", labels=("status",))
+    counter.inc(status="200")
+    assert counter.render()[-1] == 'requests_total{status="200"} 1'
@@ -0,0 +1,88 @@
+import json
+import sys
+
+import pytest
+
+import prepare_hf_dataset
+from prepare_hf_dataset import ShardWriter, load_checkpoint, shard_path
+
+SHARD_SIZE = 7
+
+
+@pytest.fixture(scope="module")
+def source(tmp_path_factory):
+    path = tmp_path_factory.mktemp("source") / "rows.jsonl"
+    with path.open("w", encoding="utf-8") as f:
+        for index in range(80):
+            packages = ["pandas"] if index % 3 else ["numpy"]
+            messages = [{"role": "user", "content": f"pregunta {index}"}, {"role": "assistant", "content": f"respuesta {index}"}]
+            f.write(json.dumps({"messages": messages, "packages_used": packages}) + "\n")
+    return path
+
+
+def _run(monkeypatch, source, output, *extra):
+    argv = [
+        "prepare_hf_dataset.py", "--dataset", "json", "--data-files", str(source), "--split", "train",
+        "--output", str(output), "--max-samples", "40", "--include-packages", "pandas",
+        "--num-proc", "1", "--shard-size", str(SHARD_SIZE), *extra,
+    ]
+    monkeypatch.setattr(sys, "argv", argv)
+    prepare_hf_dataset.main()
+
+
+def _rows(output):
+    checkpoint = load_checkpoint(output.with_name(output.name + ".checkpoint.json"))
+    rows = []
+    for shard in checkpoint["shards"]:
+        with open(shard["path"], encoding="utf-8") as f:
+            lines = f.read().splitlines()
+        assert len(lines) == shard["rows"] <= SHARD_SIZE
+        rows.extend(json.loads(line)["messages"][-1]["content"] for line in lines)
+    return rows
+
+
+def _interrupt_after(monkeypatch, shards):
+    finish = ShardWriter._finish_shard
+
+    def crash(self):
+        if len(self.checkpoint["shards"]) == shards:
+            raise KeyboardInterrupt
+        finish(self)
+
+    monkeypatch.setattr(ShardWriter, "_finish_shard", crash)
+
+
+def test_shard_writer_splits_rows(tmp_path):
+    output = tmp_path / "out.jsonl"
+    checkpoint = load_checkpoint(tmp_path / "missing.json")
+    writer = ShardWriter(str(output), 4, tmp_path / "checkpoint.json", checkpoint)
+    writer.write([f'"{i}"' for i in range(10)], list(range(0, 20, 2)))
+    writer.close()
+    assert [shard["rows"] for shard in checkpoint["shards"]] == [4, 4, 2]
+    assert checkpoint["kept"] == 10 and checkpoint["consumed"] == 19
+    assert shard_path(str(output), 1, 4).read_text().split() == ['"4"', '"5"', '"6"', '"7"']
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_resume_after_interruption_has_no_gaps_or_duplicates(monkeypatch, source, tmp_path, streaming):
+    # --max-samples counts kept rows when streaming, input rows otherwise.
+    mode = ["--streaming"] if streaming else []
+    (tmp_path / "full").mkdir()
+    _run(monkeypatch, source, tmp_path / "full" / "out.jsonl", *mode)
+    expected = _rows(tmp_path / "full" / "out.jsonl")
+    kept = [f"respuesta {i}" for i in range(80) if i % 3]
+    assert expected == (kept[:40] if streaming else kept[:26])
+
+    output = tmp_path / "resumed" / "out.jsonl"
+    output.parent.mkdir()
+    with monkeypatch.context() as patch:
+        _interrupt_after(patch, 3)
+        with pytest.raises(KeyboardInterrupt):
+            _run(patch, source, output, *mode)
+    assert len(_rows(output)) == 3 * SHARD_SIZE
+    assert list(output.parent.glob("*.tmp"))
+
+    _run(monkeypatch, source, output, "--resume", *mode)
+    assert _rows(output) == expected
+    assert not list(output.parent.glob("*.jsonl.tmp"))
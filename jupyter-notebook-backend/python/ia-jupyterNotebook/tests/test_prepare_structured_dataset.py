@@ -0,0 +1,39 @@
+import json
+import sys
+
+import pytest
+
+import prepare_structured_dataset
+
+TOPICS = ["pandas", "numpy", "markdown", "sklearn", "algoritmos", "graficos"]
+
+
+@pytest.fixture(scope="module")
+def source(tmp_path_factory):
+    path = tmp_path_factory.mktemp("source") / "messages.jsonl"
+    with path.open("w", encoding="utf-8") as f:
+        for index in range(300):
+            topic = TOPICS[index % len(TOPICS)]
+            messages = [
+                {"role": "user", "content": f"Pregunta {index} sobre {topic}"},
+                {"role": "assistant", "content": f"Respuesta {index}: usa {topic}."},
+            ]
+            f.write(json.dumps({"messages": messages}, ensure_ascii=False) + "\n")
+    return path
+
+
+def _run(monkeypatch, source, output, num_proc):
+    argv = [
+        "prepare_structured_dataset.py", "--input", str(source), "--output", str(output),
+        "--max-samples", "250", "--chunk-size", "7", "--num-proc", str(num_proc),
+    ]
+    monkeypatch.setattr(sys, "argv", argv)
+    prepare_structured_dataset.main()
+    return output.read_bytes()
+
+
+def test_output_does_not_depend_on_num_proc(monkeypatch, source, tmp_path):
+    single = _run(monkeypatch, source, tmp_path / "single.jsonl", 1)
+    assert len(single.splitlines()) == 250
+    for num_proc in (2, 4):
+        assert _run(monkeypatch, source, tmp_path / f"multi-{num_proc}.jsonl", num_proc) == single
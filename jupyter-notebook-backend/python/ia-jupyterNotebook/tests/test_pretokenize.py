@@ -0,0 +1,173 @@
+import copy
+import inspect
+import json
+import random
+import re
+
+import numpy as np
+import pytest
+import torch
+
+from pretokenize_dataset import (
+    PretokenizedCollator,
+    check_masks,
+    get_pretokenized,
+    pack_dataset,
+    pack_sequences,
+    report_mask_fallback,
+    tokenize_batch,
+)
+
+MAX_LEN = 256
+# Assistant turns as rendered by the test chat template, end-of-turn included.
+ASSISTANT_TURN = re.compile(r"<\|im_start\|>assistant\n(.*?<\|im_end\|>\n)", re.DOTALL)
+
+
+def _chat(rng, index):
+    words = ["pandas", "groupby", "media", "ventas", "columna", "filtro", "numpy", "suma"]
+    messages = [{"role": "system", "content": "Eres un instructor de Jupyter."}]
+    for turn in range(rng.randint(1, 2)):
+        messages.append({"role": "user", "content": f"Ejercicio {index}.{turn}: " + " ".join(rng.choices(words, k=rng.randint(1, 6)))})
+        messages.append({"role": "assistant", "content": json.dumps({"title": " ".join(rng.choices(words, k=rng.randint(1, 8)))})})
+    return {"messages": messages}
+
+
+@pytest.fixture(scope="module")
+def train_file(tmp_path_factory):
+    rng = random.Random(0)
+    path = tmp_path_factory.mktemp("data") / "chats.jsonl"
+    with path.open("w", encoding="utf-8") as f:
+        for index in range(60):
+            f.write(json.dumps(_chat(rng, index), ensure_ascii=False) + "\n")
+    return path
+
+
+@pytest.fixture(scope="module")
+def cached(tiny_tokenizer, train_file, tmp_path_factory):
+    return get_pretokenized(tiny_tokenizer, str(train_file), MAX_LEN, str(tmp_path_factory.mktemp("cache")))
+
+
+@pytest.fixture(scope="module")
+def tiny_model(tiny_dir):
+    from transformers import AutoModelForCausalLM
+
+    model = AutoModelForCausalLM.from_pretrained(tiny_dir / "base", dtype=torch.float32)
+    model.config.use_cache = False
+    return model.eval()
+
+
+def test_pack_sequences_fits_and_uses_every_row():
+    rng = random.Random(1)
+    lengths = [rng.randint(1, MAX_LEN) for _ in range(500)]
+    packs = pack_sequences(lengths, MAX_LEN)
+    assert sorted(index for pack in packs for index in pack) == list(range(len(lengths)))
+    assert all(sum(lengths[index] for index in pack) <= MAX_LEN for pack in packs)
+
+
+def test_packed_rows_never_exceed_max_length(cached):
+    packed = pack_dataset(cached, MAX_LEN)
+    assert len(packed) < len(cached)
+    rows = packed[: len(packed)]
+    assert all(len(ids) <= MAX_LEN for ids in rows["input_ids"])
+    assert sum(len(ids) for ids in rows["input_ids"]) == int(np.sum(cached["length"]))
+
+
+def _packs(cached):
+    # Row indices of each pack, in the order pack_dataset lays them out.
+    return pack_sequences(list(cached["length"]), MAX_LEN)
+
+
+def test_packed_labels_stop_at_sequence_boundaries(cached):
+    packed = pack_dataset(cached, MAX_LEN)
+    packs = _packs(cached)
+    collator = PretokenizedCollator(pad_token_id=0)
+    chosen = [i for i, pack in enumerate(packs) if len(pack) > 1][:4] + [0]
+    examples = [packed[i] for i in chosen]
+    batch = collator(examples)
+    assert "attention_mask" not in batch
+    for row, example in enumerate(examples):
+        positions = batch["position_ids"][row, : len(example["input_ids"])]
+        starts = (positions == 0).nonzero().flatten().tolist()
+        assert len(starts) == len(packs[chosen[row]])
+        for start, index in zip(starts, packs[chosen[row]]):
+            source = cached[int(index)]
+            end = start + len(source["input_ids"])
+            assert batch["input_ids"][row, start:end].tolist() == source["input_ids"].tolist()
+            labels = batch["labels"][row, start:end]
+            expected = torch.as_tensor(source["input_ids"], dtype=torch.long).masked_fill(
+                ~torch.as_tensor(source["loss_mask"], dtype=torch.bool), -100
+            )
+            expected[0] = -100
+            assert labels.tolist() == expected.tolist()
+        assert (batch["labels"][row, len(example["input_ids"]) :] == -100).all()
+
+
+def test_packed_sequences_do_not_attend_to_each_other(cached, tiny_model):
+    packed = pack_dataset(cached, MAX_LEN)
+    pack_id, pack = next((i, pack) for i, pack in enumerate(_packs(cached)) if len(pack) > 1)
+    batch = PretokenizedCollator(pad_token_id=0)([packed[pack_id]])
+    with torch.no_grad():
+        logits = tiny_model(input_ids=batch["input_ids"], position_ids=batch["position_ids"]).logits[0]
+        start = 0
+        for index in pack:
+            ids = torch.as_tensor(cached[int(index)]["input_ids"], dtype=torch.long)[None]
+            alone = tiny_model(input_ids=ids).logits[0]
+            torch.testing.assert_close(logits[start : start + ids.shape[-1]], alone, atol=1e-5, rtol=1e-4)
+            start += ids.shape[-1]
+
+
+def test_length_grouped_sampler_yields_every_index_once(cached, tiny_model, tmp_path):
+    from transformers import Trainer, TrainingArguments
+
+    from train_lora_qwen import group_by_length_kwargs
+
+    args = TrainingArguments(
+        output_dir=str(tmp_path),
+        per_device_train_batch_size=4,
+        report_to="none",
+        **group_by_length_kwargs(inspect.signature(TrainingArguments.__init__)),
+    )
+    trainer = Trainer(model=tiny_model, args=args, train_dataset=cached)
+    sampler = trainer._get_train_sampler(cached)
+    assert type(sampler).__name__ == "LengthGroupedSampler"
+    assert sorted(sampler) == list(range(len(cached)))
+
+
+def test_labels_ignore_everything_but_assistant_turns(tiny_tokenizer, train_file, cached):
+    chats = [json.loads(line)["messages"] for line in train_file.read_text(encoding="utf-8").splitlines()]
+    assert len(cached) == len(chats)
+    labels = PretokenizedCollator(tiny_tokenizer.pad_token_id)([cached[i] for i in range(len(cached))])["labels"]
+    for row, messages in enumerate(chats):
+        text = tiny_tokenizer.apply_chat_template(messages, tokenize=False)
+        spans = [match.span(1) for match in ASSISTANT_TURN.finditer(text)]
+        encoded = tiny_tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+        assert encoded["input_ids"] == cached[row]["input_ids"].tolist()
+        for position, (start, end) in enumerate(encoded["offset_mapping"]):
+            inside = any(start < span_end and end > span_start for span_start, span_end in spans)
+            assert (labels[row, position] != -100) == inside, (row, position, text[start:end])
+        learned = tiny_tokenizer.decode(cached[row]["input_ids"][cached[row]["loss_mask"].astype(bool)].tolist())
+        assert all(m["content"] in learned for m in messages if m["role"] == "assistant")
+    assert not np.asarray(cached["mask_fallback"]).any()
+
+
+def test_check_masks_passes(tiny_tokenizer, train_file):
+    assert check_masks(tiny_tokenizer, str(train_file), MAX_LEN, 20) == 0
+
+
+def test_inconsistent_template_rows_are_counted(tiny_tokenizer, train_file, capsys):
+    # A header that depends on the number of turns: no prefix renders as a
+    # prefix of the full chat, so no row can be masked.
+    tokenizer = copy.deepcopy(tiny_tokenizer)
+    tokenizer.chat_template = "turns={{ messages|length }}\n" + tokenizer.chat_template
+    chats = [json.loads(line)["messages"] for line in train_file.read_text(encoding="utf-8").splitlines()[:10]]
+    batch = tokenize_batch({"messages": chats}, tokenizer, MAX_LEN)
+    assert batch["mask_fallback"] == [True] * len(chats)
+    assert all(all(mask) for mask in batch["loss_mask"])
+
+    from datasets import Dataset
+
+    dataset = Dataset.from_dict(batch).with_format("numpy")
+    with pytest.raises(ValueError, match="whole chat"):
+        report_mask_fallback(dataset)
+    assert report_mask_fallback(dataset, max_ratio=1.0) == len(chats)
+    assert "Warning" in capsys.readouterr().out
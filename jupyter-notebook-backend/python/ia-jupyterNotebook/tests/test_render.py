@@ -0,0 +1,22 @@
+import pytest
+
+
+@pytest.mark.parametrize("topic", ["pandas", "numpy", "markdown", "python"])
+@pytest.mark.parametrize("difficulty", ["basica", "intermedia", "avanzada"])
+@pytest.mark.parametrize("exercise_type", ["completar_codigo", "explicar"])
+def test_render_matches_fallback(server, topic, difficulty, exercise_type):
+    payload = server.ExerciseRequest(topic=topic, difficulty=difficulty, exerciseType=exercise_type, datasetSize="mediano")
+    task = server._pick_task(payload)
+    assert server.render_exercise(payload, task) == server.build_fallback_exercise(payload, {}, task)
+
+
+def test_rendered_lists_are_fresh(server):
+    payload = server.ExerciseRequest(topic="pandas", difficulty="basica", exerciseType="explicar", datasetSize="mediano")
+    task = server._pick_task(payload)
+    first = server.render_exercise(payload, task)
+    for key in ("hints", "steps", "acceptanceCriteria"):
+        first[key].append("extra")
+    first["files"][0]["columns"].append("extra")
+    second = server.render_exercise(payload, task)
+    assert "extra" not in second["hints"] + second["steps"] + second["acceptanceCriteria"]
+    assert "extra" not in second["files"][0]["columns"]
@@ -0,0 +1,27 @@
+import pytest
+
+from task_index import SqliteTaskHistoryStore, TaskHistoryStore, TaskIndex
+
+BANK = {"pandas": {"basica": [{"id": f"t{i}", "task": f"tarea {i}"} for i in range(6)]}}
+
+
+def test_history_store_is_abstract():
+    with pytest.raises(TypeError):
+        TaskHistoryStore()
+
+
+def test_sqlite_history_avoids_recent_tasks(tmp_path):
+    group = TaskIndex(BANK).group("pandas", "basica")
+    store = SqliteTaskHistoryStore(str(tmp_path / "history.sqlite3"), history_max=5)
+    picked = [store.pick("u1", "pandas::basica", group)["id"] for _ in range(6)]
+    assert len(set(picked)) == 6
+
+
+def test_sqlite_history_keeps_only_max_scopes(tmp_path):
+    group = TaskIndex(BANK).group("pandas", "basica")
+    store = SqliteTaskHistoryStore(str(tmp_path / "history.sqlite3"), history_max=5, max_scopes=3)
+    for user in ("u1", "u2", "u3", "u1", "u4"):
+        store.pick(user, "pandas::basica", group)
+    scopes = {row[0] for row in store._conn.execute("SELECT DISTINCT scope FROM task_history")}
+    assert scopes == {"u1", "u3", "u4"}
+    assert store._conn.execute("SELECT COUNT(*) FROM task_history_scopes").fetchone()[0] == 3
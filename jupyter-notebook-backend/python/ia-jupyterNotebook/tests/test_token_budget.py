@@ -0,0 +1,67 @@
+import json
+
+from inference import MicroBatcher, RowUsage
+
+BODY = {"topic": "pandas", "difficulty": "basica", "exerciseType": "completar_codigo", "datasetSize": "pequeno"}
+
+
+def test_usage_reports_generated_tokens_per_row(server):
+    usages = [RowUsage(), RowUsage()]
+    server._generate_batch(
+        ["Crea un ejercicio de pandas", "def _norm"], {"top_k": 1, "max_new_tokens": [3, 7], "usage": usages}
+    )
+    assert [usage.new_tokens for usage in usages] == [3, 7]
+
+
+def test_usage_is_per_row_in_the_batcher():
+    seen = []
+
+    def runner(prompts, gen_kwargs, timings):
+        seen.append(gen_kwargs["usage"])
+        for usage in gen_kwargs["usage"]:
+            if usage is not None:
+                usage.new_tokens = 5
+        return list(prompts)
+
+    batcher = MicroBatcher(runner, max_wait_ms=200, per_row=("max_new_tokens", "usage"))
+    usage = RowUsage()
+    try:
+        futures = [batcher.submit("a", usage=usage, max_new_tokens=4), batcher.submit("b", max_new_tokens=8)]
+        [future.result(timeout=10) for future in futures]
+    finally:
+        batcher.close()
+    assert seen == [[usage, None]] and usage.new_tokens == 5
+
+
+def test_budget_learns_from_generated_tokens(server, monkeypatch):
+    learned = []
+    blob = '{"title": "t"}'
+
+    def fake_batch(prompts, gen_kwargs, timings):
+        for usage in gen_kwargs["usage"]:
+            usage.new_tokens = 42
+        return [blob] * len(prompts)
+
+    monkeypatch.setattr(server, "_generate_batch", fake_batch)
+    monkeypatch.setattr(server, "_batcher", None)
+    monkeypatch.setattr(server._token_budget, "observe", lambda key, tokens: learned.append((key, tokens)))
+    try:
+        payload = server.ExerciseRequest(**BODY)
+        server._generate_llm(payload, server._pick_task(payload))
+    finally:
+        server._batcher.close()
+    assert learned == [(server._task_key(payload), 42)]
+
+
+def test_budget_keys_are_capped(tmp_path):
+    from token_budget import TokenBudget
+
+    path = tmp_path / "budget.json"
+    budget = TokenBudget(16, minimum=1, min_samples=1, path=str(path), save_every=1, max_keys=3)
+    for index in range(10):
+        budget.observe(f"topic-{index}", 10)
+    budget.observe("topic-7", 12)
+    assert list(budget._samples) == ["topic-8", "topic-9", "topic-7"]
+    assert set(budget.stats()["learned"]) == {"topic-7", "topic-8", "topic-9"}
+    assert list(json.loads(path.read_text())["samples"]) == ["topic-8", "topic-9", "topic-7"]
+    assert list(TokenBudget(16, path=str(path), max_keys=2)._samples) == ["topic-9", "topic-7"]
@@ -0,0 +1,126 @@
+import json
+import math
+import os
+import threading
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict
+
+
+# max_new_tokens per request key (topic::tier::exerciseType), learned from the
+# token length of recent successful outputs: the `quantile` of the last
+# `window` lengths times `margin`, clamped to [minimum, maximum]. Keys with
+# fewer than `min_samples` use `default`. Outputs cut at their budget record
+# `growth` times that budget, so a budget that is too small grows quickly.
+# Only the `max_keys` most recently observed keys are kept (and saved): keys
+# carry client text, so the oldest is dropped when a new one arrives.
+# Samples are saved to `path` (JSON) every `save_every` observations.
+class TokenBudget:
+    def __init__(
+        self,
+        default: int,
+        minimum: int = 64,
+        maximum: int = 1024,
+        quantile: float = 0.95,
+        margin: float = 1.15,
+        min_samples: int = 8,
+        window: int = 200,
+        growth: float = 1.5,
+        path: str = "",
+        save_every: int = 20,
+        max_keys: int = 1000,
+    ):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.default = default
+        self.quantile = min(1.0, max(0.0, quantile))
+        self.margin = margin
+        self.min_samples = max(1, min_samples)
+        self.window = window
+        self.growth = growth
+        self.path = path
+        self.save_every = save_every
+        self.max_keys = max(1, max_keys)
+        self._samples: "OrderedDict[str, Deque[int]]" = OrderedDict()
+        self._budgets: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._unsaved = 0
+        self.truncations = 0
+        self._load()
+
+    def _clamp(self, tokens: float) -> int:
+        return int(min(self.maximum, max(self.minimum, math.ceil(tokens))))
+
+    def budget(self, key: str) -> int:
+        return self._budgets.get(key, self.default)
+
+    def observe(self, key: str, tokens: int) -> None:
+        self._add(key, tokens)
+
+    def observe_truncated(self, key: str, budget: int) -> None:
+        self._add(key, budget * self.growth, truncated=True)
+
+    def _add(self, key: str, tokens: float, truncated: bool = False) -> None:
+        with self._lock:
+            self.truncations += truncated
+            samples = self._track(key)
+            samples.append(int(math.ceil(tokens)))
+            self._refresh(key)
+            self._unsaved += 1
+            save = bool(self.path) and self._unsaved >= self.save_every
+        if save:
+            self.save()
+
+    def _track(self, key: str) -> Deque[int]:
+        samples = self._samples.get(key)
+        if samples is None:
+            samples = self._samples[key] = deque(maxlen=self.window)
+            while len(self._samples) > self.max_keys:
+                stale, _ = self._samples.popitem(last=False)
+                self._budgets.pop(stale, None)
+        else:
+            self._samples.move_to_end(key)
+        return samples
+
+    def _refresh(self, key: str) -> None:
+        samples = self._samples[key]
+        if len(samples) < self.min_samples:
+            self._budgets.pop(key, None)
+            return
+        ordered = sorted(samples)
+        value = ordered[max(0, math.ceil(self.quantile * len(ordered)) - 1)]
+        self._budgets[key] = self._clamp(value * self.margin)
+
+    def _load(self) -> None:
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as handle:
+                stored = json.load(handle)
+        except (OSError, ValueError):
+            return
+        # Saved oldest first, so the most recent keys survive a smaller max_keys.
+        for key, samples in stored.get("samples", {}).items():
+            self._track(key).extend(int(value) for value in samples)
+            self._refresh(key)
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        with self._save_lock:
+            with self._lock:
+                data = {"samples": {key: list(samples) for key, samples in self._samples.items()}}
+                self._unsaved = 0
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as handle:
+                json.dump(data, handle)
+            os.replace(tmp_path, self.path)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "default": self.default,
+                "keys": len(self._samples),
+                "learned": dict(sorted(self._budgets.items())),
+                "truncations": self.truncations,
+            }
@@ -1,7 +1,9 @@
 import argparse
+import importlib.util
 import inspect
+import time
 from dataclasses import dataclass
-from typing import List
+from typing import Any, Dict, List
 
 import torch
 from datasets import load_dataset
@@ -10,6 +12,7 @@ from transformers import (
   AutoModelForCausalLM,
   AutoTokenizer,
   BitsAndBytesConfig,
+  TrainerCallback,
   TrainingArguments,
 )
 from trl import SFTTrainer
@@ -18,6 +21,16 @@ try:
 except ImportError:  # Older TRL versions
     SFTConfig = None
 
+from pretokenize_dataset import (
+    DEFAULT_CACHE_DIR,
+    DEFAULT_MAX_MASK_FALLBACK,
+    PretokenizedCollator,
+    get_pretokenized,
+    pack_dataset,
+    padding_ratio,
+    supports_packed_position_ids,
+)
+
 
 @dataclass
 class TrainConfig:
@@ -35,6 +48,12 @@ class TrainConfig:
     save_steps: int = 100
     logging_steps: int = 50
     warmup_ratio: float = 0.05
+    cache_dir: str = DEFAULT_CACHE_DIR
+    dataset_num_proc: int = 1
+    packing: bool = False
+    group_by_length: bool = False
+    assistant_only_loss: bool = True
+    max_mask_fallback: float = DEFAULT_MAX_MASK_FALLBACK
 
 
 def build_prompt(tokenizer, messages: List[dict]) -> str:
@@ -50,6 +69,46 @@ def formatting_func(tokenizer):
     return _format
 
 
+def group_by_length_kwargs(training_signature: inspect.Signature) -> Dict[str, Any]:
+    # transformers 5 replaced the `group_by_length` flag with a sampling strategy.
+    if "train_sampling_strategy" in training_signature.parameters:
+        return {"train_sampling_strategy": "group_by_length"}
+    return {"group_by_length": True}
+
+
+# Adds tokens/s (real tokens, no padding) and the padding ratio since the
+# previous log to the trainer logs, from the collator's counters.
+class ThroughputCallback(TrainerCallback):
+    def __init__(self, collator: PretokenizedCollator):
+        self.collator = collator
+        self._started = time.perf_counter()
+        self._last = (self._started, 0, 0)
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self._started = time.perf_counter()
+        self._last = (self._started, self.collator.tokens, self.collator.slots)
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        if logs is None:
+            return
+        now = time.perf_counter()
+        last_time, last_tokens, last_slots = self._last
+        tokens = self.collator.tokens - last_tokens
+        slots = self.collator.slots - last_slots
+        if slots:
+            logs["tokens_per_s"] = round(tokens / max(now - last_time, 1e-9), 1)
+            logs["padding_ratio"] = round(1 - tokens / slots, 4)
+        self._last = (now, self.collator.tokens, self.collator.slots)
+
+    def on_train_end(self, args, state, control, **kwargs):
+        elapsed = time.perf_counter() - self._started
+        tokens, slots = self.collator.tokens, max(self.collator.slots, 1)
+        print(
+            f"Trained on {tokens} tokens in {elapsed:.1f}s ({tokens / max(elapsed, 1e-9):.1f} tokens/s), "
+            f"padding ratio {1 - tokens / slots:.1%}"
+        )
+
+
 def parse_args() -> TrainConfig:
     parser = argparse.ArgumentParser()
     parser.add_argument("--model-name", default=TrainConfig.model_name)
@@ -74,6 +133,34 @@ def parse_args() -> TrainConfig:
     parser.add_argument("--save-steps", type=int, default=TrainConfig.save_steps)
     parser.add_argument("--logging-steps", type=int, default=TrainConfig.logging_steps)
     parser.add_argument("--warmup-ratio", type=float, default=TrainConfig.warmup_ratio)
+    parser.add_argument(
+        "--cache-dir",
+        default=TrainConfig.cache_dir,
+        help="Pretokenized dataset cache (see pretokenize_dataset.py). Empty string disables it.",
+    )
+    parser.add_argument("--dataset-num-proc", type=int, default=TrainConfig.dataset_num_proc)
+    parser.add_argument(
+        "--packing",
+        action="store_true",
+        help="Pack several samples into each --max-seq-length window (needs the pretokenized cache).",
+    )
+    parser.add_argument(
+        "--group-by-length",
+        action="store_true",
+        help="Batch samples of similar length together to cut padding.",
+    )
+    parser.add_argument(
+        "--assistant-only-loss",
+        action=argparse.BooleanOptionalAction,
+        default=TrainConfig.assistant_only_loss,
+        help="Compute the loss only on assistant turns (needs the pretokenized cache).",
+    )
+    parser.add_argument(
+        "--max-mask-fallback",
+        type=float,
+        default=TrainConfig.max_mask_fallback,
+        help="Fail if more than this share of rows cannot be masked and would train on the whole chat.",
+    )
     args = parser.parse_args()
 
     return TrainConfig(**vars(args))
@@ -81,6 +168,10 @@ def parse_args() -> TrainConfig:
 
 def main() -> None:
     cfg = parse_args()
+    if cfg.packing and not cfg.cache_dir:
+        raise ValueError("--packing needs the pretokenized cache (--cache-dir)")
+    if cfg.packing and not supports_packed_position_ids():
+        raise RuntimeError("--packing needs transformers>=4.53 (block-diagonal masks from position_ids)")
     if torch.cuda.is_available():
         torch.backends.cuda.matmul.allow_tf32 = True
 
@@ -88,23 +179,32 @@ def main() -> None:
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token
 
-    bnb_config = BitsAndBytesConfig(
-        load_in_4bit=True,
-        bnb_4bit_quant_type="nf4",
-        bnb_4bit_compute_dtype=torch.float16,
-        bnb_4bit_use_double_quant=True,
-    )
+    # 4-bit QLoRA needs CUDA + bitsandbytes; otherwise train plain LoRA in fp32
+    # (CPU smoke runs with small models).
+    use_4bit = torch.cuda.is_available() and importlib.util.find_spec("bitsandbytes") is not None
+    if use_4bit:
+        bnb_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.float16,
+            bnb_4bit_use_double_quant=True,
+        )
 
-    model = AutoModelForCausalLM.from_pretrained(
-        cfg.model_name,
-        device_map="auto",
-        quantization_config=bnb_config,
-        dtype=torch.float16,
-    )
+        model = AutoModelForCausalLM.from_pretrained(
+            cfg.model_name,
+            device_map="auto",
+            quantization_config=bnb_config,
+            dtype=torch.float16,
+        )
+    else:
+        model = AutoModelForCausalLM.from_pretrained(cfg.model_name, dtype=torch.float32)
 
     model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
     model.config.use_cache = False
-    model = prepare_model_for_kbit_training(model)
+    if use_4bit:
+        model = prepare_model_for_kbit_training(model)
+    else:
+        model.enable_input_require_grads()
     lora_config = LoraConfig(
         r=cfg.lora_r,
         lora_alpha=cfg.lora_alpha,
@@ -123,7 +223,36 @@ def main() -> None:
     )
     model = get_peft_model(model, lora_config)
 
-    dataset = load_dataset("json", data_files=cfg.train_file, split="train")
+    if cfg.cache_dir:
+        # Tokenized once per (tokenizer, chat template, max_seq_length, file)
+        # and memory-mapped on later runs; TRL's own preparation is skipped.
+        dataset = get_pretokenized(
+            tokenizer,
+            cfg.train_file,
+            cfg.max_seq_length,
+            cfg.cache_dir,
+            cfg.dataset_num_proc,
+            cfg.assistant_only_loss,
+            cfg.max_mask_fallback,
+        )
+        lengths = dataset["length"]
+        batch_size = cfg.per_device_train_batch_size
+        summary = (
+            f"Padding with batch size {batch_size}: random {padding_ratio(lengths, batch_size):.1%}, "
+            f"group_by_length {padding_ratio(lengths, batch_size, group_by_length=True):.1%}"
+        )
+        if cfg.packing:
+            packed = pack_dataset(dataset, cfg.max_seq_length)
+            summary += (
+                f", packing {padding_ratio(packed['length'], batch_size):.1%} "
+                f"({len(dataset)} samples -> {len(packed)} packs of up to {cfg.max_seq_length} tokens)"
+            )
+            dataset = packed
+        print(summary)
+    else:
+        if cfg.assistant_only_loss:
+            print("Without --cache-dir the loss covers the whole chat (system and user turns included).")
+        dataset = load_dataset("json", data_files=cfg.train_file, split="train")
 
     warmup_steps = int(cfg.max_steps * cfg.warmup_ratio)
     training_args_kwargs = dict(
@@ -140,22 +269,43 @@ def main() -> None:
         report_to="none",
     )
 
-    training_signature = inspect.signature(TrainingArguments.__init__)
-    if "optim" in training_signature.parameters:
+    # SFTConfig (a TrainingArguments subclass) when TRL has it, so the dataset
+    # options below reach the trainer.
+    training_cls = SFTConfig if SFTConfig is not None else TrainingArguments
+    training_signature = inspect.signature(training_cls.__init__)
+    if "optim" in training_signature.parameters and use_4bit:
         training_args_kwargs["optim"] = "paged_adamw_8bit"
     if "push_to_hub" in training_signature.parameters:
         training_args_kwargs["push_to_hub"] = False
     if "push_to_hub_token" in training_signature.parameters:
         training_args_kwargs["push_to_hub_token"] = None
 
-    training_args = TrainingArguments(**training_args_kwargs)
+    # TRL truncates to this when it tokenizes (no --cache-dir); the cache is
+    # already cut to it. Older SFTConfig versions call it max_seq_length.
+    for name in ("max_length", "max_seq_length"):
+        if name in training_signature.parameters:
+            training_args_kwargs[name] = cfg.max_seq_length
+            break
+    if cfg.cache_dir and "dataset_kwargs" in training_signature.parameters:
+        training_args_kwargs["dataset_kwargs"] = {"skip_prepare_dataset": True}
+    if cfg.cache_dir and "remove_unused_columns" in training_signature.parameters:
+        training_args_kwargs["remove_unused_columns"] = False
+    if cfg.group_by_length:
+        training_args_kwargs.update(group_by_length_kwargs(training_signature))
+
+    training_args = training_cls(**training_args_kwargs)
 
     trainer_kwargs = dict(
         model=model,
         train_dataset=dataset,
-        formatting_func=formatting_func(tokenizer),
         args=training_args,
     )
+    if cfg.cache_dir:
+        collator = PretokenizedCollator(tokenizer.pad_token_id)
+        trainer_kwargs["data_collator"] = collator
+        trainer_kwargs["callbacks"] = [ThroughputCallback(collator)]
+    else:
+        trainer_kwargs["formatting_func"] = formatting_func(tokenizer)
 
     trainer_signature = inspect.signature(SFTTrainer.__init__)
     if SFTConfig is not None and "sft_config" in trainer_signature.parameters:
@@ -171,7 +321,9 @@ def main() -> None:
 
     # Do NOT pass tokenizer/processing_class to avoid TRL/Transformers incompatibilities
     if "max_seq_length" in trainer_signature.parameters and "sft_config" not in trainer_kwargs:
+        trainer_kwargs["max_seq_length"] = cfg.max_seq_length
     if "dataset_text_field" in trainer_signature.parameters and "sft_config" not in trainer_kwargs:
+        trainer_kwargs["dataset_text_field"] = None
 
     trainer = SFTTrainer(**trainer_kwargs)
 